@@ -1,23 +1,65 @@
 from django.contrib import admin
+from django.forms.models import BaseInlineFormSet
+from django.urls import reverse
+from django.utils.html import format_html
+from .listing import search_uploads
 from .models import DataUpload, DataPreview
 
+# Columns shown inline on an upload's admin page; the rest are one click away
+PREVIEW_INLINE_LIMIT = 50
+
+class CappedPreviewFormSet(BaseInlineFormSet):
+    def get_queryset(self):
+        if not hasattr(self, '_capped_queryset'):
+            self._capped_queryset = super().get_queryset().order_by('sheet_name', 'id')[:PREVIEW_INLINE_LIMIT]
+        return self._capped_queryset
+
 class DataPreviewInline(admin.TabularInline):
     model = DataPreview
+    formset = CappedPreviewFormSet
     extra = 0
-    readonly_fields = ['sheet_name', 'column_name', 'column_data_type', 'sample_data']
+    readonly_fields = ['sheet_name', 'column_name', 'column_data_type', 'inferred_type', 'nullable', 'sample_data']
     can_delete = False
     max_num = 0
+    # Collapsed until opened, so wide uploads do not swamp the page
+    classes = ['collapse']
 
 @admin.register(DataUpload)
 class DataUploadAdmin(admin.ModelAdmin):
-    list_display = ['title', 'display_filename', 'uploaded_at']
-    list_filter = ['uploaded_at']
-    search_fields = ['title', 'description']
-    readonly_fields = ['display_filename', 'get_extension']
+    list_display = ['title', 'display_filename', 'file_extension', 'file_size', 'uploaded_at']
+    list_filter = ['uploaded_at', 'file_extension']
+    # Titles are matched through the full-text index (see listing.py)
+    search_fields = ['title']
+    readonly_fields = ['display_filename', 'get_extension', 'file_size', 'file_extension', 'preview_columns']
     date_hierarchy = 'uploaded_at'
+    ordering = ['-uploaded_at', '-id']
+    show_full_result_count = False
     inlines = [DataPreviewInline]
-    
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).defer('description', 'sheet_names')
+
+    def get_search_results(self, request, queryset, search_term):
+        return search_uploads(queryset, search_term), False
+
     def display_filename(self, obj):
         return obj.filename()
-    
+
     display_filename.short_description = 'File Name'
+
+    def preview_columns(self, obj):
+        count = obj.previews.count()
+        url = reverse('admin:dashboard_datapreview_changelist') + f'?upload__id__exact={obj.pk}'
+        shown = min(count, PREVIEW_INLINE_LIMIT)
+        return format_html('{} columns, {} shown below. <a href="{}">Browse all</a>', count, shown, url)
+
+    preview_columns.short_description = 'Columns'
+
+@admin.register(DataPreview)
+class DataPreviewAdmin(admin.ModelAdmin):
+    list_display = ['column_name', 'sheet_name', 'upload', 'inferred_type', 'nullable']
+    list_filter = ['inferred_type']
+    list_select_related = ['upload']
+    search_fields = ['column_name']
+    raw_id_fields = ['upload']
+    show_full_result_count = False
@@ -0,0 +1,250 @@
+"""
+Append-mode uploads: add the rows of a new CSV file to an existing upload.
+
+Only the new rows are parsed and profiled. Their bytes are added to the
+upload's file, the existing Parquet row groups are copied into the new
+sidecar unchanged, and the profile of the new row groups is merged into
+the accumulators stored when the sheet was last profiled (see
+``profiling.save_profiler``). The merged profile replaces the stored one
+and is written straight into the preview cache under the new version.
+
+An upload that shares its file with other uploads (``StoredBlob``) gets a
+private copy first. Its new content hash chains the old one with the
+hash of the appended rows, so the file is never hashed in full again.
+The CSV row index (see rowindex.py) is extended with the new records.
+When the new rows do not fit the stored column types, the upload is
+ingested again from scratch instead. The whole append holds the upload's
+``upload_lock``, so readers wait for it rather than rebuilding the sidecar.
+"""
+import hashlib
+import logging
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+from django.db import transaction
+from django.db.models import F
+
+from .caching import PREVIEW_CACHE_TIMEOUT, set_value, versioned_key
+from .columnar import (
+    META_SHEET, SchemaDrift, _source_metadata, append_sidecar, ensure_sidecar, iter_sidecar_chunks, open_sidecar,
+    sidecar_path, sidecar_version, upload_lock,
+)
+from .database import retry_write
+from .models import DataPreview, DataUpload, SheetProfile, UploadRollup
+from .profiling import approximate_profiles, build_profiler, load_profiler, save_profiler, to_json_safe
+from .readers import CSV_CHUNK_ROWS, CSV_SHEET_NAME, iter_csv_chunks
+from .rowindex import extend_row_index, load_row_index
+from .schema import TypeMismatch, arrow_read_options
+
+logger = logging.getLogger(__name__)
+
+# Appended files and the upload's file are copied in blocks of this size
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+class AppendError(ValueError):
+    """The file cannot be appended to the upload"""
+
+
+def header_end(path):
+    """Byte offset just past the header record of a CSV file (newlines in quotes are skipped)"""
+    head = b''
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_BLOCK_SIZE), b''):
+            position = len(head) - 1
+            head += block
+            while (position := head.find(b'\n', position + 1)) != -1:
+                # An odd number of quotes before it puts the newline inside a field
+                if not head.count(b'"', 0, position) % 2:
+                    return position + 1
+    return len(head)
+
+
+def check_appendable(upload, path):
+    """Raise ``AppendError`` unless the CSV at ``path`` can be appended to ``upload``"""
+    if upload.get_extension() != '.csv':
+        raise AppendError('Rows can only be appended to CSV uploads')
+    if not path.lower().endswith('.csv'):
+        raise AppendError('Only CSV files can be appended')
+    try:
+        existing = list(pd.read_csv(upload.file.path, nrows=0).columns)
+        incoming = list(pd.read_csv(path, nrows=0).columns)
+    except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError) as e:
+        raise AppendError(f'Could not read the CSV header: {e}')
+    if incoming != existing:
+        raise AppendError('The appended file must have the same columns, in the same order, as the upload')
+
+
+def _append_bytes(source, target, start):
+    """Append ``source`` from byte ``start`` to ``target``; returns ``(bytes_written, sha256)``"""
+    digest = hashlib.sha256()
+    written = 0
+    with open(target, 'rb+') as out:
+        out.seek(0, os.SEEK_END)
+        if out.tell():
+            out.seek(-1, os.SEEK_END)
+            if out.read(1) != b'\n':
+                out.write(b'\n')
+                written += 1
+        with open(source, 'rb') as f:
+            f.seek(start)
+            for block in iter(lambda: f.read(COPY_BLOCK_SIZE), b''):
+                out.write(block)
+                digest.update(block)
+                written += len(block)
+    return written, digest.hexdigest()
+
+
+def _chain_hash(content_hash, appended_sha256):
+    return hashlib.sha256(f'{content_hash}+{appended_sha256}'.encode()).hexdigest()
+
+
+def _incoming_chunks(path, schema):
+    options = arrow_read_options(schema)
+    try:
+        yield from iter_csv_chunks(path, chunksize=CSV_CHUNK_ROWS, read_options=options)
+    except TypeMismatch as e:
+        # Values the stored column types cannot hold: the sidecar needs new types
+        raise SchemaDrift(schema) from e
+
+
+def _stored_profiler(sidecar, version):
+    """Accumulators of the sidecar's current profile, profiling it once if none were stored"""
+    profiler = load_profiler(sidecar, version)
+    if profiler is None:
+        logger.info(f"No stored profile state for {os.path.basename(sidecar)}, profiling it once")
+        profiler = build_profiler(iter_sidecar_chunks(sidecar), approximate=approximate_profiles())
+    return profiler
+
+
+def _private_copy(upload):
+    """Give an upload sharing a stored blob its own copy of the file; returns the new name"""
+    storage = upload.file.storage
+    name = storage.get_available_name(upload.file.name)
+    shutil.copyfile(upload.file.path, storage.path(name))
+    return name
+
+
+def append_rows(upload, path, progress=None):
+    """Append the data rows of the CSV at ``path`` to ``upload``; returns the number of rows added"""
+    with upload_lock(upload):
+        # A previous append may have moved the file while we waited
+        upload.refresh_from_db()
+        return _append_rows(upload, path, progress)
+
+
+def _append_rows(upload, path, progress):
+    from .blobs import release_file
+    from .processing import process_excel_file
+
+    report = progress or (lambda percent, message='': None)
+    check_appendable(upload, path)
+
+    report(10, 'Loading stored statistics')
+    old_sidecar = ensure_sidecar(upload, CSV_SHEET_NAME)
+    old_version = sidecar_version(old_sidecar)
+    profiler = _stored_profiler(old_sidecar, old_version)
+    old_rows = open_sidecar(old_sidecar).metadata.num_rows
+    old_offsets = load_row_index(upload, old_sidecar, open_sidecar(old_sidecar))
+    if old_offsets is not None:
+        # Rebuilding the sidecar drops its index directory
+        old_offsets = np.array(old_offsets)
+
+    shared = upload.blob_id is not None
+    recorded_size = upload.file_size
+    old_upload = DataUpload(pk=upload.pk, file=upload.file.name, blob_id=upload.blob_id, content_hash=upload.content_hash)
+    name = _private_copy(upload) if shared else upload.file.name
+    file_path = upload.file.storage.path(name)
+    original_size = os.path.getsize(file_path)
+
+    report(30, 'Appending rows')
+    try:
+        body_start = header_end(path)
+        added_bytes, appended_sha256 = _append_bytes(path, file_path, body_start)
+        # Past the newline added when the file did not end with one
+        append_start = original_size + added_bytes - (os.path.getsize(path) - body_start)
+        upload.file.name = name
+        upload.blob = None
+        upload.content_hash = _chain_hash(upload.content_hash or old_version, appended_sha256)
+        metadata = _source_metadata(file_path, upload.content_hash)
+        metadata[META_SHEET] = CSV_SHEET_NAME.encode()
+        target = sidecar_path(upload)
+        try:
+            kept_groups = append_sidecar(
+                old_sidecar, target, _incoming_chunks(path, open_sidecar(old_sidecar).schema_arrow), metadata,
+            )
+        except SchemaDrift:
+            kept_groups = None
+    except Exception:
+        # Leave the upload as it was
+        if shared:
+            os.remove(file_path)
+        else:
+            os.truncate(file_path, original_size)
+        upload.file.name = old_upload.file.name
+        upload.blob_id = old_upload.blob_id
+        upload.content_hash = old_upload.content_hash
+        raise
+
+    upload.file_size = original_size + added_bytes
+    _record_file(upload, name, recorded_size)
+    if shared:
+        release_file(old_upload)
+
+    if kept_groups is None:
+        logger.info(f"Appended rows of upload {upload.pk} changed its column types; ingesting it again")
+        report(40, 'Column types changed, processing the whole file again')
+        total_rows = process_excel_file(upload, progress=report)
+        DataUpload.objects.filter(pk=upload.pk).update(row_count=total_rows)
+        return total_rows - old_rows
+
+    report(60, 'Profiling the new rows')
+    parquet = open_sidecar(target)
+    new_groups = list(range(kept_groups, parquet.metadata.num_row_groups))
+    profiler.merge(build_profiler(iter_sidecar_chunks(target, row_groups=new_groups), approximate=profiler.approximate))
+    save_profiler(target, profiler, upload.content_hash)
+    profile = to_json_safe(profiler.result())
+    added_rows = parquet.metadata.num_rows - old_rows
+    if old_offsets is not None:
+        extend_row_index(file_path, target, old_offsets, append_start)
+
+    report(90, 'Saving statistics')
+    _save_profile(upload, profile)
+    set_value(versioned_key('data_preview', upload, 0), profile, PREVIEW_CACHE_TIMEOUT)
+    return added_rows
+
+
+@retry_write
+def _record_file(upload, name, recorded_size):
+    """Point the upload at its grown file and move the rollup by the added bytes"""
+    with transaction.atomic():
+        DataUpload.objects.filter(pk=upload.pk).update(
+            file=name, blob=None, content_hash=upload.content_hash, file_size=upload.file_size,
+        )
+        UploadRollup.objects.filter(extension=upload.file_extension).update(
+            total_size=F('total_size') + upload.file_size - recorded_size,
+        )
+
+
+@retry_write
+def _save_profile(upload, profile):
+    with transaction.atomic():
+        SheetProfile.objects.update_or_create(
+            upload=upload,
+            sheet_name=CSV_SHEET_NAME,
+            defaults={
+                'position': 0,
+                'row_count': profile['stats']['row_count'],
+                'column_count': profile['stats']['column_count'],
+                'profile': profile,
+                'content_hash': upload.content_hash,
+            },
+        )
+        DataUpload.objects.filter(pk=upload.pk).update(row_count=profile['stats']['row_count'])
+        # Sample values come from the first rows, but new rows may bring the first nulls
+        nullable = [column['name'] for column in profile['column_stats'] if column['null_count']]
+        DataPreview.objects.filter(
+            upload=upload, sheet_name=CSV_SHEET_NAME, column_name__in=nullable,
+        ).update(nullable=True)
@@ -4,3 +4,21 @@ from django.apps import AppConfig
 class DashboardConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'dashboard'
+
+    def ready(self):
+        # Connects the receivers that keep the upload rollups current and
+        # clean up the files and tables of deleted uploads
+        from . import blobs, materialize, summary  # noqa: F401
+        from django.db.backends.signals import connection_created
+        from django.db.models.signals import post_migrate
+        from .database import configure_connection
+        post_migrate.connect(restore_title_search, sender=self)
+        connection_created.connect(configure_connection)
+
+
+def restore_title_search(sender, using, **kwargs):
+    # Migrations that rebuild the upload table drop the search triggers
+    from django.db import connections
+    from .listing import install_title_search
+
+    install_title_search(connections[using])
@@ -0,0 +1,380 @@
+"""
+Benchmarks of ingestion and the preview pages (see ``manage.py bench``).
+
+Synthetic CSV/XLSX files with a chosen number of rows, columns and mix of
+column types are generated into a scratch directory. Each is ingested
+with ``process_excel_file`` and its pages are fetched through the test
+client, against a throwaway SQLite database, media root and cache, so a
+run never touches real data. Every step records wall time, peak resident
+memory and the number of SQL queries. ``bench_concurrent`` measures page
+latency while another thread writes to the database.
+"""
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+# Column types the generator knows, in the order columns are assigned
+COLUMN_KINDS = ('int', 'float', 'str', 'date', 'bool')
+DEFAULT_MIX = {'int': 3, 'float': 3, 'str': 2, 'date': 1, 'bool': 1}
+# Rows generated and written per block, so big files need little memory
+GENERATE_BLOCK_ROWS = 100000
+# Distinct values of generated text columns
+STRING_VOCABULARY = 500
+
+
+def parse_mix(text):
+    """``'int=3,float=2'`` -> ``{'int': 3, 'float': 2}``"""
+    mix = {}
+    for part in filter(None, (item.strip() for item in text.split(','))):
+        kind, _, weight = part.partition('=')
+        if kind not in COLUMN_KINDS:
+            raise ValueError(f"Unknown column type '{kind}', expected one of {', '.join(COLUMN_KINDS)}")
+        mix[kind] = float(weight or 1)
+    if not mix or sum(mix.values()) <= 0:
+        raise ValueError('The column mix needs at least one positive weight')
+    return mix
+
+
+def column_kinds(columns, mix):
+    """Spread ``columns`` over the types of ``mix`` in proportion to their weights"""
+    total = sum(mix.values())
+    kinds = []
+    for kind, weight in mix.items():
+        kinds.extend([kind] * int(round(columns * weight / total)))
+    kinds = (kinds + [max(mix, key=mix.get)] * columns)[:columns]
+    return kinds
+
+
+def _block(kinds, start, rows, rng, nulls):
+    vocabulary = np.array([f'value_{i}' for i in range(STRING_VOCABULARY)], dtype=object)
+    data = {}
+    for i, kind in enumerate(kinds):
+        if kind == 'int':
+            values = pd.array(rng.integers(0, 10 ** (2 + i % 6), rows), dtype='Int64')
+        elif kind == 'float':
+            values = pd.array(rng.normal(1000, 250, rows).round(2), dtype='Float64')
+        elif kind == 'str':
+            values = pd.array(vocabulary[rng.integers(0, STRING_VOCABULARY, rows)], dtype='str')
+        elif kind == 'date':
+            values = pd.Series(pd.Timestamp('2020-01-01') + pd.to_timedelta(start + np.arange(rows), unit='min'))
+        else:
+            values = pd.array(rng.random(rows) < 0.5, dtype='boolean')
+        values = pd.Series(values)
+        if nulls and kind != 'date':
+            values[rng.random(rows) < nulls] = None
+        data[f'{kind}_{i}'] = values
+    return pd.DataFrame(data)
+
+
+def generate_dataset(path, rows, columns, mix=None, nulls=0.0, seed=0):
+    """Write a synthetic ``.csv`` or ``.xlsx`` file and return its size in bytes"""
+    kinds = column_kinds(columns, mix or DEFAULT_MIX)
+    rng = np.random.default_rng(seed)
+    blocks = (
+        _block(kinds, start, min(GENERATE_BLOCK_ROWS, rows - start), rng, nulls)
+        for start in range(0, rows, GENERATE_BLOCK_ROWS)
+    )
+    if path.endswith('.csv'):
+        for i, block in enumerate(blocks):
+            block.to_csv(path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+        if not rows:
+            _block(kinds, 0, 0, rng, nulls).to_csv(path, index=False)
+    elif path.endswith('.xlsx'):
+        from openpyxl import Workbook
+
+        workbook = Workbook(write_only=True)
+        worksheet = workbook.create_sheet('Data')
+        header = [f'{kind}_{i}' for i, kind in enumerate(kinds)]
+        worksheet.append(header)
+        for block in blocks:
+            for row in block.astype(object).where(block.notna(), None).itertuples(index=False):
+                worksheet.append([value.to_pydatetime() if isinstance(value, pd.Timestamp) else value for value in row])
+        workbook.save(path)
+    else:
+        raise ValueError(f'Cannot generate {path}: only .csv and .xlsx are supported')
+    return os.path.getsize(path)
+
+
+def _reset_peak_rss():
+    # Linux only: start a new high-water mark for this process
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Lifetime peak of the process (kilobytes on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class QueryCounter:
+    """Thread-safe count of the SQL queries run on every tracked connection"""
+
+    def __init__(self):
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.total += 1
+        return execute(sql, params, many, context)
+
+    def track(self, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+queries = QueryCounter()
+
+
+def track_queries():
+    """Count the queries of every connection, including those opened by worker threads
+
+    Async views query from other threads, where a ``CaptureQueriesContext``
+    on the request thread's connection would miss them.
+    """
+    from django.db import connections
+    from django.db.backends.signals import connection_created
+
+    connection_created.connect(queries.track, weak=False)
+    for connection in connections.all():
+        queries.track(connection)
+
+
+@contextmanager
+def measure(into):
+    """Record wall time, peak RSS and SQL queries of the block into the dict ``into``"""
+    peak_reset = _reset_peak_rss()
+    queries_before = queries.total
+    started = time.perf_counter()
+    yield into
+    into['wall_s'] = time.perf_counter() - started
+    into['peak_rss_mb'] = round(_peak_rss_mb(), 1)
+    into['peak_rss_scope'] = 'step' if peak_reset else 'process'
+    into['children_peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+    into['queries'] = queries.total - queries_before
+
+
+def summarize(runs):
+    """Median of the timed runs, with the individual wall times kept"""
+    summary = dict(runs[-1])
+    summary['wall_s'] = round(statistics.median(run['wall_s'] for run in runs), 4)
+    summary['runs_s'] = [round(run['wall_s'], 4) for run in runs]
+    summary['peak_rss_mb'] = max(run['peak_rss_mb'] for run in runs)
+    return summary
+
+
+def environment():
+    """Machine and library versions, for comparing runs between commits"""
+    import django
+    import pyarrow
+
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, timeout=10,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'django': django.get_version(),
+        'pandas': pd.__version__,
+        'pyarrow': pyarrow.__version__,
+    }
+
+
+def _fetch(client, path):
+    response = client.get(path)
+    if response.status_code != 200:
+        raise RuntimeError(f'GET {path} returned {response.status_code}')
+    if response.streaming:
+        return b''.join(response.streaming_content)
+    return response.content
+
+
+def _new_upload(path):
+    from django.core.files import File
+
+    from .models import DataUpload
+
+    upload = DataUpload(title=os.path.basename(path))
+    with open(path, 'rb') as f:
+        upload.file.save(os.path.basename(path), File(f), save=False)
+    upload.save()
+    return upload
+
+
+def _finish_ingestion(upload, rows):
+    # What the ingestion job records once processing succeeds
+    from .models import DataUpload
+
+    DataUpload.objects.filter(pk=upload.pk).update(row_count=rows)
+    upload.set_status(DataUpload.STATUS_READY, progress=100)
+
+
+def bench_dataset(path, repeat=3, client=None):
+    """Time ingestion, the cold and warm preview and the index/list pages for one file"""
+    from django.core.cache import cache
+    from django.test import Client
+    from django.urls import reverse
+
+    from .caching import local_cache
+    from .processing import process_excel_file
+
+    client = client or Client()
+    steps = {name: [] for name in ('ingest', 'preview_cold', 'preview_warm', 'index', 'upload_list')}
+    for _ in range(repeat):
+        upload = _new_upload(path)
+        with measure({}) as step:
+            rows = process_excel_file(upload)
+        steps['ingest'].append(step)
+        _finish_ingestion(upload, rows)
+
+        preview_url = reverse('dashboard:data_preview', args=[upload.pk])
+        cache.clear()
+        local_cache.clear()
+        with measure({}) as step:
+            _fetch(client, preview_url)
+        steps['preview_cold'].append(step)
+        with measure({}) as step:
+            _fetch(client, preview_url)
+        steps['preview_warm'].append(step)
+        for name, url in (('index', reverse('dashboard:index')), ('upload_list', reverse('dashboard:upload_list'))):
+            with measure({}) as step:
+                _fetch(client, url)
+            steps[name].append(step)
+    return {name: summarize(runs) for name, runs in steps.items()}
+
+
+def latency_summary(latencies, failures=0):
+    """Percentiles of request latencies in seconds"""
+    values = np.asarray(latencies, dtype=np.float64)
+    summary = {'requests': len(values), 'failures': failures}
+    if len(values):
+        for name, q in (('p50_s', 50), ('p95_s', 95), ('max_s', 100)):
+            summary[name] = round(float(np.percentile(values, q)), 4)
+    return summary
+
+
+def _time_requests(client, urls, count, keep_going=lambda: True):
+    latencies, failures = [], 0
+    for i in range(count):
+        if not keep_going():
+            break
+        started = time.perf_counter()
+        try:
+            _fetch(client, urls[i % len(urls)])
+        except Exception:
+            failures += 1
+            continue
+        latencies.append(time.perf_counter() - started)
+    return latencies, failures
+
+
+def _write_loop(settings_module, database, media_root, path, writing, stop, results):
+    """Writer process of ``bench_concurrent``: ingest and materialize copies of ``path`` until stopped"""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    import django
+    from django.conf import settings
+
+    django.setup()
+    # The benchmark's throwaway database and media root, not the configured ones
+    settings.DATABASES['default']['NAME'] = database
+    settings.MEDIA_ROOT = media_root
+    settings.INGEST_ASYNC = False
+    from django.db import connection
+
+    from .jobs import lower_priority
+    from .materialize import materialize_upload
+    from .processing import process_excel_file
+
+    connection.settings_dict['NAME'] = database
+    lower_priority()
+    ingestions, errors = 0, []
+    try:
+        while not stop.is_set():
+            upload = _new_upload(path)
+            writing.set()
+            _finish_ingestion(upload, process_excel_file(upload))
+            materialize_upload(upload)
+            ingestions += 1
+    except Exception as e:
+        errors.append(str(e))
+    finally:
+        writing.set()
+        results.put({'ingestions': ingestions, 'errors': errors})
+
+
+def bench_concurrent(path, requests=100, client=None):
+    """Latency of the preview pages when idle and while another process ingests and materializes ``path``
+
+    The pages (warm preview, a grid window, the upload list and the
+    index) are read through the test client while a writer process,
+    at the priority of an ingestion worker, keeps ingesting fresh copies of the file
+    and loading them into SQLite tables. Reads that fail (for example
+    with a locked database) are counted, as are writer errors.
+    """
+    import multiprocessing
+
+    from django.conf import settings
+    from django.db import connection
+    from django.test import Client
+    from django.urls import reverse
+
+    from .processing import process_excel_file
+
+    client = client or Client()
+    upload = _new_upload(path)
+    _finish_ingestion(upload, process_excel_file(upload))
+    urls = [
+        reverse('dashboard:data_preview', args=[upload.pk]),
+        reverse('dashboard:data_rows', args=[upload.pk]) + '?offset=0&limit=100',
+        reverse('dashboard:upload_list'),
+        reverse('dashboard:index'),
+    ]
+    for url in urls:
+        _fetch(client, url)
+
+    idle = latency_summary(*_time_requests(client, urls, requests))
+
+    context = multiprocessing.get_context('spawn')
+    writing, stop, results = context.Event(), context.Event(), context.Queue()
+    writer = context.Process(
+        target=_write_loop,
+        args=(settings.SETTINGS_MODULE, str(connection.settings_dict['NAME']), str(settings.MEDIA_ROOT), path,
+              writing, stop, results),
+        name='bench-writer',
+    )
+    writer.start()
+    writing.wait()
+    try:
+        # Only requests made while the writer is still at work count
+        busy = latency_summary(*_time_requests(client, urls, requests, keep_going=writer.is_alive))
+    finally:
+        stop.set()
+        writer_result = results.get()
+        writer.join()
+    return {'idle': idle, 'ingesting': busy, 'writer': writer_result}
@@ -0,0 +1,109 @@
+"""
+Content-addressed storage of uploaded files.
+
+Every upload is hashed while it is received (``SHA256UploadHandler`` for
+form posts, the upload session for chunked uploads). Uploads with the same
+SHA-256 point at one ``StoredBlob``, so the file and everything derived
+from its path (sidecars, row indexes) is stored once. ``ref_count`` tracks
+the uploads using a blob; the files go when the last one is deleted,
+whichever way it is deleted (see ``release_deleted_upload``).
+"""
+import hashlib
+import os
+
+from django.core.files.uploadhandler import FileUploadHandler
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from .columnar import remove_sidecars
+from .models import DataUpload, StoredBlob
+
+
+class SHA256UploadHandler(FileUploadHandler):
+    """Hash each uploaded file as its chunks arrive
+
+    Must come before the handlers that store the file; it passes every
+    chunk on unchanged and never produces a file itself.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.digests = {}
+        self._digest = None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self._digest = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self._digest.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        self.digests[self.field_name] = self._digest.hexdigest()
+        return None
+
+
+def received_sha256(request, field_name):
+    """SHA-256 of an uploaded file, hashed on arrival when the handler is installed"""
+    for handler in request.upload_handlers:
+        if isinstance(handler, SHA256UploadHandler) and field_name in handler.digests:
+            return handler.digests[field_name]
+    digest = hashlib.sha256()
+    for chunk in request.FILES[field_name].chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def attach_blob(upload, sha256):
+    """Point ``upload`` at the stored copy of its content, storing it if new
+
+    Call before saving the upload. An uncommitted file (a form upload) is
+    only written to storage when no blob has this content yet; an already
+    written file (a finished chunked upload) is removed when it turns out
+    to be a duplicate.
+    """
+    incoming = upload.file
+    size = incoming.size
+    with transaction.atomic():
+        reused = StoredBlob.objects.filter(sha256=sha256, ref_count__gt=0).update(ref_count=F('ref_count') + 1)
+        if reused:
+            blob = StoredBlob.objects.get(sha256=sha256)
+            if incoming._committed and incoming.name != blob.file.name:
+                incoming.storage.delete(incoming.name)
+            upload.file = blob.file.name
+        else:
+            if not incoming._committed:
+                incoming.save(incoming.name, incoming.file, save=False)
+            blob = StoredBlob.objects.create(sha256=sha256, file=upload.file.name, size=size, ref_count=1)
+    upload.blob = blob
+    upload.content_hash = sha256
+    upload.file_size = size
+    return blob
+
+
+def release_file(upload):
+    """Drop an upload's claim on its file; delete the file once nobody uses it"""
+    if not upload.file:
+        return
+    if upload.blob_id is None:
+        # Uploads stored before deduplication own their file
+        remove_sidecars(upload)
+        upload.file.delete(save=False)
+        return
+
+    with transaction.atomic():
+        StoredBlob.objects.filter(pk=upload.blob_id).update(ref_count=F('ref_count') - 1)
+        deleted, _ = StoredBlob.objects.filter(pk=upload.blob_id, ref_count__lte=0).delete()
+    if deleted and os.path.exists(upload.file.path):
+        remove_sidecars(upload)
+        upload.file.storage.delete(upload.file.name)
+
+
+@receiver(post_delete, sender=DataUpload)
+def release_deleted_upload(sender, instance, **kwargs):
+    # Views, the admin and session expiry all delete through here; the
+    # file is only given up once the delete has committed
+    transaction.on_commit(lambda: release_file(instance))
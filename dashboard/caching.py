@@ -0,0 +1,243 @@
+"""
+Two-tier cache for computed previews.
+
+Tier 1 is a size-bounded in-process LRU. Tier 2 is Django's default cache,
+configured in settings as a file-based cache so every worker on the host
+shares it. A miss is computed by one worker at a time (a ``ComputeLock``),
+and entries are refreshed probabilistically shortly before
+they expire ("XFetch"), so hot keys do not all expire together.
+
+Keys should be versioned with ``versioned_key`` so that an upload whose
+content changes never reads a stale entry.
+"""
+import hashlib
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .metrics import record_cache
+
+# How long preview pages (profiles, rendered fragments) stay cached
+PREVIEW_CACHE_TIMEOUT = 60 * 10
+# How long a worker may hold the compute lock for a key
+LOCK_TIMEOUT = 60 * 5
+# How long other workers wait for the lock holder before computing themselves
+LOCK_WAIT = 30
+# Scales how early entries are refreshed; 1.0 is the XFetch default
+REFRESH_BETA = 1.0
+
+
+class LocalLRU:
+    """Thread-safe LRU of ``key -> (value, compute_seconds, expires_at)``"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+local_cache = LocalLRU(getattr(settings, 'PREVIEW_CACHE_LOCAL_ENTRIES', 128))
+
+
+def versioned_key(prefix, upload, *parts):
+    """Cache key tied to the upload's content hash
+
+    Uploads with identical content share entries; an upload that has not
+    been hashed yet gets keys of its own.
+    """
+    version = upload.content_hash or f'upload{upload.pk}'
+    return '_'.join([prefix, version] + [str(part) for part in parts])
+
+
+def _lock_file(lock_key):
+    """Lock file of ``lock_key`` when the shared cache is a directory, else None"""
+    directory = getattr(cache, '_dir', None)
+    if fcntl is None or directory is None:
+        return None
+    directory = os.path.join(directory, 'locks')
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f'{hashlib.sha1(lock_key.encode()).hexdigest()}.lock')
+
+
+class ComputeLock:
+    """Lock on computing one key, shared by every worker on the host
+
+    With the file-based cache it is an ``flock`` on a file of its own under
+    the cache directory: taken atomically, and dropped by the kernel if the
+    holder dies. ``FileBasedCache.add`` is a read followed by a write, so
+    two workers could both win it. The holder deletes the file before it
+    lets go, so a worker that locked a file no longer at that path tries
+    again. Other backends use ``cache.add`` of a
+    random token, and the lock is only deleted while it still holds that
+    token, never after it expired and another worker took it.
+    """
+
+    def __init__(self, key):
+        self.key = f'{key}:lock'
+        self._token = None
+        self._fd = None
+        self._path = None
+
+    def acquire(self):
+        """Take the lock without waiting; False if another worker holds it"""
+        path = _lock_file(self.key)
+        if path is None:
+            token = uuid.uuid4().hex
+            if not cache.add(self.key, token, LOCK_TIMEOUT):
+                return False
+            self._token = token
+            return True
+        while True:
+            fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return False
+            try:
+                current = os.stat(path)
+            except FileNotFoundError:
+                current = None
+            if current is not None and os.path.samestat(current, os.fstat(fd)):
+                self._fd, self._path = fd, path
+                return True
+            # The previous holder deleted the file after we opened it
+            os.close(fd)
+
+    def release(self):
+        if self._fd is not None:
+            os.remove(self._path)
+            os.close(self._fd)  # closing drops the flock
+            self._fd = self._path = None
+        elif self._token is not None:
+            if cache.get(self.key) == self._token:
+                cache.delete(self.key)
+            self._token = None
+
+
+def _fresh(entry, now):
+    """False once the entry expired or was picked for early refresh"""
+    if entry is None:
+        return False
+    _, compute_seconds, expires_at = entry
+    # XFetch: the closer to expiry and the slower to compute, the likelier a refresh
+    return now - compute_seconds * REFRESH_BETA * math.log(1.0 - random.random()) < expires_at
+
+
+def _store(key, value, compute_seconds, timeout):
+    entry = (value, compute_seconds, time.time() + timeout)
+    cache.set(key, entry, timeout)
+    local_cache.set(key, entry)
+
+
+def _compute_locked(key, compute, timeout, lock):
+    try:
+        started = time.time()
+        value = compute()
+        _store(key, value, time.time() - started, timeout)
+        return value
+    finally:
+        lock.release()
+
+
+def get_or_compute(key, compute, timeout):
+    """Return the cached value for ``key``, computing it at most once across workers"""
+    now = time.time()
+    entry = local_cache.get(key)
+    if _fresh(entry, now):
+        record_cache(key, 'hit_local')
+        return entry[0]
+
+    entry = cache.get(key)
+    if _fresh(entry, now):
+        record_cache(key, 'hit_shared')
+        local_cache.set(key, entry)
+        return entry[0]
+
+    lock = ComputeLock(key)
+    if lock.acquire():
+        record_cache(key, 'miss' if entry is None else 'refresh')
+        return _compute_locked(key, compute, timeout, lock)
+
+    if entry is not None:
+        # Someone else is refreshing; the current value is still valid
+        record_cache(key, 'hit_stale')
+        local_cache.set(key, entry)
+        return entry[0]
+
+    # Cold key being built elsewhere: wait for it instead of piling on
+    delay = 0.05
+    deadline = now + LOCK_WAIT
+    while time.time() < deadline:
+        time.sleep(delay)
+        delay = min(delay * 2, 1.0)
+        entry = cache.get(key)
+        if entry is not None:
+            record_cache(key, 'hit_wait')
+            local_cache.set(key, entry)
+            return entry[0]
+        if lock.acquire():
+            entry = cache.get(key)
+            if entry is not None:
+                # Stored just before the holder let go
+                lock.release()
+                record_cache(key, 'hit_wait')
+                local_cache.set(key, entry)
+                return entry[0]
+            # The holder gave up without storing a value; take over
+            record_cache(key, 'miss')
+            return _compute_locked(key, compute, timeout, lock)
+
+    record_cache(key, 'miss')
+    started = time.time()
+    value = compute()
+    _store(key, value, time.time() - started, timeout)
+    return value
+
+
+def set_value(key, value, timeout):
+    """Replace a cached value in both tiers"""
+    _store(key, value, 0.0, timeout)
+
+
+def invalidate(key):
+    cache.delete(key)
+    local_cache.delete(key)
@@ -0,0 +1,277 @@
+"""
+Chunked, resumable uploads.
+
+A session is started with the file's name and size, which creates the
+``DataUpload`` and an empty file at its final storage path. Chunks are then
+written straight into that file at the session's current offset, so a large
+upload is never spooled to a temp file and copied. A client that loses its
+connection asks for the session's offset and carries on from there.
+
+Every response carries the SHA-256 of the bytes received so far. The hash
+object is kept in memory between chunks and rebuilt from disk when a chunk
+lands on a different worker.
+
+Sessions left unfinished for ``CHUNKED_UPLOAD_EXPIRY`` seconds are deleted
+with their upload and partial file, when the next session starts or by
+``manage.py expire_upload_sessions``.
+"""
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import DataUpload, UploadSession
+
+# Block size for reading request bodies and re-hashing files
+COPY_BLOCK_BYTES = 1024 * 1024
+# In-progress hash states kept per process
+MAX_CACHED_HASHERS = 64
+# How far back to look for a complete CSV record when profiling a prefix
+PREFIX_BACKOFF_LINES = 3
+
+
+class ChunkError(ValueError):
+    """A chunk that cannot be applied; ``offset`` is the session's current offset"""
+
+    def __init__(self, message, offset=None):
+        super().__init__(message)
+        self.offset = offset
+
+
+_hashers = OrderedDict()
+_hashers_lock = threading.Lock()
+_session_locks = {}
+
+
+def _session_lock(session_id):
+    with _hashers_lock:
+        return _session_locks.setdefault(session_id, threading.Lock())
+
+
+def _cached_hasher(session):
+    """SHA-256 state for the received prefix, from memory or re-read from disk"""
+    with _hashers_lock:
+        cached = _hashers.get(session.pk)
+    if cached is not None and cached[0] == session.received:
+        return cached[1].copy()
+
+    hasher = hashlib.sha256()
+    remaining = session.received
+    with open(session.upload.file.path, 'rb') as f:
+        while remaining:
+            block = f.read(min(COPY_BLOCK_BYTES, remaining))
+            if not block:
+                break
+            hasher.update(block)
+            remaining -= len(block)
+    return hasher
+
+
+def _remember_hasher(session_id, offset, hasher):
+    with _hashers_lock:
+        _hashers[session_id] = (offset, hasher)
+        _hashers.move_to_end(session_id)
+        while len(_hashers) > MAX_CACHED_HASHERS:
+            _hashers.popitem(last=False)
+
+
+def _forget_session(session_id):
+    with _hashers_lock:
+        _hashers.pop(session_id, None)
+        _session_locks.pop(session_id, None)
+
+
+def expire_sessions(now=None):
+    """Delete unfinished sessions past the expiry, with their uploads and partial files
+
+    A session whose file was written to within the expiry is still in use
+    and kept. Returns the number of sessions deleted.
+    """
+    cutoff = (now or timezone.now()) - timedelta(seconds=settings.CHUNKED_UPLOAD_EXPIRY)
+    stale = UploadSession.objects.filter(completed_at__isnull=True, created_at__lt=cutoff).select_related('upload')
+    expired = 0
+    for session in stale:
+        upload = session.upload
+        path = upload.file.path
+        if os.path.exists(path) and os.path.getmtime(path) >= cutoff.timestamp():
+            continue
+        with transaction.atomic():
+            # Skip a session that received a chunk or finished since it was read
+            if not UploadSession.objects.filter(
+                pk=session.pk, completed_at__isnull=True, received=session.received,
+            ).exists():
+                continue
+            # The partial file goes with it (see blobs.release_deleted_upload)
+            upload.delete()
+        _forget_session(session.pk)
+        expired += 1
+    return expired
+
+
+def start_session(title, description, filename, total_size):
+    """Create the upload, its empty file and the session that fills it"""
+    expire_sessions()
+    upload = DataUpload(title=title, description=description)
+    storage = upload.file.storage
+    name = storage.get_available_name(upload.file.field.generate_filename(upload, filename))
+    path = storage.path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+
+    upload.file.name = name
+    upload.file_extension = upload.get_extension().lstrip('.')[:10]
+    upload.file_size = total_size
+    upload.status_message = 'Receiving file'
+    # Counted in the upload totals once complete, not now
+    upload.receiving_chunks = True
+    with transaction.atomic():
+        upload.save()
+        return UploadSession.objects.create(upload=upload, total_size=total_size)
+
+
+def append_chunk(session, offset, stream, length):
+    """Write ``length`` bytes from ``stream`` at ``offset`` and advance the session
+
+    A connection that drops mid-chunk keeps the bytes that arrived, so the
+    client resumes from the returned session's ``received``.
+    """
+    if session.is_complete():
+        raise ChunkError('Upload is already complete', session.received)
+    if length > settings.CHUNKED_UPLOAD_MAX_CHUNK:
+        raise ChunkError(f'Chunks may be at most {settings.CHUNKED_UPLOAD_MAX_CHUNK} bytes', session.received)
+
+    with _session_lock(session.pk):
+        session.refresh_from_db(fields=['received', 'sha256', 'completed_at'])
+        if offset != session.received:
+            raise ChunkError(f'Expected offset {session.received}, got {offset}', session.received)
+        if offset + length > session.total_size:
+            raise ChunkError('Chunk runs past the declared file size', session.received)
+
+        hasher = _cached_hasher(session)
+        written = 0
+        with open(session.upload.file.path, 'r+b') as f:
+            f.seek(offset)
+            while written < length:
+                block = stream.read(min(COPY_BLOCK_BYTES, length - written))
+                if not block:
+                    break
+                f.write(block)
+                hasher.update(block)
+                written += len(block)
+            # Drop bytes left over from an earlier, abandoned attempt
+            f.truncate()
+
+        received = offset + written
+        updated = UploadSession.objects.filter(pk=session.pk, received=offset).update(
+            received=received, sha256=hasher.hexdigest(),
+        )
+        if not updated:
+            session.refresh_from_db(fields=['received'])
+            raise ChunkError('Another request wrote to this upload concurrently', session.received)
+        session.received = received
+        session.sha256 = hasher.hexdigest()
+        _remember_hasher(session.pk, received, hasher)
+
+    upload = session.upload
+    if received == session.total_size:
+        _complete(session)
+    else:
+        upload.set_status(
+            DataUpload.STATUS_QUEUED, progress=0,
+            message=f'Receiving file ({100 * received // session.total_size}%)',
+        )
+    return session
+
+
+def _complete(session):
+    from .blobs import attach_blob
+    from .jobs import enqueue_ingestion
+    from .summary import add_to_rollup
+
+    upload = session.upload
+    session.completed_at = timezone.now()
+    with transaction.atomic():
+        UploadSession.objects.filter(pk=session.pk).update(completed_at=session.completed_at)
+        # A duplicate's file is dropped in favour of the stored copy
+        attach_blob(upload, session.sha256)
+        upload.save(update_fields=['file', 'blob', 'content_hash', 'file_size'])
+        add_to_rollup(upload)
+        enqueue_ingestion(upload)
+    _forget_session(session.pk)
+
+
+class _PrefixReader(io.RawIOBase):
+    """Read-only view of the first ``end`` bytes of a file"""
+
+    def __init__(self, path, end):
+        self._file = open(path, 'rb')
+        self._remaining = end
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self._remaining)
+        if size <= 0:
+            return 0
+        data = self._file.read(size)
+        buffer[:len(data)] = data
+        self._remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def _line_ends(path, received, count):
+    """Offsets just past the last ``count`` newlines before ``received``"""
+    ends = []
+    position = received
+    with open(path, 'rb') as f:
+        while position > 0 and len(ends) < count:
+            start = max(0, position - COPY_BLOCK_BYTES)
+            f.seek(start)
+            block = f.read(position - start)
+            index = len(block)
+            while len(ends) < count:
+                index = block.rfind(b'\n', 0, index)
+                if index < 0:
+                    break
+                ends.append(start + index + 1)
+            position = start
+    return ends
+
+
+def profile_received(session):
+    """Profile the complete CSV records received so far
+
+    The prefix is cut at a newline; if that newline sits inside a quoted
+    field, earlier newlines are tried.
+    """
+    import pandas as pd
+    from .profiling import approximate_profiles, profile_chunks, to_json_safe
+    from .readers import iter_csv_chunks
+
+    upload = session.upload
+    if upload.get_extension() != '.csv':
+        raise ChunkError('Only CSV uploads can be profiled before they finish', session.received)
+
+    path = upload.file.path
+    ends = [session.received] if session.is_complete() else _line_ends(path, session.received, PREFIX_BACKOFF_LINES)
+    for end in ends:
+        reader = io.BufferedReader(_PrefixReader(path, end))
+        try:
+            profile = profile_chunks(iter_csv_chunks(reader), approximate=approximate_profiles())
+        except (pd.errors.ParserError, pd.errors.EmptyDataError):
+            continue
+        finally:
+            reader.close()
+        return end, to_json_safe(profile)
+    raise ChunkError('Not enough data received to profile yet', session.received)
@@ -0,0 +1,436 @@
+"""
+Columnar Parquet sidecar for every upload.
+
+Spreadsheets are parsed once during ingestion and every sheet is written
+to a zstd-compressed Parquet file stored next to the original
+(``<upload>.parquet`` for the first sheet, ``<upload>.<n>.parquet`` for
+the others). Later reads use that file with column projection
+and memory-mapping. Each sidecar records the SHA-256 of its source and is
+rebuilt whenever the source content changes. Rows appended to a CSV
+upload are added to its sidecar without parsing the rest again (see
+appending.py). Rebuilds and appends of one upload hold ``upload_lock``,
+so a reader never rebuilds a sidecar an append is replacing.
+"""
+import glob
+import hashlib
+import logging
+import os
+import re
+import shutil
+import threading
+import uuid
+from contextlib import contextmanager
+from functools import partial
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from django.conf import settings
+
+from .schema import TypeMismatch
+
+logger = logging.getLogger(__name__)
+
+SIDECAR_SUFFIX = '.parquet'
+SIDECAR_COMPRESSION = 'zstd'
+ROW_GROUP_ROWS = 65536
+BATCH_ROWS = 65536
+
+# Schema metadata keys describing the source file
+META_HASH = b'source_sha256'
+META_SIZE = b'source_size'
+META_MTIME = b'source_mtime_ns'
+META_SHEET = b'sheet_name'
+
+# A sidecar is rewritten at most this many times while types settle
+MAX_SCHEMA_PASSES = 3
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Integer widths tried, narrowest first, when reading sidecars back
+INT_WIDTHS = (8, 16, 32)
+
+
+class SchemaDrift(Exception):
+    """A later chunk cannot be stored with the schema already written"""
+
+    def __init__(self, schema):
+        super().__init__('Column types changed part-way through the file')
+        self.schema = schema
+
+
+def file_sha256(path):
+    """SHA-256 of a file, read in fixed-size blocks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def sidecar_path(upload, position=0):
+    """Sidecar of one sheet: ``<file>.parquet`` for the first, ``<file>.<n>.parquet`` after"""
+    if position:
+        return f'{upload.file.path}.{position}{SIDECAR_SUFFIX}'
+    return upload.file.path + SIDECAR_SUFFIX
+
+
+def _extra_sheet_sidecars(source):
+    """Existing ``<file>.<n>.parquet`` sidecars of a source file"""
+    pattern = re.compile(r'\.\d+' + re.escape(SIDECAR_SUFFIX))
+    return [
+        path for path in glob.glob(glob.escape(source) + '.*' + SIDECAR_SUFFIX)
+        if pattern.fullmatch(path[len(source):])
+    ]
+
+
+def sidecar_index_dir(path):
+    """Directory for derived row indexes of a sidecar (see grid.py)"""
+    return path + '.idx'
+
+
+def _source_metadata(path, content_hash):
+    stat = os.stat(path)
+    return {
+        META_HASH: content_hash.encode(),
+        META_SIZE: str(stat.st_size).encode(),
+        META_MTIME: str(stat.st_mtime_ns).encode(),
+    }
+
+
+def _arrow_safe(df):
+    """Stringify object columns whose values mix Python types or overflow int64"""
+    for column in df.columns:
+        if df[column].dtype == object:
+            kind = pd.api.types.infer_dtype(df[column], skipna=True)
+            # Integers left as objects by pandas are too long for int64
+            if kind == 'integer' or (kind.startswith('mixed') and kind != 'mixed-integer-float'):
+                df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+    return df
+
+
+def _chunk_table(df):
+    """A DataFrame chunk as an Arrow table, with categorical columns stored as their values
+
+    Category dictionaries differ from chunk to chunk, and sidecars keep
+    plain column types.
+    """
+    table = pa.Table.from_pandas(_arrow_safe(df), preserve_index=False)
+    for index, field in enumerate(table.schema):
+        if pa.types.is_dictionary(field.type):
+            value_type = field.type.value_type
+            value_type = pa.large_string() if pa.types.is_null(value_type) else value_type
+            table = table.set_column(index, pa.field(field.name, value_type), table.column(index).cast(value_type))
+    return table
+
+
+def _unify(schema, other):
+    """Widen ``schema`` so chunks typed as ``other`` also fit"""
+    try:
+        return pa.unify_schemas([schema, other], promote_options='permissive')
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        fields = []
+        for field in schema:
+            other_type = other.field(field.name).type
+            if field.type == other_type:
+                fields.append(field)
+            else:
+                fields.append(pa.field(field.name, pa.string()))
+        return pa.schema(fields)
+
+
+def _write_sidecar(chunks, target, metadata, schema=None):
+    writer = None
+    try:
+        for chunk in chunks:
+            table = _chunk_table(chunk)
+            if schema is None:
+                schema = table.schema.remove_metadata()
+            if not table.schema.remove_metadata().equals(schema):
+                try:
+                    table = table.cast(schema)
+                except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+                    raise SchemaDrift(_unify(schema, table.schema.remove_metadata()))
+            if writer is None:
+                writer = pq.ParquetWriter(
+                    target, schema.with_metadata(metadata), compression=SIDECAR_COMPRESSION
+                )
+            writer.write_table(table.replace_schema_metadata(metadata), row_group_size=ROW_GROUP_ROWS)
+        if writer is None:
+            # Empty file: still record the source so it is not rebuilt
+            pq.write_table(pa.table({}).replace_schema_metadata(metadata), target)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def _build_sheet(chunks, target, metadata):
+    """Write one sheet's sidecar, widening the schema if types drift"""
+    # Uploads sharing a blob may build the same sidecar at once
+    temp = f'{target}.{uuid.uuid4().hex}.tmp'
+    schema = None
+    passes = 0
+    try:
+        while True:
+            try:
+                _write_sidecar(chunks(), temp, metadata, schema)
+                break
+            except SchemaDrift as drift:
+                passes += 1
+                if passes >= MAX_SCHEMA_PASSES:
+                    raise ValueError('Could not settle on column types for the columnar cache')
+                schema = drift.schema
+            except TypeMismatch as e:
+                # The sample missed a value that does not fit: let pandas infer types instead
+                logger.info(f"{e}; rebuilding {os.path.basename(target)} without them")
+                chunks = partial(chunks, read_options=None)
+                schema = None
+        os.replace(temp, target)
+        _drop_derived(target)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
+def append_sidecar(source, target, chunks, metadata):
+    """Write ``target`` as the rows of the sidecar ``source`` followed by ``chunks``
+
+    Existing row groups are copied as they are, so the appended rows start
+    a row group of their own. Returns the number of row groups copied.
+    Raises ``SchemaDrift`` when the new rows do not fit the stored types.
+    """
+    existing = open_sidecar(source)
+    schema = existing.schema_arrow.remove_metadata()
+    temp = f'{target}.{uuid.uuid4().hex}.tmp'
+    try:
+        with pq.ParquetWriter(temp, schema.with_metadata(metadata), compression=SIDECAR_COMPRESSION) as writer:
+            for group in range(existing.num_row_groups):
+                writer.write_table(
+                    existing.read_row_group(group).replace_schema_metadata(metadata), row_group_size=ROW_GROUP_ROWS,
+                )
+            for chunk in chunks:
+                table = _chunk_table(chunk)
+                if table.schema.names != schema.names:
+                    raise SchemaDrift(table.schema.remove_metadata())
+                try:
+                    table = table.cast(schema)
+                except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+                    raise SchemaDrift(_unify(schema, table.schema.remove_metadata()))
+                writer.write_table(table.replace_schema_metadata(metadata), row_group_size=ROW_GROUP_ROWS)
+        os.replace(temp, target)
+        _drop_derived(target)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+    return existing.num_row_groups
+
+
+def build_sidecars(upload, content_hash=None):
+    """Convert every sheet of an upload into a Parquet sidecar
+
+    The workbook is opened once and its sheets are streamed one after the
+    other. Returns ``[(sheet_name, path), ...]`` in workbook order.
+    """
+    from .readers import open_source_sheets
+
+    source = upload.file.path
+    content_hash = content_hash or file_sha256(source)
+    built = []
+    with open_source_sheets(upload) as sheets:
+        for position, (name, chunks) in enumerate(sheets):
+            metadata = _source_metadata(source, content_hash)
+            metadata[META_SHEET] = str(name).encode()
+            target = sidecar_path(upload, position)
+            _build_sheet(chunks, target, metadata)
+            built.append((name, target))
+
+    # Sheets removed from the workbook leave stale sidecars behind
+    for path in _extra_sheet_sidecars(source):
+        if path not in {target for _, target in built}:
+            _remove_path(path)
+    return built
+
+
+def sheet_position(upload, sheet):
+    """Index of ``sheet`` in the upload's workbook (0 for the first sheet)"""
+    if sheet is None:
+        return 0
+    if sheet in upload.sheet_names:
+        return upload.sheet_names.index(sheet)
+    return None
+
+
+def sidecar_is_fresh(upload, path):
+    """True if the sidecar exists and was built from the current source"""
+    if not os.path.exists(path):
+        return False
+    metadata = pq.read_schema(path).metadata or {}
+    stat = os.stat(upload.file.path)
+    if (metadata.get(META_SIZE) == str(stat.st_size).encode()
+            and metadata.get(META_MTIME) == str(stat.st_mtime_ns).encode()):
+        return True
+    # The file was touched: only its content decides whether to rebuild
+    return metadata.get(META_HASH) == file_sha256(upload.file.path).encode()
+
+
+_held_locks = threading.local()
+
+
+@contextmanager
+def upload_lock(upload):
+    """Hold the upload's sidecar lock, shared by every worker on the host
+
+    An ``flock`` on ``MEDIA_ROOT/locks/upload-<pk>.lock`` (Unix only).
+    Reentrant within a thread, so an append may rebuild while holding it.
+    """
+    held = _held_locks.__dict__.setdefault('uploads', set())
+    if upload.pk in held or fcntl is None:
+        yield
+        return
+    directory = os.path.join(settings.MEDIA_ROOT, 'locks')
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, f'upload-{upload.pk}.lock'), 'ab') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        held.add(upload.pk)
+        try:
+            yield
+        finally:
+            held.discard(upload.pk)
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def ensure_sidecars(upload):
+    """Rebuild all sidecars of an upload and record its hash and sheets"""
+    with upload_lock(upload):
+        logger.info(f"Building columnar cache for upload {upload.pk}")
+        content_hash = file_sha256(upload.file.path)
+        built = build_sidecars(upload, content_hash=content_hash)
+        upload.content_hash = content_hash
+        upload.sheet_names = [str(name) for name, _ in built]
+        type(upload).objects.filter(pk=upload.pk).update(
+            content_hash=content_hash, sheet_names=upload.sheet_names
+        )
+    return built
+
+
+def ensure_sidecar(upload, sheet=None):
+    """Return a fresh sidecar path for one sheet, rebuilding if the source changed"""
+    position = sheet_position(upload, sheet)
+    if position is not None:
+        path = sidecar_path(upload, position)
+        if sidecar_is_fresh(upload, path):
+            return path
+
+    with upload_lock(upload):
+        # An append may have finished while we waited: it moves the file and hash
+        upload.refresh_from_db(fields=['file', 'blob', 'content_hash', 'sheet_names'])
+        position = sheet_position(upload, sheet)
+        if position is not None:
+            path = sidecar_path(upload, position)
+            if sidecar_is_fresh(upload, path):
+                return path
+        built = ensure_sidecars(upload)
+    position = sheet_position(upload, sheet)
+    if position is None or position >= len(built):
+        raise ValueError(f"Unknown sheet '{sheet}'")
+    return built[position][1]
+
+
+def open_sidecar(path):
+    return pq.ParquetFile(path, memory_map=True)
+
+
+def sidecar_version(path):
+    """Content hash the sidecar was built from"""
+    metadata = pq.read_schema(path).metadata or {}
+    return metadata.get(META_HASH, b'').decode()
+
+
+def _column_range(metadata, index):
+    """``(min, max, null_count)`` of one column over all row groups (None if unknown)"""
+    low = high = None
+    nulls = 0
+    for group in range(metadata.num_row_groups):
+        statistics = metadata.row_group(group).column(index).statistics
+        if statistics is None or not statistics.has_null_count:
+            return None
+        nulls += statistics.null_count
+        if statistics.has_min_max:
+            low = statistics.min if low is None else min(low, statistics.min)
+            high = statistics.max if high is None else max(high, statistics.max)
+    return low, high, nulls
+
+
+def compact_dtypes(parquet):
+    """Smallest pandas dtype for the integer and boolean columns of a sidecar
+
+    Integers are narrowed to the smallest width that holds the column's
+    min and max, and columns with nulls get nullable dtypes instead of
+    float64 or object. Floats are left alone so no precision is lost.
+    """
+    dtypes = {}
+    for index, field in enumerate(parquet.schema_arrow):
+        if not (pa.types.is_integer(field.type) or pa.types.is_boolean(field.type)):
+            continue
+        column_range = _column_range(parquet.metadata, index)
+        if column_range is None:
+            continue
+        low, high, nulls = column_range
+        if pa.types.is_boolean(field.type):
+            if nulls:
+                dtypes[field.name] = 'boolean'
+            continue
+        for width in INT_WIDTHS:
+            info = np.iinfo(f'int{width}')
+            if low is None or (info.min <= low and high <= info.max):
+                dtypes[field.name] = f'Int{width}' if nulls else f'int{width}'
+                break
+        else:
+            if nulls:
+                dtypes[field.name] = 'Int64'
+    return dtypes
+
+
+def iter_sidecar_chunks(path, columns=None, chunksize=None, row_groups=None):
+    """Yield DataFrames from a sidecar, reading only the requested columns (and row groups)"""
+    parquet = open_sidecar(path)
+    if not parquet.metadata.num_rows:
+        # Keep the columns of header-only sheets visible
+        empty = parquet.schema_arrow.empty_table()
+        yield (empty.select(columns) if columns is not None else empty).to_pandas()
+        return
+    dtypes = compact_dtypes(parquet)
+    if columns is not None:
+        dtypes = {column: dtype for column, dtype in dtypes.items() if column in columns}
+    for batch in parquet.iter_batches(batch_size=chunksize or BATCH_ROWS, columns=columns, row_groups=row_groups):
+        df = batch.to_pandas()
+        yield df.astype(dtypes) if dtypes else df
+
+
+def _drop_derived(path):
+    """Remove what was derived from a sidecar's previous content (row indexes, profile state)"""
+    from .profiling import profiler_state_path
+
+    shutil.rmtree(sidecar_index_dir(path), ignore_errors=True)
+    state = profiler_state_path(path)
+    if os.path.exists(state):
+        os.remove(state)
+
+
+def _remove_path(path):
+    if os.path.exists(path):
+        os.remove(path)
+    _drop_derived(path)
+
+
+def remove_sidecars(upload):
+    """Delete the sidecars (and their row indexes) of every sheet"""
+    source = upload.file.path
+    for path in [source + SIDECAR_SUFFIX] + _extra_sheet_sidecars(source):
+        _remove_path(path)
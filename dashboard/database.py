@@ -0,0 +1,83 @@
+"""
+SQLite connection tuning and retried write transactions.
+
+Every new connection gets the pragmas of ``settings.SQLITE_PRAGMAS``
+(WAL journal, ``synchronous=NORMAL``, memory-mapped reads, a larger page
+cache and a busy timeout). In WAL mode readers never wait for a writer,
+so the preview pages keep their latency while an upload is ingested.
+Connections are kept open between requests (``CONN_MAX_AGE``), which
+pays for the pragmas once per connection rather than once per request.
+
+Writers still take turns. Ingestion writes are short transactions wrapped
+in ``retry_write``; one that finds the database locked beyond the
+busy timeout is retried a bounded number of times with backoff.
+"""
+import logging
+import random
+import sqlite3
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import OperationalError, connections
+
+logger = logging.getLogger(__name__)
+
+WRITE_BACKOFF_S = 0.05
+
+
+def sqlite_pragmas():
+    return settings.SQLITE_PRAGMAS
+
+
+def apply_pragmas(conn, pragmas=None):
+    """Run ``PRAGMA name = value`` for each pragma on a DB-API connection or cursor"""
+    for name, value in (sqlite_pragmas() if pragmas is None else pragmas).items():
+        conn.execute(f'PRAGMA {name} = {value}')
+
+
+def configure_connection(sender, connection, **kwargs):
+    """``connection_created`` receiver: tune every new SQLite connection"""
+    if connection.vendor != 'sqlite':
+        return
+    # The raw connection, so the pragmas are not counted as queries of the request
+    apply_pragmas(connection.connection)
+
+
+def is_locked(error):
+    message = str(error).lower()
+    return 'locked' in message or 'busy' in message
+
+
+def retry_locked(func, attempts=None, backoff=None):
+    """Call ``func()``, again after a growing pause each time it fails with a locked database"""
+    attempts = attempts or settings.DATABASE_WRITE_ATTEMPTS
+    backoff = WRITE_BACKOFF_S if backoff is None else backoff
+    for attempt in range(1, attempts + 1):
+        try:
+            return func()
+        except (OperationalError, sqlite3.OperationalError) as e:
+            if attempt == attempts or not is_locked(e):
+                raise
+            pause = backoff * 2 ** (attempt - 1) * (1 + random.random())
+            logger.warning(f'Database locked, retrying write in {pause:.2f}s (attempt {attempt} of {attempts})')
+            time.sleep(pause)
+
+
+def retry_write(func=None, using='default'):
+    """Retry the decorated function while it fails with a locked database
+
+    The function must make its writes in one transaction, so a failed
+    attempt leaves nothing behind. Inside an enclosing transaction it runs
+    once, since only the outermost transaction can be retried as a whole.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if connections[using].in_atomic_block:
+                return func(*args, **kwargs)
+            return retry_locked(lambda: func(*args, **kwargs))
+
+        return wrapper
+
+    return decorator(func) if func is not None else decorator
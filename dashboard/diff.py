@@ -0,0 +1,277 @@
+"""
+Row-level diff between two uploads.
+
+Rows are matched on one or more key columns. Both sheets are streamed
+from their sidecars in record batches, and every row is routed to one of
+``partitions`` buckets by the hash of its key, so matching rows of the two
+uploads always land in the same bucket. Large sheets spill their buckets
+to temporary Parquet files; one bucket of each side is then loaded at a
+time and compared, so memory is bounded by the bucket size rather than the
+size of the files. The result counts added, removed and changed rows,
+changes per column, and keeps a sample of each for display.
+"""
+import hashlib
+import json
+import math
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from .caching import get_or_compute, versioned_key
+from .columnar import BATCH_ROWS, ensure_sidecar, sheet_position
+from .grid import GridError
+from .profiling import to_json_safe
+from .query import scan, sheet_columns
+
+# Rows per side in one bucket; sheets up to this size are diffed in memory
+DIFF_PARTITION_ROWS = 200000
+# Added, removed and changed rows kept for display
+DIFF_SAMPLE_ROWS = 50
+# Diffs are keyed by content, so they only go stale by expiring
+DIFF_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+class DiffError(GridError):
+    """Invalid diff parameters"""
+
+
+def _row_count(upload, sheet):
+    try:
+        return ds.dataset(ensure_sidecar(upload, sheet), format='parquet').count_rows()
+    except Exception:
+        return None
+
+
+def _key_types(schema_a, schema_b, key):
+    """Common type per key column; mismatched types are compared as text"""
+    types = {}
+    for column in key:
+        type_a, type_b = schema_a.field(column).type, schema_b.field(column).type
+        types[column] = type_a if type_a == type_b else pa.string()
+    return types
+
+
+def _normalize(table, key_types):
+    for column, kind in key_types.items():
+        index = table.schema.get_field_index(column)
+        if table.schema.field(index).type != kind:
+            table = table.set_column(index, column, pc.cast(table.column(index), kind))
+    return table
+
+
+# Stands in for a null key value when hashing; not a string pa.cast produces
+NULL_KEY = '\x00null'
+
+
+def _partition_ids(table, key, partitions):
+    """Bucket of each row, from its key values as text
+
+    Keys are hashed as strings rather than through ``to_pandas``, whose
+    dtype depends on the batch (an int column with a null becomes float),
+    so equal keys land in the same bucket whatever batch they are in.
+    """
+    text = {
+        column: pc.fill_null(pc.cast(table.column(column), pa.string()), NULL_KEY).to_numpy(zero_copy_only=False)
+        for column in key
+    }
+    hashes = pd.util.hash_pandas_object(pd.DataFrame(text, dtype=object), index=False).to_numpy()
+    return hashes % np.uint64(partitions)
+
+
+def _spill(batches, key, key_types, partitions, directory, side):
+    """Route every row to its bucket; returns one table or Parquet path per bucket"""
+    if partitions == 1:
+        tables = [_normalize(table, key_types) for table in batches]
+        return [pa.concat_tables(tables) if tables else None]
+
+    writers = {}
+    try:
+        for table in batches:
+            table = _normalize(table, key_types)
+            ids = _partition_ids(table, key, partitions)
+            for bucket in np.unique(ids):
+                part = table.filter(pa.array(ids == bucket))
+                writer = writers.get(bucket)
+                if writer is None:
+                    path = os.path.join(directory, f'{side}-{bucket}.parquet')
+                    writer = writers[bucket] = pq.ParquetWriter(path, part.schema)
+                writer.write_table(part.cast(writer.schema))
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return [
+        os.path.join(directory, f'{side}-{bucket}.parquet') if bucket in writers else None
+        for bucket in range(partitions)
+    ]
+
+
+def _load(source, schema):
+    if source is None:
+        return schema.empty_table().to_pandas()
+    if isinstance(source, str):
+        source = pq.read_table(source)
+    return source.to_pandas()
+
+
+def _changed(a, b):
+    """Boolean mask of the positions where two aligned columns differ"""
+    if a.dtype != b.dtype and not (pd.api.types.is_numeric_dtype(a.dtype) and pd.api.types.is_numeric_dtype(b.dtype)):
+        a, b = a.astype(str).where(a.notna()), b.astype(str).where(b.notna())
+    equal = (a == b).astype('boolean').fillna(False).to_numpy(dtype=bool)
+    both_null = (a.isna() & b.isna()).to_numpy(dtype=bool)
+    return ~(equal | both_null)
+
+
+def _key_dict(key, value):
+    return dict(zip(key, value if isinstance(value, tuple) else (value,)))
+
+
+class DiffResult:
+    """Running totals and samples, merged bucket by bucket"""
+
+    def __init__(self, key, columns):
+        self.key = key
+        self.columns = columns
+        self.rows_a = self.rows_b = 0
+        self.added = self.removed = self.changed = self.unchanged = 0
+        self.duplicates_a = self.duplicates_b = 0
+        self.column_changes = dict.fromkeys(columns, 0)
+        self.added_rows, self.removed_rows, self.changed_rows = [], [], []
+
+    def _sample(self, rows, df):
+        room = DIFF_SAMPLE_ROWS - len(rows)
+        if room > 0:
+            rows.extend(df.head(room).reset_index().to_dict('records'))
+
+    def compare(self, a, b):
+        key = self.key
+        self.rows_a += len(a)
+        self.rows_b += len(b)
+        self.duplicates_a += int(a.duplicated(key).sum())
+        self.duplicates_b += int(b.duplicated(key).sum())
+        # Duplicate keys: the first row of each key is the one compared
+        a = a.drop_duplicates(key).set_index(key)
+        b = b.drop_duplicates(key).set_index(key)
+
+        added = b.index.difference(a.index)
+        removed = a.index.difference(b.index)
+        self.added += len(added)
+        self.removed += len(removed)
+        self._sample(self.added_rows, b.loc[added])
+        self._sample(self.removed_rows, a.loc[removed])
+
+        common = a.index.intersection(b.index)
+        a, b = a.loc[common], b.loc[common]
+        masks = {column: _changed(a[column], b[column]) for column in self.columns}
+        any_change = np.zeros(len(common), dtype=bool)
+        for column, mask in masks.items():
+            self.column_changes[column] += int(mask.sum())
+            any_change |= mask
+        self.changed += int(any_change.sum())
+        self.unchanged += int(len(common) - any_change.sum())
+
+        for position in np.flatnonzero(any_change)[:max(0, DIFF_SAMPLE_ROWS - len(self.changed_rows))]:
+            self.changed_rows.append({
+                'key': _key_dict(key, common[position]),
+                'changes': {
+                    column: [a[column].iloc[position], b[column].iloc[position]]
+                    for column, mask in masks.items() if mask[position]
+                },
+            })
+
+
+def diff_uploads(upload_a, upload_b, key, sheet_a=None, sheet_b=None):
+    """Compare one sheet of ``upload_a`` (old) with one of ``upload_b`` (new), matching rows on ``key``"""
+    key = [key] if isinstance(key, str) else list(key)
+    if not key:
+        raise DiffError('Choose at least one key column to match rows on')
+    for upload, sheet in ((upload_a, sheet_a), (upload_b, sheet_b)):
+        if sheet is not None and upload.sheet_names and sheet not in upload.sheet_names:
+            raise DiffError(f"Unknown sheet '{sheet}' in '{upload.title}'")
+
+    columns_a, columns_b = sheet_columns(upload_a, sheet_a), sheet_columns(upload_b, sheet_b)
+    for column in key:
+        if column not in columns_a or column not in columns_b:
+            raise DiffError(f"Key column '{column}' must exist in both uploads")
+    compared = [column for column in columns_a if column in columns_b and column not in key]
+
+    rows_a, rows_b = _row_count(upload_a, sheet_a), _row_count(upload_b, sheet_b)
+    partitions = max(1, math.ceil(max(rows_a or 0, rows_b or 0) / DIFF_PARTITION_ROWS))
+
+    wanted = key + compared
+    batches_a = scan(upload_a, sheet_a, wanted, [], batch_size=BATCH_ROWS)
+    batches_b = scan(upload_b, sheet_b, wanted, [], batch_size=BATCH_ROWS)
+    first_a, first_b = next(batches_a, None), next(batches_b, None)
+    schema_a = first_a[0] if first_a else pa.schema([(column, pa.null()) for column in wanted])
+    schema_b = first_b[0] if first_b else pa.schema([(column, pa.null()) for column in wanted])
+    key_types = _key_types(schema_a, schema_b, key)
+
+    def tables(first, rest):
+        if first is not None:
+            yield first[1]
+            for _, table in rest:
+                yield table
+
+    result = DiffResult(key, compared)
+    with tempfile.TemporaryDirectory(prefix='diff-') as directory:
+        sources_a = _spill(tables(first_a, batches_a), key, key_types, partitions, directory, 'a')
+        sources_b = _spill(tables(first_b, batches_b), key, key_types, partitions, directory, 'b')
+        empty_a = _bucket_schema(schema_a, wanted, key_types)
+        empty_b = _bucket_schema(schema_b, wanted, key_types)
+        for source_a, source_b in zip(sources_a, sources_b):
+            if source_a is None and source_b is None:
+                continue
+            result.compare(_load(source_a, empty_a), _load(source_b, empty_b))
+
+    return to_json_safe({
+        'key': key,
+        'sheet_a': sheet_a,
+        'sheet_b': sheet_b,
+        'rows_a': result.rows_a,
+        'rows_b': result.rows_b,
+        'partitions': partitions,
+        'added_count': result.added,
+        'removed_count': result.removed,
+        'changed_count': result.changed,
+        'unchanged_count': result.unchanged,
+        'duplicate_keys_a': result.duplicates_a,
+        'duplicate_keys_b': result.duplicates_b,
+        'compared_columns': compared,
+        'added_columns': [column for column in columns_b if column not in columns_a],
+        'removed_columns': [column for column in columns_a if column not in columns_b],
+        'column_changes': [
+            {'name': column, 'changed': count} for column, count in result.column_changes.items()
+        ],
+        'added': result.added_rows,
+        'removed': result.removed_rows,
+        'changed': result.changed_rows,
+    })
+
+
+def _bucket_schema(schema, columns, key_types):
+    """Schema of one side's buckets, used for buckets that got no rows"""
+    return pa.schema([pa.field(column, key_types.get(column, schema.field(column).type)) for column in columns])
+
+
+def cached_diff(upload_a, upload_b, key, sheet_a=None, sheet_b=None, compute=None):
+    """``diff_uploads`` cached per (upload_a, upload_b) content pair, sheets and key
+
+    ``compute`` wraps the diff itself (for example to run it on a bounded pool).
+    """
+    key = [key] if isinstance(key, str) else list(key)
+    version_b = upload_b.content_hash or f'upload{upload_b.pk}'
+    # Column names may hold characters that are not safe in cache keys
+    digest = hashlib.sha1(json.dumps([sheet_a, sheet_b, key]).encode()).hexdigest()[:16]
+    cache_key = versioned_key(
+        'diff', upload_a, version_b, sheet_position(upload_a, sheet_a), sheet_position(upload_b, sheet_b), digest,
+    )
+    run = compute or (lambda func, *args: func(*args))
+    return get_or_compute(
+        cache_key, lambda: run(diff_uploads, upload_a, upload_b, key, sheet_a, sheet_b), DIFF_CACHE_TIMEOUT,
+    )
@@ -0,0 +1,145 @@
+"""
+Streaming exports of an upload's rows.
+
+Rows are read from the sheet's sidecar in record batches (see
+query.scan, which also applies the grid's filters) and encoded one batch at
+a time, so an export of any size uses constant memory. CSV and NDJSON
+bytes go out as soon as the first batch is encoded. XLSX is a zip
+container that openpyxl can only finish at the end, so it is written
+in write-only mode to a temporary file and streamed from there.
+"""
+import csv
+import io
+import os
+import tempfile
+import zlib
+from datetime import datetime
+
+import pyarrow.csv as pa_csv
+from openpyxl import Workbook
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+
+from .query import scan, sheet_columns
+
+# Rows encoded per step; smaller batches start the download sooner
+EXPORT_BATCH_ROWS = 10000
+# Bytes per chunk when streaming a finished file
+STREAM_BLOCK_BYTES = 64 * 1024
+# Rows per worksheet allowed by Excel (including the header)
+XLSX_MAX_ROWS = 1048576
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv', '.csv'),
+    'ndjson': ('application/x-ndjson', '.ndjson'),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', '.xlsx'),
+}
+
+
+def _csv_chunks(columns, batches):
+    header = True
+    for table in batches:
+        buffer = io.BytesIO()
+        pa_csv.write_csv(table, buffer, pa_csv.WriteOptions(include_header=header))
+        header = False
+        yield buffer.getvalue()
+    if header:
+        # No rows at all: still send the header line
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator='\n').writerow(columns)
+        yield buffer.getvalue().encode()
+
+
+def _ndjson_chunks(columns, batches):
+    for table in batches:
+        if not table.num_rows:
+            continue
+        text = table.to_pandas().to_json(orient='records', lines=True, date_format='iso', force_ascii=False)
+        yield (text if text.endswith('\n') else text + '\n').encode()
+
+
+def _xlsx_value(value):
+    if isinstance(value, str):
+        return ILLEGAL_CHARACTERS_RE.sub('', value)
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        # Excel has no time zones
+        return value.replace(tzinfo=None)
+    return value
+
+
+def _xlsx_chunks(columns, batches, title):
+    workbook = Workbook(write_only=True)
+    title = ILLEGAL_CHARACTERS_RE.sub('', title).translate(str.maketrans('', '', '[]:*?/\\'))[:28] or 'Sheet'
+    sheets = 0
+    worksheet = None
+    rows = XLSX_MAX_ROWS
+    for table in batches:
+        for row in zip(*(column.to_pylist() for column in table.columns)):
+            if rows >= XLSX_MAX_ROWS:
+                # Continue on a new worksheet once one is full
+                sheets += 1
+                worksheet = workbook.create_sheet(title if sheets == 1 else f'{title} {sheets}')
+                worksheet.append(columns)
+                rows = 1
+            worksheet.append([_xlsx_value(value) for value in row])
+            rows += 1
+    if worksheet is None:
+        workbook.create_sheet(title).append(columns)
+
+    handle, path = tempfile.mkstemp(suffix='.xlsx')
+    os.close(handle)
+    try:
+        workbook.save(path)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(STREAM_BLOCK_BYTES), b''):
+                yield block
+    finally:
+        os.remove(path)
+
+
+def _gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def _chain(first, rest):
+    yield first
+    yield from rest
+
+
+def export_rows(upload, sheet=None, fmt='csv', filters=(), compress=False):
+    """Byte chunks of one sheet of an upload encoded as ``fmt``
+
+    The first batch is read before returning, so bad sheets or filters
+    raise here instead of halfway through a response.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format '{fmt}', expected one of {', '.join(EXPORT_FORMATS)}")
+
+    scanned = scan(upload, sheet, None, list(filters), batch_size=EXPORT_BATCH_ROWS)
+    first = next(scanned, None)
+    if first is None:
+        columns, tables = sheet_columns(upload, sheet), iter(())
+    else:
+        columns = first[1].column_names
+        tables = (table for _, table in _chain(first, scanned))
+    columns = [str(name) for name in columns]
+
+    if fmt == 'csv':
+        chunks = _csv_chunks(columns, tables)
+    elif fmt == 'ndjson':
+        chunks = _ndjson_chunks(columns, tables)
+    else:
+        chunks = _xlsx_chunks(columns, tables, sheet or (upload.sheet_names[0] if upload.sheet_names else 'Sheet'))
+    return _gzip_chunks(chunks) if compress else chunks
+
+
+def export_filename(upload, sheet, fmt, compress=False):
+    base = os.path.splitext(upload.filename())[0]
+    if sheet and len(upload.sheet_names) > 1:
+        base = f'{base}-{sheet}'
+    base = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in base)
+    return base + EXPORT_FORMATS[fmt][1] + ('.gz' if compress else '')
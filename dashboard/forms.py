@@ -1,8 +1,17 @@
 from django import forms
+import os
 from .models import DataUpload
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Layout, Submit, Field, Div
 
+ALLOWED_EXTENSIONS = ['xlsx', 'xls', 'csv']
+
+def validate_extension(name):
+    # Ensure the file is an Excel file
+    ext = name.split('.')[-1]
+    if ext.lower() not in ALLOWED_EXTENSIONS:
+        raise forms.ValidationError("Only Excel files (xlsx, xls) or CSV files are allowed.")
+
 class DataUploadForm(forms.ModelForm):
     class Meta:
         model = DataUpload
@@ -32,8 +41,48 @@ class DataUploadForm(forms.ModelForm):
     def clean_file(self):
         file = self.cleaned_data.get('file', False)
         if file:
-            # Ensure the file is an Excel file
-            ext = file.name.split('.')[-1]
-            if ext.lower() not in ['xlsx', 'xls', 'csv']:
-                raise forms.ValidationError("Only Excel files (xlsx, xls) or CSV files are allowed.")
-        return file
\ No newline at end of file
+            validate_extension(file.name)
+        return file
+
+class ChunkedUploadForm(forms.Form):
+    """Start a chunked upload; the file itself arrives in later requests"""
+    title = forms.CharField(max_length=255)
+    description = forms.CharField(required=False, widget=forms.Textarea)
+    filename = forms.CharField(max_length=255)
+    size = forms.IntegerField(min_value=1)
+
+    def clean_filename(self):
+        filename = os.path.basename(self.cleaned_data['filename'])
+        validate_extension(filename)
+        return filename
+
+class AppendForm(forms.Form):
+    """A CSV file whose rows are added to an existing upload"""
+    file = forms.FileField()
+
+    def clean_file(self):
+        file = self.cleaned_data['file']
+        if not file.name.lower().endswith('.csv'):
+            raise forms.ValidationError("Only CSV files can be appended.")
+        return file
+
+class MaterializeForm(forms.Form):
+    """Choose the columns to index when loading an upload into SQLite"""
+    index_columns = forms.MultipleChoiceField(required=False)
+
+    def __init__(self, *args, columns=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['index_columns'].choices = [(col, col) for col in columns]
+
+class DiffForm(forms.Form):
+    """Pick the newer upload and the key columns to compare an upload against"""
+    against = forms.ModelChoiceField(queryset=DataUpload.objects.none(), label='Compare with')
+    key = forms.MultipleChoiceField(label='Match rows on')
+    against_sheet = forms.CharField(required=False)
+
+    def __init__(self, *args, upload=None, columns=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['against'].queryset = (
+            DataUpload.objects.filter(status=DataUpload.STATUS_READY).exclude(pk=upload.pk).order_by('-uploaded_at')
+        )
+        self.fields['key'].choices = [(col, col) for col in columns]
@@ -0,0 +1,223 @@
+"""
+Windowed row access for the data grid.
+
+Rows are served from the upload's Parquet sidecar. An unsorted,
+unfiltered window only reads the row groups that cover it. Sorted or
+filtered views compute the ordering once (from an indexed materialized
+table when one exists, otherwise from the projected sort/filter columns)
+and save it as a ``.npy`` index next to the sidecar, so later windows
+cost the same at any offset. Those indexes are capped per sheet at
+``GRID_ORDER_CACHE_BYTES``; the least recently used are deleted first.
+
+Windows of CSV uploads are sliced from the original file through its row
+index instead when there is one (see rowindex.py).
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from django.conf import settings
+
+from .columnar import ensure_sidecar, open_sidecar, sidecar_index_dir
+from .materialize import query_positions
+from .rowindex import load_row_index, take_csv_rows
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 500
+
+FILTER_OPS = {
+    'eq': pc.equal,
+    'ne': pc.not_equal,
+    'lt': pc.less,
+    'le': pc.less_equal,
+    'gt': pc.greater,
+    'ge': pc.greater_equal,
+}
+FILTER_RE = re.compile(r'^(?P<column>.+?):(?P<op>eq|ne|lt|le|gt|ge|contains):(?P<value>.*)$')
+
+
+class GridError(ValueError):
+    """Invalid window, sort or filter parameters"""
+
+
+def parse_sort(value):
+    """``"col"`` sorts ascending, ``"-col"`` descending"""
+    if not value:
+        return None
+    if value.startswith('-'):
+        return (value[1:], True)
+    return (value, False)
+
+
+def parse_filters(values):
+    """Parse ``column:op:value`` filter strings"""
+    filters = []
+    for raw in values:
+        match = FILTER_RE.match(raw)
+        if not match:
+            raise GridError(f"Invalid filter '{raw}', expected column:op:value")
+        filters.append((match.group('column'), match.group('op'), match.group('value')))
+    return filters
+
+
+def _check_columns(schema, names):
+    for name in names:
+        if schema.get_field_index(name) < 0:
+            raise GridError(f"Unknown column '{name}'")
+
+
+def _filter_mask(table, column, op, value):
+    data = table.column(column)
+    if op == 'contains':
+        return pc.match_substring(pc.cast(data, pa.string()), value, ignore_case=True)
+    try:
+        scalar = pa.scalar(value).cast(data.type)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+        raise GridError(f"'{value}' is not a valid value for column '{column}'")
+    return FILTER_OPS[op](data, scalar)
+
+
+def _compute_order(parquet, sort, filters):
+    columns = list(dict.fromkeys([c for c, _, _ in filters] + ([sort[0]] if sort else [])))
+    table = parquet.read(columns=columns)
+    positions = np.arange(table.num_rows, dtype=np.int64)
+
+    if filters:
+        mask = None
+        for column, op, value in filters:
+            condition = _filter_mask(table, column, op, value)
+            mask = condition if mask is None else pc.and_(mask, condition)
+        mask = pc.fill_null(mask, False)
+        table = table.filter(mask)
+        positions = positions[mask.to_numpy(zero_copy_only=False)]
+
+    if sort:
+        order = pc.sort_indices(
+            table,
+            sort_keys=[(sort[0], 'descending' if sort[1] else 'ascending')],
+        )
+        positions = positions[order.to_numpy()]
+    return positions
+
+
+def _evict_orders(directory, keep):
+    """Delete the least recently used row orders beyond the size cap, never ``keep``"""
+    limit = settings.GRID_ORDER_CACHE_BYTES
+    orders = []
+    for path in glob.glob(os.path.join(directory, 'order-*.npy')):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        orders.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in orders)
+    for _, size, path in sorted(orders):
+        if total <= limit:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def row_order(upload, sheet, sidecar, parquet, sort, filters):
+    """Row positions for a sorted/filtered view, cached on disk"""
+    key = hashlib.sha256(json.dumps([upload.content_hash, sheet, sort, filters]).encode()).hexdigest()[:32]
+    directory = sidecar_index_dir(sidecar)
+    path = os.path.join(directory, f'order-{key}.npy')
+    if os.path.exists(path):
+        try:
+            os.utime(path)  # mtime marks the last use, for eviction
+            return np.load(path, mmap_mode='r')
+        except FileNotFoundError:
+            pass  # evicted meanwhile
+
+    # An indexed SQLite copy answers the query without scanning the sidecar
+    positions = query_positions(upload, sheet, sort, filters)
+    if positions is None:
+        positions = _compute_order(parquet, sort, filters)
+    os.makedirs(directory, exist_ok=True)
+    temp = f'{path}.{os.getpid()}.tmp'
+    with open(temp, 'wb') as f:
+        np.save(f, positions)
+    os.replace(temp, path)
+    _evict_orders(directory, keep=path)
+    return positions
+
+
+def _row_group_starts(parquet):
+    metadata = parquet.metadata
+    sizes = [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+    return np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)])
+
+
+def take_rows(parquet, positions):
+    """Fetch rows by position, reading only the row groups that hold them"""
+    positions = np.asarray(positions, dtype=np.int64)
+    if not len(positions):
+        return parquet.schema_arrow.empty_table()
+
+    starts = _row_group_starts(parquet)
+    groups = np.searchsorted(starts, positions, side='right') - 1
+    parts = []
+    offsets = {}
+    for group in np.unique(groups):
+        offsets[group] = sum(len(part) for part in parts)
+        parts.append(parquet.read_row_group(int(group)))
+    table = pa.concat_tables(parts)
+    local = np.array([offsets[g] + p - starts[g] for g, p in zip(groups, positions)], dtype=np.int64)
+    return table.take(pa.array(local))
+
+
+def fetch_rows(upload, sidecar, parquet, positions):
+    """Rows at ``positions``, from the CSV row index when there is one, else from the sidecar"""
+    offsets = load_row_index(upload, sidecar, parquet)
+    if offsets is not None:
+        try:
+            return take_csv_rows(upload.file.path, offsets, positions, parquet.schema_arrow)
+        except (ValueError, pa.ArrowException) as e:
+            logger.warning(f"Row index of upload {upload.pk} unusable, reading the sidecar: {e}")
+    return take_rows(parquet, positions)
+
+
+def read_window(upload, sheet=None, offset=0, limit=DEFAULT_LIMIT, sort=None, filters=()):
+    """Return one window of rows of a sheet as a JSON-serialisable dict"""
+    if offset < 0 or limit < 1:
+        raise GridError('offset must be >= 0 and limit >= 1')
+    limit = min(limit, MAX_LIMIT)
+
+    try:
+        sidecar = ensure_sidecar(upload, sheet)
+    except ValueError as e:
+        raise GridError(str(e))
+    parquet = open_sidecar(sidecar)
+    schema = parquet.schema_arrow
+    _check_columns(schema, [c for c, _, _ in filters] + ([sort[0]] if sort else []))
+
+    if sort or filters:
+        order = row_order(upload, sheet, sidecar, parquet, sort, list(filters))
+        total = len(order)
+        table = fetch_rows(upload, sidecar, parquet, order[offset:offset + limit])
+    else:
+        total = parquet.metadata.num_rows
+        table = fetch_rows(upload, sidecar, parquet, np.arange(offset, min(offset + limit, total)))
+
+    columns = [col.to_pylist() for col in table.columns]
+    return {
+        'offset': offset,
+        'limit': limit,
+        'total': total,
+        'columns': schema.names,
+        'rows': [list(row) for row in zip(*columns)],
+    }
@@ -0,0 +1,191 @@
+"""
+Background job queue for upload ingestion.
+
+Jobs run on a local process pool so that parsing large workbooks never
+holds a web worker. Set ``INGEST_ASYNC = False`` to run jobs inline
+(useful for tests and management commands).
+"""
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _init_worker(settings_module):
+    """Set up Django inside a freshly spawned pool process"""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    import django
+    django.setup()
+    lower_priority()
+
+
+def lower_priority():
+    """Let web workers go first for the CPU (``INGEST_NICE``, Unix only)"""
+    niceness = getattr(settings, 'INGEST_NICE', 0)
+    if niceness and hasattr(os, 'nice'):
+        os.nice(niceness)
+
+
+def get_executor():
+    """Return the shared process pool, creating it on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=getattr(settings, 'INGEST_WORKERS', 2),
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(settings.SETTINGS_MODULE,),
+            )
+        return _executor
+
+
+def run_parallel(func, items):
+    """Map ``func`` over ``items`` on the shared process pool
+
+    ``func`` must be a module-level function that does not need Django
+    (for example ``profiling.profile_sidecar``). Runs inline for a single
+    item or when ``INGEST_ASYNC`` is off.
+    """
+    items = list(items)
+    if len(items) <= 1 or not getattr(settings, 'INGEST_ASYNC', True):
+        return [func(item) for item in items]
+    return list(get_executor().map(func, items))
+
+
+def _log_failure(future):
+    exc = future.exception()
+    if exc is not None:
+        logger.error(f"Background job failed: {exc}")
+
+
+def enqueue(func, *args):
+    """Run ``func(*args)`` on the process pool once the current transaction commits"""
+    if not getattr(settings, 'INGEST_ASYNC', True):
+        transaction.on_commit(lambda: func(*args))
+        return
+
+    def submit():
+        future = get_executor().submit(func, *args)
+        future.add_done_callback(_log_failure)
+
+    transaction.on_commit(submit)
+
+
+def ingest_upload(upload_pk):
+    """Job: process a freshly saved upload and record its status"""
+    from django.db import close_old_connections
+    from .models import DataUpload
+    from .processing import process_excel_file
+
+    close_old_connections()
+    try:
+        upload = DataUpload.objects.get(pk=upload_pk)
+    except DataUpload.DoesNotExist:
+        logger.warning(f"Upload {upload_pk} vanished before ingestion")
+        return
+
+    def report(percent, message=''):
+        upload.set_status(DataUpload.STATUS_PROCESSING, progress=percent, message=message)
+
+    report(5, 'Reading file')
+    try:
+        total_rows = process_excel_file(upload, progress=report)
+    except Exception as e:
+        logger.error(f"File processing error for upload {upload_pk}: {e}")
+        upload.set_status(DataUpload.STATUS_FAILED, message=str(e))
+        return
+
+    DataUpload.objects.filter(pk=upload_pk).update(row_count=total_rows)
+    upload.set_status(DataUpload.STATUS_READY, progress=100)
+    return total_rows
+
+
+def enqueue_ingestion(data_upload):
+    """Mark an upload as queued and hand it to the process pool
+
+    A copy of an already processed file reuses its results instead.
+    """
+    from .processing import copy_ingestion
+
+    if copy_ingestion(data_upload):
+        return
+    data_upload.set_status(data_upload.STATUS_QUEUED, progress=0, message='Waiting for a worker')
+    enqueue(ingest_upload, data_upload.pk)
+
+
+def append_to_upload(upload_pk, path):
+    """Job: append the rows of the CSV at ``path`` to an upload, then delete ``path``"""
+    from django.db import close_old_connections
+    from .appending import append_rows
+    from .models import DataUpload
+
+    close_old_connections()
+    try:
+        try:
+            upload = DataUpload.objects.get(pk=upload_pk)
+        except DataUpload.DoesNotExist:
+            logger.warning(f"Upload {upload_pk} vanished before rows could be appended")
+            return
+
+        def report(percent, message=''):
+            upload.set_status(DataUpload.STATUS_PROCESSING, progress=percent, message=message)
+
+        try:
+            added = append_rows(upload, path, progress=report)
+        except Exception as e:
+            # The upload is left as it was, so it stays usable
+            logger.error(f"Appending to upload {upload_pk} failed: {e}")
+            upload.set_status(DataUpload.STATUS_READY, progress=100, message=f'Rows were not appended: {e}')
+            return
+        upload.set_status(DataUpload.STATUS_READY, progress=100, message=f'Appended {added} rows')
+        return added
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def enqueue_append(data_upload, path):
+    """Queue appending the rows of the CSV at ``path`` to an upload"""
+    data_upload.set_status(data_upload.STATUS_QUEUED, progress=0, message='Waiting for a worker')
+    enqueue(append_to_upload, data_upload.pk, path)
+
+
+def materialize_table(upload_pk, sheet_name, index_columns):
+    """Job: load one sheet of an upload into its SQLite table"""
+    from django.db import close_old_connections
+    from .materialize import materialize_upload
+    from .models import DataUpload, MaterializedTable
+
+    close_old_connections()
+    upload = DataUpload.objects.get(pk=upload_pk)
+    tables = MaterializedTable.objects.filter(upload_id=upload_pk, sheet_name=sheet_name)
+    tables.update(status=DataUpload.STATUS_PROCESSING, status_message='Loading rows')
+    try:
+        materialize_upload(upload, sheet_name, index_columns)
+    except Exception as e:
+        logger.error(f"Materialization failed for upload {upload_pk}: {e}")
+        tables.update(status=DataUpload.STATUS_FAILED, status_message=str(e)[:255])
+
+
+def enqueue_materialization(data_upload, sheet_name, index_columns):
+    """Queue loading a sheet into SQLite with indexes on ``index_columns``"""
+    from .materialize import table_name_for
+    from .models import MaterializedTable
+
+    MaterializedTable.objects.update_or_create(
+        upload=data_upload,
+        sheet_name=sheet_name,
+        defaults={'status': data_upload.STATUS_QUEUED, 'status_message': ''},
+        create_defaults={'table_name': table_name_for(data_upload, sheet_name), 'status': data_upload.STATUS_QUEUED},
+    )
+    enqueue(materialize_table, data_upload.pk, sheet_name, list(index_columns))
@@ -0,0 +1,166 @@
+"""
+Upload listing: keyset pagination and full-text title search.
+
+Pages are ordered newest first on ``(uploaded_at, id)`` and continue from
+a cursor holding the last row of the previous page, so every page is a
+range scan of ``dashboard_upload_recent_idx`` however deep it is. There
+is no OFFSET and no COUNT(*) over the table.
+
+Titles are searched through an FTS5 table kept current by triggers on
+``dashboard_dataupload``. Databases without FTS5 fall back to
+``icontains``.
+"""
+import datetime
+import re
+
+from django.db import DatabaseError, connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+FTS_TABLE = 'dashboard_upload_fts'
+UPLOAD_TABLE = 'dashboard_dataupload'
+
+# Newest first; the index on these columns serves both directions
+ORDERING = ['-uploaded_at', '-id']
+
+FTS_SQL = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(title, content='{UPLOAD_TABLE}', content_rowid='id')",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert AFTER INSERT ON {UPLOAD_TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, title) VALUES (new.id, new.title);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON {UPLOAD_TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title) VALUES ('delete', old.id, old.title);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update AFTER UPDATE OF title ON {UPLOAD_TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title) VALUES ('delete', old.id, old.title);
+        INSERT INTO {FTS_TABLE}(rowid, title) VALUES (new.id, new.title);
+    END""",
+]
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_CURSOR = re.compile(r'^(-?\d+)\.(\d+)$')
+_WORD = re.compile(r'\w+')
+
+
+class CursorError(ValueError):
+    """A page cursor that was not produced by ``encode_cursor``"""
+
+
+def install_title_search(conn=None):
+    """Create the FTS5 title index and its triggers if they are missing
+
+    Rebuilding a table on SQLite (as migrations that alter
+    ``DataUpload`` do) drops its triggers, so this also runs after every
+    migrate; the index is rebuilt whenever triggers had to be recreated.
+    Returns False when ``conn`` is not SQLite or has no FTS5.
+    """
+    conn = conn or connection
+    if conn.vendor != 'sqlite':
+        return False
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name LIKE %s",
+            [f'{FTS_TABLE}_%'],
+        )
+        complete = cursor.fetchone()[0] == len(FTS_SQL) - 1
+        try:
+            for statement in FTS_SQL:
+                cursor.execute(statement)
+        except DatabaseError:
+            # SQLite built without FTS5
+            return False
+        if not complete:
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+    return True
+
+
+def has_title_search():
+    if connection.vendor != 'sqlite':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = %s", [FTS_TABLE])
+        return cursor.fetchone() is not None
+
+
+def search_uploads(queryset, text):
+    """Uploads of ``queryset`` whose title contains every word of ``text`` (as a prefix)"""
+    words = _WORD.findall(text)
+    if not words:
+        return queryset
+    if not has_title_search():
+        return queryset.filter(*[Q(title__icontains=word) for word in words])
+    # Quoted terms keep FTS5 operators in the input from being interpreted
+    match = ' '.join(f'"{word}"*' for word in words)
+    return queryset.filter(pk__in=RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [match]))
+
+
+def encode_cursor(upload):
+    """Opaque cursor for the position of ``upload`` in the listing"""
+    micros = (upload.uploaded_at - _EPOCH) // datetime.timedelta(microseconds=1)
+    return f'{micros}.{upload.pk}'
+
+
+def decode_cursor(value):
+    """``(uploaded_at, pk)`` of a cursor"""
+    match = _CURSOR.match(value or '')
+    if match is None:
+        raise CursorError('Invalid page cursor')
+    return _EPOCH + datetime.timedelta(microseconds=int(match.group(1))), int(match.group(2))
+
+
+class KeysetPage:
+    """One page of a keyset-paginated listing (quacks like ``django.core.paginator.Page`` for templates)"""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+def keyset_page(queryset, size, after=None, before=None):
+    """The ``size`` uploads following cursor ``after`` (or preceding ``before``), newest first
+
+    The bare bound on ``uploaded_at`` lets SQLite seek into the index
+    rather than scan it for the OR. Raises ``CursorError`` for a
+    malformed cursor.
+    """
+    if before:
+        uploaded_at, pk = decode_cursor(before)
+        rows = list(
+            queryset.filter(Q(uploaded_at__gt=uploaded_at) | Q(pk__gt=pk), uploaded_at__gte=uploaded_at)
+            .order_by('uploaded_at', 'id')[:size + 1]
+        )
+        more_before = len(rows) > size
+        rows = rows[:size][::-1]
+        return KeysetPage(
+            rows,
+            next_cursor=encode_cursor(rows[-1]) if rows else None,
+            previous_cursor=encode_cursor(rows[0]) if rows and more_before else None,
+        )
+
+    if after:
+        uploaded_at, pk = decode_cursor(after)
+        queryset = queryset.filter(Q(uploaded_at__lt=uploaded_at) | Q(pk__lt=pk), uploaded_at__lte=uploaded_at)
+    rows = list(queryset.order_by(*ORDERING)[:size + 1])
+    more_after = len(rows) > size
+    rows = rows[:size]
+    return KeysetPage(
+        rows,
+        next_cursor=encode_cursor(rows[-1]) if rows and more_after else None,
+        previous_cursor=encode_cursor(rows[0]) if rows and after else None,
+    )
@@ -0,0 +1,107 @@
+import json
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from dashboard.benchmark import bench_concurrent, bench_dataset, environment, generate_dataset, parse_mix, track_queries
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark ingestion and the preview pages on synthetic files. Runs against a '
+        'throwaway database, media root and cache, and writes the results as JSON.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000],
+                            help='Row counts to generate (one dataset per count and format)')
+        parser.add_argument('--columns', type=int, default=10, help='Columns per dataset')
+        parser.add_argument('--formats', default='csv,xlsx', help='Comma-separated file formats: csv, xlsx')
+        parser.add_argument('--mix', default='int=3,float=3,str=2,date=1,bool=1',
+                            help='Relative weights of the column types int, float, str, date and bool')
+        parser.add_argument('--nulls', type=float, default=0.02, help='Share of empty cells')
+        parser.add_argument('--repeat', type=int, default=3, help='Timed runs per dataset; the median is reported')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default='-', help="JSON results file ('-' for stdout)")
+        parser.add_argument('--concurrent', type=int, default=0, metavar='REQUESTS',
+                            help='Also time this many page reads while idle and while an ingestion runs')
+        parser.add_argument('--keep', action='store_true', help='Keep the scratch directory with the generated files')
+
+    def handle(self, *args, **options):
+        formats = [fmt.strip() for fmt in options['formats'].split(',') if fmt.strip()]
+        unknown = set(formats) - {'csv', 'xlsx'}
+        if unknown:
+            raise CommandError(f"Unknown formats: {', '.join(sorted(unknown))}")
+        try:
+            mix = parse_mix(options['mix'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options['repeat'] < 1 or options['columns'] < 1:
+            raise CommandError('--repeat and --columns must be at least 1')
+        if options['concurrent'] < 0:
+            raise CommandError('--concurrent cannot be negative')
+
+        scratch = tempfile.mkdtemp(prefix='bench-')
+        cache_settings = {'default': dict(settings.CACHES['default'], LOCATION=os.path.join(scratch, 'cache'))}
+        old_name = connection.settings_dict['NAME']
+        connection.settings_dict['TEST']['NAME'] = os.path.join(scratch, 'bench.sqlite3')
+        setup_test_environment()
+        try:
+            connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            track_queries()
+            with override_settings(MEDIA_ROOT=os.path.join(scratch, 'media'), CACHES=cache_settings, INGEST_ASYNC=False):
+                results = self._run(scratch, formats, mix, options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            if options['keep']:
+                self.stderr.write(f'Generated files kept in {scratch}')
+            else:
+                shutil.rmtree(scratch, ignore_errors=True)
+
+        report = {
+            'environment': environment(),
+            'options': {
+                key: options[key] for key in ('rows', 'columns', 'formats', 'mix', 'nulls', 'repeat', 'seed', 'concurrent')
+            },
+            'results': results,
+        }
+        text = json.dumps(report, indent=2)
+        if options['output'] == '-':
+            self.stdout.write(text)
+        else:
+            with open(options['output'], 'w') as f:
+                f.write(text + '\n')
+            self.stderr.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+
+    def _run(self, scratch, formats, mix, options):
+        results = []
+        for fmt in formats:
+            for rows in options['rows']:
+                path = os.path.join(scratch, f"bench-{rows}x{options['columns']}.{fmt}")
+                self.stderr.write(f'Generating {os.path.basename(path)}')
+                size = generate_dataset(path, rows, options['columns'], mix, options['nulls'], options['seed'])
+                steps = bench_dataset(path, repeat=options['repeat'])
+                for name, step in steps.items():
+                    self.stderr.write(
+                        f"  {name:<13} {step['wall_s']:>9.3f}s  {step['peak_rss_mb']:>8.1f} MB  {step['queries']:>4} queries"
+                    )
+                result = {
+                    'dataset': {'format': fmt, 'rows': rows, 'columns': options['columns'], 'bytes': size},
+                    'steps': steps,
+                }
+                if options['concurrent']:
+                    result['concurrent'] = bench_concurrent(path, requests=options['concurrent'])
+                    for phase in ('idle', 'ingesting'):
+                        latency = result['concurrent'][phase]
+                        self.stderr.write(
+                            f"  reads {phase:<9} p50 {latency.get('p50_s', 0):.4f}s  p95 {latency.get('p95_s', 0):.4f}s  "
+                            f"{latency['requests']:>4} ok  {latency['failures']:>3} failed"
+                        )
+                results.append(result)
+        return results
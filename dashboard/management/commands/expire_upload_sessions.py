@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from dashboard.chunked import expire_sessions
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete resumable uploads left unfinished for longer than CHUNKED_UPLOAD_EXPIRY, '
+        'with their partial files. Suitable for a daily cron job.'
+    )
+
+    def handle(self, *args, **options):
+        expired = expire_sessions()
+        self.stdout.write(f'Deleted {expired} expired upload session(s)')
@@ -0,0 +1,253 @@
+"""
+Materialize uploads into real SQLite tables.
+
+The rows of an upload's Parquet sidecar are bulk-loaded into a typed
+table (``upload_data_<pk>``) in ``executemany`` batches, on a dedicated
+connection tuned for the load. Each batch is its own short transaction,
+so other writers get the lock between batches; the table is only used
+once the whole load has committed (see ``indexed_table``).
+Secondary indexes on chosen columns let the data grid answer filter and
+sort requests from SQLite instead of scanning the file.
+"""
+import logging
+import sqlite3
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from django.conf import settings
+from django.db import connection
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+
+from .columnar import ensure_sidecar, open_sidecar
+from .database import apply_pragmas, retry_locked
+from .models import DataUpload, MaterializedTable
+
+logger = logging.getLogger(__name__)
+
+INSERT_BATCH_ROWS = 20000  # rows per insert transaction
+
+# Row position in the upload, used as the table's primary key
+ROW_COLUMN = '_row'
+
+# Applied on top of settings.SQLITE_PRAGMAS, to the bulk-load connection only.
+# Durability settings stay as configured: the load shares the file that
+# holds the app's own tables, so a crash must not be able to corrupt it.
+LOAD_PRAGMAS = {
+    'cache_size': -262144,  # 256 MB page cache
+}
+
+SQL_OPS = {'eq': '=', 'ne': '!=', 'lt': '<', 'le': '<=', 'gt': '>', 'ge': '>='}
+
+
+class MaterializeError(ValueError):
+    """The upload cannot be loaded into or queried from SQLite"""
+
+
+def table_name_for(upload, sheet=None):
+    """``upload_data_<pk>`` for the first sheet, ``upload_data_<pk>_<n>`` for the others"""
+    position = upload.sheet_names.index(sheet) if sheet in upload.sheet_names else 0
+    if position:
+        return f'upload_data_{upload.pk}_{position}'
+    return f'upload_data_{upload.pk}'
+
+
+def quote(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def sqlite_type(arrow_type):
+    if pa.types.is_integer(arrow_type) or pa.types.is_boolean(arrow_type):
+        return 'INTEGER'
+    if pa.types.is_floating(arrow_type) or pa.types.is_decimal(arrow_type):
+        return 'REAL'
+    return 'TEXT'
+
+
+def _database_path():
+    database = settings.DATABASES['default']
+    if database['ENGINE'] != 'django.db.backends.sqlite3':
+        raise MaterializeError('Materialized tables require the SQLite database backend')
+    return str(database['NAME'])
+
+
+def _load_connection():
+    conn = sqlite3.connect(_database_path(), timeout=30, isolation_level=None)
+    apply_pragmas(conn)
+    apply_pragmas(conn, LOAD_PRAGMAS)
+    return conn
+
+
+def _sqlite_column(array):
+    """Python values for one Arrow column, in types sqlite3 accepts"""
+    kind = array.type
+    if pa.types.is_boolean(kind):
+        array = pc.cast(array, pa.int8())
+    elif pa.types.is_decimal(kind):
+        array = pc.cast(array, pa.float64())
+    elif sqlite_type(kind) == 'TEXT' and not pa.types.is_string(kind) and not pa.types.is_large_string(kind):
+        try:
+            array = pc.cast(array, pa.string())
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            return [None if v is None else str(v) for v in array.to_pylist()]
+    return array.to_pylist()
+
+
+def _create_indexes(conn, table_name, schema, columns):
+    for column in columns:
+        position = schema.get_field_index(column)
+        conn.execute(
+            f'CREATE INDEX IF NOT EXISTS {quote(f"{table_name}_idx_{position}")} '
+            f'ON {quote(table_name)} ({quote(column)})'
+        )
+
+
+def _table_exists(conn, table_name):
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", [table_name]).fetchone()
+    return row is not None
+
+
+def _write(conn, func):
+    """Run ``func()`` in an immediate transaction on ``conn``, retried while the database is locked"""
+    def attempt():
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            func()
+            conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+
+    retry_locked(attempt)
+
+
+def _bulk_load(conn, table_name, parquet):
+    schema = parquet.schema_arrow
+    column_defs = [f'{quote(ROW_COLUMN)} INTEGER PRIMARY KEY']
+    column_defs += [f'{quote(field.name)} {sqlite_type(field.type)}' for field in schema]
+    placeholders = ', '.join(['?'] * (len(schema) + 1))
+
+    def create():
+        conn.execute(f'DROP TABLE IF EXISTS {quote(table_name)}')
+        conn.execute(f'CREATE TABLE {quote(table_name)} ({", ".join(column_defs)})')
+
+    _write(conn, create)
+    insert = f'INSERT INTO {quote(table_name)} VALUES ({placeholders})'
+
+    loaded = 0
+    for batch in parquet.iter_batches(batch_size=INSERT_BATCH_ROWS):
+        columns = [range(loaded, loaded + batch.num_rows)]
+        columns += [_sqlite_column(column) for column in batch.columns]
+        # A fresh iterator for every attempt
+        _write(conn, lambda: conn.executemany(insert, zip(*columns)))
+        loaded += batch.num_rows
+    return loaded
+
+
+def materialize_upload(upload, sheet=None, index_columns=()):
+    """Load one sheet of an upload into its SQLite table and build the requested indexes"""
+    sheet = sheet or (upload.sheet_names[0] if upload.sheet_names else 'Sheet1')
+    parquet = open_sidecar(ensure_sidecar(upload, sheet))
+    schema = parquet.schema_arrow
+    unknown = [column for column in index_columns if schema.get_field_index(column) < 0]
+    if unknown:
+        raise MaterializeError(f"Unknown columns: {', '.join(map(str, unknown))}")
+
+    table, _ = MaterializedTable.objects.get_or_create(
+        upload=upload, sheet_name=sheet, defaults={'table_name': table_name_for(upload, sheet)}
+    )
+    indexed = list(dict.fromkeys(list(table.indexed_columns) + list(index_columns)))
+
+    conn = _load_connection()
+    try:
+        # content_hash is only recorded once a load has completed
+        current = table.content_hash == upload.content_hash and _table_exists(conn, table.table_name)
+        if current:
+            # Data is up to date: only add the missing indexes
+            row_count = table.row_count
+        else:
+            # A load cut short between batches must not pass for a current table
+            MaterializedTable.objects.filter(pk=table.pk).update(content_hash='')
+            row_count = _bulk_load(conn, table.table_name, parquet)
+        _write(conn, lambda: _create_indexes(conn, table.table_name, schema, indexed))
+    finally:
+        conn.close()
+
+    MaterializedTable.objects.filter(pk=table.pk).update(
+        status=DataUpload.STATUS_READY,
+        status_message='',
+        row_count=row_count,
+        indexed_columns=indexed,
+        content_hash=upload.content_hash,
+    )
+    return table.table_name
+
+
+def drop_table(table):
+    with connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {quote(table.table_name)}')
+
+
+@receiver(pre_delete, sender=MaterializedTable)
+def drop_deleted_table(sender, instance, **kwargs):
+    # Also runs when the table's upload is deleted, in the same transaction
+    drop_table(instance)
+
+
+def indexed_table(upload, sheet=None):
+    """The sheet's materialized table if it is ready and current"""
+    sheet = sheet or (upload.sheet_names[0] if upload.sheet_names else 'Sheet1')
+    table = upload.tables.filter(sheet_name=sheet, status=DataUpload.STATUS_READY).first()
+    if table is None or table.content_hash != upload.content_hash:
+        return None
+    return table
+
+
+def _typed_value(value, field):
+    """A filter value as the loader stores it for ``field`` (timestamps become the same TEXT)"""
+    try:
+        scalar = pa.scalar(value).cast(field.type)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+        raise MaterializeError(f"'{value}' is not a valid value for column '{field.name}'")
+    return _sqlite_column(pa.repeat(scalar, 1))[0]
+
+
+def query_positions(upload, sheet, sort, filters):
+    """Row positions for a sorted/filtered view, answered from SQLite
+
+    Returns None unless the sheet has a current materialized table with an
+    index on at least one of the sort/filter columns.
+    """
+    table = indexed_table(upload, sheet)
+    used = {column for column, _, _ in filters} | ({sort[0]} if sort else set())
+    if table is None or not used & set(table.indexed_columns):
+        return None
+
+    schema = pq.read_schema(ensure_sidecar(upload, sheet))
+    if any(op == 'contains' and sqlite_type(schema.field(column).type) != 'TEXT' for column, op, _ in filters):
+        # SQLite's text of numbers and booleans ('1', '8.0') is not Arrow's ('true', '8')
+        return None
+    with connection.cursor() as cursor:
+        clauses, params = [], []
+        for column, op, value in filters:
+            if op == 'contains':
+                escaped = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                clauses.append(f"CAST({quote(column)} AS TEXT) LIKE %s ESCAPE '\\'")
+                params.append(f'%{escaped}%')
+            else:
+                clauses.append(f'{quote(column)} {SQL_OPS[op]} %s')
+                params.append(_typed_value(value, schema.field(column)))
+
+        sql = f'SELECT {quote(ROW_COLUMN)} FROM {quote(table.table_name)}'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        order = [quote(ROW_COLUMN)]
+        if sort:
+            order.insert(0, f'{quote(sort[0])} {"DESC" if sort[1] else "ASC"} NULLS LAST')
+        sql += ' ORDER BY ' + ', '.join(order)
+
+        cursor.execute(sql, params)
+        return np.fromiter((row[0] for row in cursor.fetchall()), dtype=np.int64)
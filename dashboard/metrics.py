@@ -0,0 +1,368 @@
+"""
+Request-level performance metrics.
+
+``MetricsMiddleware`` gives every request a small record that the hooks
+below fill in: SQL query count and time (an execute wrapper on every
+connection), cache outcomes of ``get_or_compute`` by key prefix, and named
+timers such as ``pandas_read`` and ``stats`` around the profiler. When the
+request ends the record is folded into per-view histograms and counters.
+Histograms keep cumulative buckets for the Prometheus endpoint and a
+rolling window of recent requests for the staff page.
+
+Metrics live in the memory of each process. With ``METRICS_ENABLED`` off
+the middleware removes itself at startup and every hook returns after a
+single flag check.
+"""
+import contextvars
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import nullcontext
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+try:
+    ENABLED = getattr(settings, 'METRICS_ENABLED', False)
+except ImproperlyConfigured:
+    # Imported by profiling code running in a pool process without Django settings
+    ENABLED = False
+
+# Histogram upper bounds for durations (seconds) and for per-request query counts
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+# The staff page summarizes the last WINDOW_SECONDS, kept as WINDOW_SLICES slices
+WINDOW_SECONDS = 60 * 60
+WINDOW_SLICES = 12
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+_noop = nullcontext()
+
+
+class RequestMetrics:
+    """What one request spent its time on"""
+
+    __slots__ = ('queries', 'query_seconds', 'timers', 'cache')
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.timers = defaultdict(float)
+        self.cache = defaultdict(int)
+
+
+class _Timer:
+    __slots__ = ('record', 'name', 'started')
+
+    def __init__(self, record, name):
+        self.record = record
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.record.timers[self.name] += time.perf_counter() - self.started
+
+
+def timed(name):
+    """Context manager adding the time spent in the block to the request's ``name`` timer"""
+    if not ENABLED:
+        return _noop
+    record = _current.get()
+    if record is None:
+        return _noop
+    return _Timer(record, name)
+
+
+def record_cache(key, outcome):
+    """Count a cache lookup of ``key`` as ``outcome`` (hit_local, hit_shared, hit_stale, miss, ...)"""
+    if not ENABLED:
+        return
+    record = _current.get()
+    if record is not None:
+        record.cache[(cache_prefix(key), outcome)] += 1
+
+
+_KEY_PREFIX_RE = re.compile(r'^(.+?)_(?:[0-9a-f]{64}|upload\d+)(?:_|$)')
+
+
+def cache_prefix(key):
+    """``data_preview_<hash>_0`` -> ``data_preview``"""
+    match = _KEY_PREFIX_RE.match(key)
+    return match.group(1) if match else key.split('_', 1)[0]
+
+
+def _count_query(execute, sql, params, many, context):
+    record = _current.get()
+    if record is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        record.queries += 1
+        record.query_seconds += time.perf_counter() - started
+
+
+def _track_connection(connection, **kwargs):
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+class RollingHistogram:
+    """Histogram with cumulative totals and a rolling window of recent observations"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._slices = deque()
+
+    def _slice(self, now):
+        start = now - now % (WINDOW_SECONDS / WINDOW_SLICES)
+        if not self._slices or self._slices[-1][0] != start:
+            self._slices.append((start, [0] * (len(self.buckets) + 1), [0.0, 0]))
+        while self._slices and self._slices[0][0] <= now - WINDOW_SECONDS:
+            self._slices.popleft()
+        return self._slices[-1]
+
+    def observe(self, value, now):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+        _, counts, totals = self._slice(now)
+        counts[index] += 1
+        totals[0] += value
+        totals[1] += 1
+
+    def window(self, now):
+        """``(bucket_counts, sum, count)`` over the last ``WINDOW_SECONDS``"""
+        self._slice(now)
+        counts = [0] * (len(self.buckets) + 1)
+        total, count = 0.0, 0
+        for _, slice_counts, totals in self._slices:
+            counts = [a + b for a, b in zip(counts, slice_counts)]
+            total += totals[0]
+            count += totals[1]
+        return counts, total, count
+
+    def quantile(self, q, now):
+        """Upper bound of the bucket holding the ``q`` quantile of the window (None if empty)"""
+        counts, _, count = self.window(now)
+        if not count:
+            return None
+        seen = 0
+        for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+            seen += bucket
+            if seen >= q * count:
+                return bound
+        return float('inf')
+
+
+class Registry:
+    """Histograms and counters keyed by ``(name, labels)``"""
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = defaultdict(int)
+        self.window_counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, labels, value, buckets=SECONDS_BUCKETS, now=None):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = RollingHistogram(buckets)
+            histogram.observe(value, now or time.time())
+
+    def increment(self, name, labels, amount=1, now=None):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] += amount
+            counter = self.window_counters.get(key)
+            if counter is None:
+                counter = self.window_counters[key] = RollingHistogram(())
+            counter.observe(amount, now or time.time())
+
+    def record_request(self, view, seconds, record):
+        now = time.time()
+        labels = {'view': view}
+        self.observe('request_seconds', labels, seconds, now=now)
+        self.observe('db_queries', labels, record.queries, COUNT_BUCKETS, now=now)
+        self.observe('db_seconds', labels, record.query_seconds, now=now)
+        for timer, elapsed in record.timers.items():
+            self.observe(f'{timer}_seconds', labels, elapsed, now=now)
+        for (prefix, outcome), count in record.cache.items():
+            self.increment('cache_lookups', {'prefix': prefix, 'outcome': outcome}, count, now=now)
+
+    def snapshot(self):
+        with self._lock:
+            now = time.time()
+            histograms = {
+                key: (histogram.buckets, list(histogram.counts), histogram.sum, histogram.count,
+                      histogram.window(now), {q: histogram.quantile(q, now) for q in (0.5, 0.95, 0.99)})
+                for key, histogram in self.histograms.items()
+            }
+            counters = {
+                key: (total, self.window_counters[key].window(now)[1])
+                for key, total in self.counters.items()
+            }
+        return histograms, counters
+
+
+registry = Registry()
+
+
+class MetricsMiddleware:
+    """Collect per-request metrics; removed at startup unless ``METRICS_ENABLED``"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not ENABLED:
+            raise MiddlewareNotUsed()
+        from django.db import connections
+        from django.db.backends.signals import connection_created
+
+        connection_created.connect(_track_connection)
+        for connection in connections.all():
+            _track_connection(connection)
+
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = _current.set(RequestMetrics())
+        started = time.perf_counter()
+        try:
+            return self.get_response(request)
+        finally:
+            self._finish(request, started, token)
+
+    async def __acall__(self, request):
+        token = _current.set(RequestMetrics())
+        started = time.perf_counter()
+        try:
+            return await self.get_response(request)
+        finally:
+            self._finish(request, started, token)
+
+    def _finish(self, request, started, token):
+        record = _current.get()
+        _current.reset(token)
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match is not None else 'unmatched'
+        registry.record_request(view, time.perf_counter() - started, record)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def prometheus_text(prefix='dashboard'):
+    """All metrics in the Prometheus text exposition format"""
+    histograms, counters = registry.snapshot()
+    lines = []
+    by_name = defaultdict(list)
+    for (name, labels), value in histograms.items():
+        by_name[name].append((labels, value))
+    for name in sorted(by_name):
+        lines.append(f'# TYPE {prefix}_{name} histogram')
+        for labels, (buckets, counts, total, count, _, _) in sorted(by_name[name]):
+            cumulative = 0
+            for bound, bucket in zip(buckets + ('+Inf',), counts):
+                cumulative += bucket
+                lines.append(f'{prefix}_{name}_bucket{_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{prefix}_{name}_sum{_labels(labels)} {total}')
+            lines.append(f'{prefix}_{name}_count{_labels(labels)} {count}')
+
+    by_name = defaultdict(list)
+    for (name, labels), (total, _) in counters.items():
+        by_name[name].append((labels, total))
+    for name in sorted(by_name):
+        lines.append(f'# TYPE {prefix}_{name}_total counter')
+        for labels, total in sorted(by_name[name]):
+            lines.append(f'{prefix}_{name}_total{_labels(labels)} {total}')
+    return '\n'.join(lines) + '\n'
+
+
+def _ms(seconds):
+    return None if seconds is None or seconds == float('inf') else round(seconds * 1000, 1)
+
+
+def window_summary():
+    """Per-view and per-cache-prefix figures over the rolling window, for the staff page
+
+    Percentiles are histogram bucket bounds, so they are upper estimates;
+    averages are per request, including requests that never ran the timer.
+    """
+    histograms, counters = registry.snapshot()
+    views = defaultdict(dict)
+    for (name, labels), (_, _, _, _, (_, total, count), quantiles) in histograms.items():
+        view = dict(labels).get('view')
+        if view is not None:
+            views[view][name] = (total, count, quantiles)
+
+    view_rows = []
+    for view, series in views.items():
+        total, requests, quantiles = series.get('request_seconds', (0.0, 0, {}))
+        if not requests:
+            continue
+
+        def mean(name, scale=1000):
+            return round(series.get(name, (0.0,))[0] / requests * scale, 1)
+
+        view_rows.append({
+            'view': view,
+            'requests': requests,
+            'mean_ms': _ms(total / requests),
+            'p50_ms': _ms(quantiles.get(0.5)),
+            'p95_ms': _ms(quantiles.get(0.95)),
+            'p99_ms': _ms(quantiles.get(0.99)),
+            'queries': mean('db_queries', scale=1),
+            'db_ms': mean('db_seconds'),
+            'read_ms': mean('pandas_read_seconds'),
+            'stats_ms': mean('stats_seconds'),
+        })
+    view_rows.sort(key=lambda row: -row['requests'])
+
+    caches = defaultdict(lambda: defaultdict(int))
+    for (name, labels), (_, recent) in counters.items():
+        if name == 'cache_lookups':
+            labels = dict(labels)
+            caches[labels['prefix']][labels['outcome']] += int(recent)
+    cache_rows = []
+    for prefix, outcomes in sorted(caches.items()):
+        lookups = sum(outcomes.values())
+        misses = outcomes.get('miss', 0) + outcomes.get('refresh', 0)
+        cache_rows.append({
+            'prefix': prefix,
+            'lookups': lookups,
+            'hit_local': outcomes.get('hit_local', 0),
+            'hit_shared': outcomes.get('hit_shared', 0),
+            'hit_other': outcomes.get('hit_stale', 0) + outcomes.get('hit_wait', 0),
+            'misses': misses,
+            'hit_ratio': round(100 * (lookups - misses) / lookups, 1) if lookups else None,
+        })
+    return {'views': view_rows, 'caches': cache_rows, 'window_minutes': WINDOW_SECONDS // 60}
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:38
+
+from django.db import migrations, models
+
+
+def mark_existing_ready(apps, schema_editor):
+    # Uploads made before the job queue existed were processed inline
+    DataUpload = apps.get_model('dashboard', 'DataUpload')
+    DataUpload.objects.update(status='ready', progress=100)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataupload',
+            name='progress',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='dataupload',
+            name='row_count',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='dataupload',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('processing', 'Processing'), ('ready', 'Ready'), ('failed', 'Failed')], default='queued', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='dataupload',
+            name='status_message',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.RunPython(mark_existing_ready, migrations.RunPython.noop),
+    ]
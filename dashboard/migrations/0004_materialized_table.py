@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:45
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0003_upload_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MaterializedTable',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sheet_name', models.CharField(default='Sheet1', max_length=100)),
+                ('table_name', models.CharField(max_length=100, unique=True)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('processing', 'Processing'), ('ready', 'Ready'), ('failed', 'Failed')], default='queued', max_length=20)),
+                ('status_message', models.CharField(blank=True, default='', max_length=255)),
+                ('row_count', models.PositiveIntegerField(default=0)),
+                ('indexed_columns', models.JSONField(blank=True, default=list)),
+                ('content_hash', models.CharField(blank=True, default='', max_length=64)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('upload', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tables', to='dashboard.dataupload')),
+            ],
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0004_materialized_table'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='datapreview',
+            index=models.Index(fields=['upload', 'sheet_name'], name='dashboard_preview_sheet_idx'),
+        ),
+    ]
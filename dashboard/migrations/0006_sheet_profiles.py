@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0005_preview_sheet_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataupload',
+            name='sheet_names',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.CreateModel(
+            name='SheetProfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sheet_name', models.CharField(max_length=100)),
+                ('position', models.PositiveSmallIntegerField(default=0)),
+                ('row_count', models.PositiveIntegerField(default=0)),
+                ('column_count', models.PositiveIntegerField(default=0)),
+                ('profile', models.JSONField(default=dict)),
+                ('content_hash', models.CharField(blank=True, default='', max_length=64)),
+                ('upload', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sheets', to='dashboard.dataupload')),
+            ],
+            options={
+                'ordering': ['position'],
+                'constraints': [models.UniqueConstraint(fields=('upload', 'sheet_name'), name='dashboard_unique_sheet_profile')],
+            },
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:53
+
+import os
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Sum
+
+
+def backfill_rollups(apps, schema_editor):
+    # Existing uploads: read size and type from disk once, then total them up
+    DataUpload = apps.get_model('dashboard', 'DataUpload')
+    UploadRollup = apps.get_model('dashboard', 'UploadRollup')
+    for upload in DataUpload.objects.all():
+        upload.file_extension = os.path.splitext(upload.file.name)[1].lower().lstrip('.')[:10]
+        try:
+            upload.file_size = upload.file.size
+        except (OSError, ValueError):
+            upload.file_size = 0
+        upload.save(update_fields=['file_extension', 'file_size'])
+    
+    totals = DataUpload.objects.values('file_extension').annotate(
+        count=Count('id'), size=Sum('file_size'), latest=Max('uploaded_at'),
+    )
+    UploadRollup.objects.bulk_create([
+        UploadRollup(
+            extension=row['file_extension'],
+            upload_count=row['count'],
+            total_size=row['size'] or 0,
+            latest_upload_at=row['latest'],
+        )
+        for row in totals
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0006_sheet_profiles'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('extension', models.CharField(max_length=10, unique=True)),
+                ('upload_count', models.PositiveIntegerField(default=0)),
+                ('total_size', models.PositiveBigIntegerField(default=0)),
+                ('latest_upload_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='dataupload',
+            name='file_extension',
+            field=models.CharField(blank=True, default='', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='dataupload',
+            name='file_size',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
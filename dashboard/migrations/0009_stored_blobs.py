@@ -0,0 +1,54 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:56
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def backfill_blobs(apps, schema_editor):
+    # Hashed uploads become blobs; copies already stored at other paths keep their own file
+    DataUpload = apps.get_model('dashboard', 'DataUpload')
+    StoredBlob = apps.get_model('dashboard', 'StoredBlob')
+    for upload in DataUpload.objects.exclude(content_hash='').filter(blob__isnull=True).order_by('pk'):
+        if StoredBlob.objects.filter(sha256=upload.content_hash).exists():
+            continue
+        sharing = DataUpload.objects.filter(file=upload.file.name)
+        blob = StoredBlob.objects.create(
+            sha256=upload.content_hash,
+            file=upload.file.name,
+            size=upload.file_size,
+            ref_count=sharing.count(),
+        )
+        sharing.update(blob=blob)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0008_upload_session'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('file', models.FileField(upload_to='uploads/%Y/%m/%d/')),
+                ('size', models.PositiveBigIntegerField(default=0)),
+                ('ref_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='dataupload',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='dataupload',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='uploads', to='dashboard.storedblob'),
+        ),
+        migrations.RunPython(backfill_blobs, migrations.RunPython.noop),
+    ]
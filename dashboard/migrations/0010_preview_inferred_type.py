@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0009_stored_blobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datapreview',
+            name='inferred_type',
+            field=models.CharField(blank=True, default='', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='datapreview',
+            name='nullable',
+            field=models.BooleanField(default=True),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+from dashboard.listing import FTS_TABLE, install_title_search
+
+
+def create_title_search(apps, schema_editor):
+    install_title_search(schema_editor.connection)
+
+
+def drop_title_search(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for trigger in ('insert', 'delete', 'update'):
+        schema_editor.execute(f'DROP TRIGGER IF EXISTS {FTS_TABLE}_{trigger}')
+    schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0010_preview_inferred_type'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='dataupload',
+            index=models.Index(fields=['uploaded_at', 'id'], name='dashboard_upload_recent_idx'),
+        ),
+        migrations.RunPython(create_title_search, drop_title_search),
+    ]
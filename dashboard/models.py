@@ -1,17 +1,62 @@
 from django.db import models
 from django.utils import timezone
 import os
+import uuid
+
+class StoredBlob(models.Model):
+    """One stored file, shared by every upload with the same content"""
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to='uploads/%Y/%m/%d/')
+    size = models.PositiveBigIntegerField(default=0)
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.sha256
 
 class DataUpload(models.Model):
     """Model to store uploaded data files"""
+    STATUS_QUEUED = 'queued'
+    STATUS_PROCESSING = 'processing'
+    STATUS_READY = 'ready'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_PROCESSING, 'Processing'),
+        (STATUS_READY, 'Ready'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
     title = models.CharField(max_length=255)
     description = models.TextField(blank=True, null=True)
     file = models.FileField(upload_to='uploads/%Y/%m/%d/')
     uploaded_at = models.DateTimeField(default=timezone.now)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    progress = models.PositiveSmallIntegerField(default=0)
+    status_message = models.CharField(max_length=255, blank=True, default='')
+    row_count = models.PositiveIntegerField(blank=True, null=True)
+    content_hash = models.CharField(max_length=64, blank=True, default='', db_index=True)
+    sheet_names = models.JSONField(default=list, blank=True)
+    blob = models.ForeignKey(StoredBlob, on_delete=models.PROTECT, blank=True, null=True, related_name='uploads')
+    file_size = models.PositiveBigIntegerField(default=0)
+    file_extension = models.CharField(max_length=10, blank=True, default='')
+    
+    class Meta:
+        indexes = [
+            # Keyset pagination of the upload list (see listing.py)
+            models.Index(fields=['uploaded_at', 'id'], name='dashboard_upload_recent_idx'),
+        ]
     
     def __str__(self):
         return self.title
     
+    def save(self, *args, **kwargs):
+        # Record size and type once so listings never touch the file
+        if self.file and not self.file_extension:
+            self.file_extension = self.get_extension().lstrip('.')[:10]
+            self.file_size = self.file.size
+        super().save(*args, **kwargs)
+    
     def filename(self):
         if self.file:
             return os.path.basename(self.file.name)
@@ -23,13 +68,97 @@ class DataUpload(models.Model):
             return extension.lower()
         return ""
 
+    def is_ready(self):
+        return self.status == self.STATUS_READY
+
+    def set_status(self, status, progress=None, message=''):
+        """Update the ingestion status without touching other fields"""
+        self.status = status
+        self.status_message = message[:255]
+        fields = {'status': status, 'status_message': self.status_message}
+        if progress is not None:
+            self.progress = progress
+            fields['progress'] = progress
+        DataUpload.objects.filter(pk=self.pk).update(**fields)
+
+class UploadRollup(models.Model):
+    """Running upload totals per file extension, kept current by signals"""
+    extension = models.CharField(max_length=10, unique=True)
+    upload_count = models.PositiveIntegerField(default=0)
+    total_size = models.PositiveBigIntegerField(default=0)
+    latest_upload_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return self.extension or 'none'
+
 class DataPreview(models.Model):
     """Model to store preview data from uploads"""
     upload = models.ForeignKey(DataUpload, on_delete=models.CASCADE, related_name='previews')
     sheet_name = models.CharField(max_length=100, default='Sheet1')
     column_name = models.CharField(max_length=100)
     column_data_type = models.CharField(max_length=50)
+    # Type inferred from values sampled across the whole sheet (see schema.py)
+    inferred_type = models.CharField(max_length=20, blank=True, default='')
+    nullable = models.BooleanField(default=True)
     sample_data = models.TextField(blank=True, null=True)
     
+    class Meta:
+        indexes = [
+            models.Index(fields=['upload', 'sheet_name'], name='dashboard_preview_sheet_idx'),
+        ]
+    
     def __str__(self):
         return f"{self.upload.title} - {self.column_name}"
+
+class SheetProfile(models.Model):
+    """Profile of one sheet, computed during ingestion"""
+    upload = models.ForeignKey(DataUpload, on_delete=models.CASCADE, related_name='sheets')
+    sheet_name = models.CharField(max_length=100)
+    position = models.PositiveSmallIntegerField(default=0)
+    row_count = models.PositiveIntegerField(default=0)
+    column_count = models.PositiveIntegerField(default=0)
+    profile = models.JSONField(default=dict)
+    content_hash = models.CharField(max_length=64, blank=True, default='')
+
+    class Meta:
+        ordering = ['position']
+        constraints = [
+            models.UniqueConstraint(fields=['upload', 'sheet_name'], name='dashboard_unique_sheet_profile'),
+        ]
+
+    def __str__(self):
+        return f"{self.upload.title} - {self.sheet_name}"
+
+class MaterializedTable(models.Model):
+    """SQLite table holding the full rows of an upload"""
+    upload = models.ForeignKey(DataUpload, on_delete=models.CASCADE, related_name='tables')
+    sheet_name = models.CharField(max_length=100, default='Sheet1')
+    table_name = models.CharField(max_length=100, unique=True)
+    status = models.CharField(max_length=20, choices=DataUpload.STATUS_CHOICES, default=DataUpload.STATUS_QUEUED)
+    status_message = models.CharField(max_length=255, blank=True, default='')
+    row_count = models.PositiveIntegerField(default=0)
+    indexed_columns = models.JSONField(default=list, blank=True)
+    content_hash = models.CharField(max_length=64, blank=True, default='')
+    created_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.table_name
+
+    def is_ready(self):
+        return self.status == DataUpload.STATUS_READY
+
+class UploadSession(models.Model):
+    """A chunked upload whose chunks are written into the upload's file"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    upload = models.OneToOneField(DataUpload, on_delete=models.CASCADE, related_name='upload_session')
+    total_size = models.PositiveBigIntegerField()
+    received = models.PositiveBigIntegerField(default=0)
+    sha256 = models.CharField(max_length=64, blank=True, default='')
+    created_at = models.DateTimeField(default=timezone.now)
+    completed_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"{self.upload.title} ({self.received}/{self.total_size} bytes)"
+
+    def is_complete(self):
+        return self.completed_at is not None
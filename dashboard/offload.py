@@ -0,0 +1,57 @@
+"""
+Bounded thread pool for the heavy work of async views.
+
+Under ASGI the preview views run on the event loop. Parsing a file,
+building a profile or scanning a sidecar is handed to this pool, so at
+most ``PREVIEW_WORKERS`` such reads run at once however many requests
+arrive; the rest queue for a free worker. Viewers of cached pages, row
+windows or progress events never wait behind them, since only the parse
+itself goes through the pool.
+"""
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+_executor = None
+_executor_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_executor():
+    """Return the shared thread pool, creating it on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'PREVIEW_WORKERS', 4),
+                thread_name_prefix='preview',
+            )
+        return _executor
+
+
+def _run(func, args, kwargs):
+    # Pool threads live outside the request cycle, so tidy their connections here
+    _local.in_pool = True
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+def call_bounded(func, *args, **kwargs):
+    """Run ``func`` on the pool and wait for it; inline when already on the pool"""
+    if getattr(_local, 'in_pool', False):
+        return func(*args, **kwargs)
+    # Carry the caller's context (request metrics) over to the pool thread
+    context = contextvars.copy_context()
+    return get_executor().submit(context.run, _run, func, args, kwargs).result()
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Await ``func(*args, **kwargs)`` run on the bounded pool"""
+    return await sync_to_async(_run, thread_sensitive=False, executor=get_executor())(func, args, kwargs)
@@ -0,0 +1,223 @@
+"""Ingestion steps run for every upload (see jobs.ingest_upload)"""
+import json
+from functools import partial
+
+from django.db import transaction
+
+from .columnar import build_sidecars, file_sha256, iter_sidecar_chunks, open_sidecar
+from .database import retry_write
+from .models import DataPreview, DataUpload, SheetProfile
+from .profiling import approximate_profiles, profile_sidecar, profile_upload, to_json_safe
+from .rowindex import build_row_index
+from .schema import infer_sidecar_schema, null_counts
+
+# Rows read from each sheet to describe its columns
+METADATA_ROWS = 100
+
+
+def process_excel_file(data_upload, progress=None):
+    """Process uploaded Excel file and extract preview data
+
+    Every sheet is converted to its columnar sidecar (opening the workbook
+    once), described in DataPreview and profiled, with the sheets profiled
+    in parallel. Returns the total number of data rows. Raises on
+    unreadable or unsupported files so the caller can mark the upload as
+    failed.
+    """
+    from .jobs import run_parallel
+
+    report = progress or (lambda percent, message='': None)
+
+    report(10, 'Converting to columnar format')
+    # Stored blobs are hashed on arrival and never change afterwards
+    content_hash = data_upload.content_hash if data_upload.blob_id else file_sha256(data_upload.file.path)
+    sheets = build_sidecars(data_upload, content_hash=content_hash)
+    sheet_names = [str(name) for name, _ in sheets]
+    data_upload.content_hash = content_hash
+    data_upload.sheet_names = sheet_names
+    DataUpload.objects.filter(pk=data_upload.pk).update(content_hash=content_hash, sheet_names=sheet_names)
+
+    if data_upload.get_extension() == '.csv':
+        report(35, 'Indexing rows')
+        build_row_index(data_upload.file.path, sheets[0][1])
+
+    report(40, 'Storing column metadata')
+    # Drop metadata of sheets that no longer exist, then replace the others
+    DataPreview.objects.filter(upload=data_upload).exclude(sheet_name__in=sheet_names).delete()
+    for sheet_name, path in zip(sheet_names, [path for _, path in sheets]):
+        save_column_metadata(data_upload, sheet_name, describe_columns(path))
+
+    report(60, f'Profiling {len(sheets)} sheet(s)')
+    profiles = run_parallel(partial(profile_sidecar, approximate=approximate_profiles()), [path for _, path in sheets])
+    save_sheet_profiles(data_upload, list(zip(sheet_names, profiles)))
+
+    return sum(open_sidecar(path).metadata.num_rows for _, path in sheets)
+
+
+@retry_write
+def copy_ingestion(data_upload):
+    """Reuse the results of a processed upload of the same blob
+
+    Returns False (and changes nothing) when there is no such upload.
+    """
+    if data_upload.blob_id is None:
+        return False
+    # Uploads ingested before sheet profiles existed are not reused
+    twin = (
+        DataUpload.objects.filter(blob_id=data_upload.blob_id, status=DataUpload.STATUS_READY, sheets__isnull=False)
+        .exclude(pk=data_upload.pk)
+        .distinct()
+        .order_by('-uploaded_at')
+        .first()
+    )
+    if twin is None:
+        return False
+
+    with transaction.atomic():
+        DataPreview.objects.filter(upload=data_upload).delete()
+        SheetProfile.objects.filter(upload=data_upload).delete()
+        DataPreview.objects.bulk_create([
+            DataPreview(
+                upload=data_upload,
+                sheet_name=preview.sheet_name,
+                column_name=preview.column_name,
+                column_data_type=preview.column_data_type,
+                inferred_type=preview.inferred_type,
+                nullable=preview.nullable,
+                sample_data=preview.sample_data,
+            )
+            for preview in twin.previews.all()
+        ])
+        SheetProfile.objects.bulk_create([
+            SheetProfile(
+                upload=data_upload,
+                sheet_name=sheet.sheet_name,
+                position=sheet.position,
+                row_count=sheet.row_count,
+                column_count=sheet.column_count,
+                profile=sheet.profile,
+                content_hash=sheet.content_hash,
+            )
+            for sheet in twin.sheets.all()
+        ])
+        data_upload.content_hash = twin.content_hash
+        data_upload.sheet_names = twin.sheet_names
+        data_upload.row_count = twin.row_count
+        DataUpload.objects.filter(pk=data_upload.pk).update(
+            content_hash=twin.content_hash,
+            sheet_names=twin.sheet_names,
+            row_count=twin.row_count,
+        )
+        data_upload.set_status(DataUpload.STATUS_READY, progress=100)
+    return True
+
+
+def describe_columns(path):
+    """``(column_name, data_type, inferred_type, nullable, sample_json)`` for each column of a sidecar"""
+    df = next(iter_sidecar_chunks(path, chunksize=METADATA_ROWS), None)
+    if df is None:
+        return []
+    parquet = open_sidecar(path)
+    types = infer_sidecar_schema(parquet)
+    nulls = null_counts(parquet)
+    columns = []
+    for column in df.columns:
+        # Optimize sample data storage by using JSON serialization
+        # and limiting to first 3 non-null values when possible
+        sample_values = df[column].dropna().head(3).tolist()
+        inferred_type = types.get(column, '')
+        # Unknown null counts are treated as nullable
+        nullable = nulls.get(column) is None or nulls[column] > 0
+        columns.append((
+            column, str(df[column].dtype), inferred_type, nullable, json.dumps(sample_values, default=str),
+        ))
+    return columns
+
+
+@retry_write
+def save_column_metadata(data_upload, sheet_name, columns):
+    """Replace the DataPreview rows of one sheet in a single transaction
+
+    ``columns`` is a list of ``(column_name, data_type, inferred_type,
+    nullable, sample_json)``.
+    Existing rows are updated in place, new columns are bulk-inserted and
+    columns that disappeared are deleted, so re-processing an upload costs
+    a handful of statements however wide the sheet is.
+    """
+    with transaction.atomic():
+        existing = {
+            preview.column_name: preview
+            for preview in DataPreview.objects.filter(upload=data_upload, sheet_name=sheet_name)
+        }
+        to_create, to_update = [], []
+        for column_name, data_type, inferred_type, nullable, sample in columns:
+            column_name = str(column_name)
+            preview = existing.pop(column_name, None)
+            if preview is None:
+                to_create.append(DataPreview(
+                    upload=data_upload,
+                    sheet_name=sheet_name,
+                    column_name=column_name,
+                    column_data_type=data_type,
+                    inferred_type=inferred_type,
+                    nullable=nullable,
+                    sample_data=sample,
+                ))
+            elif (preview.column_data_type, preview.inferred_type, preview.nullable, preview.sample_data) != (
+                    data_type, inferred_type, nullable, sample):
+                preview.column_data_type = data_type
+                preview.inferred_type = inferred_type
+                preview.nullable = nullable
+                preview.sample_data = sample
+                to_update.append(preview)
+
+        if existing:
+            DataPreview.objects.filter(pk__in=[p.pk for p in existing.values()]).delete()
+        if to_update:
+            DataPreview.objects.bulk_update(
+                to_update, ['column_data_type', 'inferred_type', 'nullable', 'sample_data'],
+            )
+        if to_create:
+            DataPreview.objects.bulk_create(to_create)
+
+
+@retry_write
+def save_sheet_profiles(data_upload, profiles):
+    """Replace the stored profiles of an upload with ``[(sheet_name, profile), ...]``"""
+    with transaction.atomic():
+        SheetProfile.objects.filter(upload=data_upload).delete()
+        SheetProfile.objects.bulk_create([
+            SheetProfile(
+                upload=data_upload,
+                sheet_name=sheet_name,
+                position=position,
+                row_count=profile['stats']['row_count'],
+                column_count=profile['stats']['column_count'],
+                profile=profile,
+                content_hash=data_upload.content_hash,
+            )
+            for position, (sheet_name, profile) in enumerate(profiles)
+        ])
+
+
+def get_sheet_profile(data_upload, sheet_name):
+    """Stored profile of a sheet, profiling (and storing) it if missing, stale or made in the other mode"""
+    approximate = approximate_profiles()
+    stored = SheetProfile.objects.filter(upload=data_upload, sheet_name=sheet_name).first()
+    if (stored is not None and stored.content_hash == data_upload.content_hash
+            and stored.profile['stats'].get('approximate', False) == approximate):
+        return stored.profile
+
+    profile = to_json_safe(profile_upload(data_upload, sheet=sheet_name, approximate=approximate))
+    SheetProfile.objects.update_or_create(
+        upload=data_upload,
+        sheet_name=sheet_name,
+        defaults={
+            'position': data_upload.sheet_names.index(sheet_name) if sheet_name in data_upload.sheet_names else 0,
+            'row_count': profile['stats']['row_count'],
+            'column_count': profile['stats']['column_count'],
+            'profile': profile,
+            'content_hash': data_upload.content_hash,
+        },
+    )
+    return profile
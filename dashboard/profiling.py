@@ -0,0 +1,503 @@
+"""
+Single-pass streaming profiler for uploaded files.
+
+Column statistics are built from mergeable accumulators, so a file is read
+chunk by chunk exactly once and peak memory depends on the chunk size, not
+the file size. ``profile_upload`` returns the same ``stats`` /
+``column_stats`` structure that ``data_preview.html`` renders, including a
+histogram and quantiles of each numeric column and the most common values
+of each categorical one, so the charts never go back to the file.
+
+The accumulators of a profiled sidecar are also stored next to it, as
+numpy arrays and plain JSON, so rows appended later are profiled on their
+own and merged in (see appending.py).
+
+With ``PROFILE_MODE = 'approximate'`` every column gets fixed-size
+sketches instead (see sketches.py): HyperLogLog distinct counts, the most
+common values with error bounds, and smaller quantile sketches. Each
+statistic reports its error bound.
+"""
+import json
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from .metrics import timed
+from .readers import iter_chunks
+from .sketches import (
+    Histogram, HyperLogLog, QuantileSketch, SpaceSaving, decode_value, encode_value, hash_values, series_from_state,
+    series_state,
+)
+
+PROFILE_EXACT = 'exact'
+PROFILE_APPROXIMATE = 'approximate'
+
+# Number of sample rows kept for the preview table
+SAMPLE_ROWS = 50
+
+# Hashes kept by the distinct-value sketch; counts are exact below this
+DISTINCT_SKETCH_SIZE = 4096
+
+# Candidate values tracked for the "most common" statistic
+TOP_VALUES_CAPACITY = 1000
+
+# Distribution of numeric columns: quantiles reported, and most bins drawn
+QUANTILES = {'p1': 0.01, 'p25': 0.25, 'p50': 0.5, 'p75': 0.75, 'p99': 0.99}
+HISTOGRAM_BINS = 20
+# Quantile sketch size in exact mode: rank error about 0.3% (sketches.KLL_K in approximate mode)
+PRECISE_QUANTILE_K = 1000
+
+# Most common values listed for text columns
+TOP_VALUES_SHOWN = 10
+
+# Bumped whenever the stored accumulators change shape
+PROFILER_STATE_FORMAT = 4
+
+
+def approximate_profiles():
+    """True when new profiles should use sketches (``PROFILE_MODE = 'approximate'``)"""
+    from django.conf import settings
+
+    return getattr(settings, 'PROFILE_MODE', PROFILE_EXACT) == PROFILE_APPROXIMATE
+
+
+class DistinctSketch:
+    """K-minimum-values sketch of the number of distinct values
+
+    Keeps the ``k`` smallest 64-bit value hashes. Below ``k`` distinct values
+    the count is exact; above it the relative error is about 1/sqrt(k).
+    """
+
+    def __init__(self, k=DISTINCT_SKETCH_SIZE):
+        self.k = k
+        self.hashes = np.empty(0, dtype=np.uint64)
+
+    def update(self, series):
+        self._absorb(np.unique(hash_values(series)))
+
+    def merge(self, other):
+        self._absorb(other.hashes)
+
+    def _absorb(self, hashes):
+        merged = np.union1d(self.hashes, hashes)
+        self.hashes = merged[:self.k]
+
+    def to_state(self):
+        return {'k': self.k, 'hashes': self.hashes}
+
+    @classmethod
+    def from_state(cls, state):
+        sketch = cls(state['k'])
+        sketch.hashes = np.asarray(state['hashes'], dtype=np.uint64)
+        return sketch
+
+    def estimate(self):
+        if len(self.hashes) < self.k:
+            return len(self.hashes)
+        kth = float(self.hashes[-1]) / 2.0 ** 64
+        return int(round((self.k - 1) / kth))
+
+
+class TopValues:
+    """Bounded frequency table used to find the most common values
+
+    Counts are exact until the column has more than twice ``capacity``
+    distinct values; after that only the heaviest candidates are kept and
+    ``exact`` is False.
+    """
+
+    def __init__(self, capacity=TOP_VALUES_CAPACITY):
+        self.capacity = capacity
+        self.counts = pd.Series(dtype='int64')
+        self.exact = True
+
+    def update(self, series):
+        self._absorb(series.value_counts(sort=False))
+
+    def merge(self, other):
+        self._absorb(other.counts)
+        self.exact = self.exact and other.exact
+
+    def to_state(self):
+        return {'capacity': self.capacity, 'exact': self.exact, **series_state(self.counts)}
+
+    @classmethod
+    def from_state(cls, state):
+        top = cls(state['capacity'])
+        top.counts = series_from_state(state['values'], state['counts'])
+        top.exact = state['exact']
+        return top
+
+    def _absorb(self, counts):
+        if len(self.counts):
+            counts = self.counts.add(counts, fill_value=0).astype('int64')
+        self.counts = counts
+        if len(counts) > 2 * self.capacity:
+            # Keep only the heaviest candidates so memory stays bounded
+            self.counts = counts.nlargest(self.capacity, keep='first')
+            self.exact = False
+
+    def most_common(self):
+        if not len(self.counts):
+            return None
+        return self.counts.idxmax()
+
+    def top(self, n):
+        """``[(value, count), ...]`` for the ``n`` most common values"""
+        return [(value, int(count)) for value, count in self.counts.nlargest(n, keep='first').items()]
+
+
+class ColumnAccumulator:
+    """Mergeable statistics for one column"""
+
+    def __init__(self, name, approximate=False):
+        self.name = name
+        self.approximate = approximate
+        self.dtype = None
+        self._dtype_from_values = False
+        self.count = 0
+        self.nulls = 0
+        self.min = None
+        self.max = None
+        # Running mean / variance (Chan et al. parallel update)
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.histogram = Histogram()
+        if approximate:
+            self.distinct = HyperLogLog()
+            self.top_values = SpaceSaving()
+            self.quantiles = QuantileSketch()
+        else:
+            self.distinct = DistinctSketch()
+            self.top_values = TopValues()
+            self.quantiles = QuantileSketch(k=PRECISE_QUANTILE_K)
+
+    def update(self, series):
+        """Fold one chunk of the column into the accumulator"""
+        non_null = series.dropna()
+        self.count += len(series)
+        self.nulls += len(series) - len(non_null)
+        self._merge_dtype(series.dtype, has_values=len(non_null) > 0)
+        if not len(non_null):
+            return
+
+        self.distinct.update(non_null)
+        if pd.api.types.is_numeric_dtype(non_null.dtype):
+            values = non_null.to_numpy(dtype='float64')
+            self._merge_range(non_null.min(), non_null.max())
+            chunk_mean = values.mean()
+            self._merge_moments(len(values), chunk_mean, ((values - chunk_mean) ** 2).sum())
+            if not pd.api.types.is_bool_dtype(non_null.dtype):
+                self.histogram.update(values)
+                self.quantiles.update(values)
+        else:
+            self.top_values.update(non_null)
+
+    def merge(self, other):
+        """Combine the accumulator of another part of the same column"""
+        self.count += other.count
+        self.nulls += other.nulls
+        if other.dtype is not None:
+            self._merge_dtype(other.dtype, has_values=other.count > other.nulls)
+        if other.min is not None:
+            self._merge_range(other.min, other.max)
+        if other.n:
+            self._merge_moments(other.n, other.mean, other.m2)
+        self.distinct.merge(other.distinct)
+        self.top_values.merge(other.top_values)
+        self.histogram.merge(other.histogram)
+        self.quantiles.merge(other.quantiles)
+
+    def to_state(self):
+        return {
+            'name': encode_value(self.name),
+            'approximate': self.approximate,
+            'dtype': None if self.dtype is None else str(self.dtype),
+            'dtype_from_values': self._dtype_from_values,
+            'count': self.count,
+            'nulls': self.nulls,
+            'min': encode_value(self.min),
+            'max': encode_value(self.max),
+            'n': self.n,
+            'mean': float(self.mean),
+            'm2': float(self.m2),
+            'distinct': self.distinct.to_state(),
+            'top_values': self.top_values.to_state(),
+            'histogram': self.histogram.to_state(),
+            'quantiles': self.quantiles.to_state(),
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        accumulator = cls(decode_value(state['name']), state['approximate'])
+        accumulator.dtype = None if state['dtype'] is None else pd.api.types.pandas_dtype(state['dtype'])
+        accumulator._dtype_from_values = state['dtype_from_values']
+        accumulator.count, accumulator.nulls = state['count'], state['nulls']
+        accumulator.min, accumulator.max = decode_value(state['min']), decode_value(state['max'])
+        accumulator.n, accumulator.mean, accumulator.m2 = state['n'], state['mean'], state['m2']
+        accumulator.distinct = type(accumulator.distinct).from_state(state['distinct'])
+        accumulator.top_values = type(accumulator.top_values).from_state(state['top_values'])
+        accumulator.histogram = Histogram.from_state(state['histogram'])
+        accumulator.quantiles = QuantileSketch.from_state(state['quantiles'])
+        return accumulator
+
+    def _merge_dtype(self, dtype, has_values):
+        # All-null chunks say nothing about the column's real type
+        if self.dtype is None:
+            self.dtype = dtype
+            self._dtype_from_values = has_values
+        elif not has_values or self.dtype == dtype:
+            return
+        elif not self._dtype_from_values:
+            self.dtype = dtype
+            self._dtype_from_values = True
+        elif pd.api.types.is_numeric_dtype(self.dtype) and pd.api.types.is_numeric_dtype(dtype):
+            self.dtype = np.promote_types(self.dtype, dtype)
+        else:
+            self.dtype = np.dtype('object')
+
+    def _merge_range(self, low, high):
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+
+    def _merge_moments(self, n, mean, m2):
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta ** 2 * self.n * n / total
+        self.n = total
+
+    @property
+    def variance(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else 0.0
+
+    def to_stats(self):
+        """Render the accumulator in the shape used by data_preview.html"""
+        null_percentage = round((self.nulls / self.count) * 100, 2) if self.count else 0
+        col_type = str(self.dtype)
+        if pd.api.types.is_numeric_dtype(self.dtype):
+            empty = self.n == 0
+            stats = {
+                'name': self.name,
+                'type': col_type,
+                'min': 'N/A' if empty else self.min,
+                'max': 'N/A' if empty else self.max,
+                'mean': 'N/A' if empty else self.mean,
+                'std': 'N/A' if empty else float(np.sqrt(self.variance)),
+                'null_count': self.nulls,
+                'null_percentage': null_percentage,
+            }
+            if self.quantiles.n:
+                edges, counts = self.histogram.bins(HISTOGRAM_BINS)
+                stats['histogram'] = {'edges': edges, 'counts': counts}
+                stats['quantiles'] = dict(zip(QUANTILES, self.quantiles.quantiles(list(QUANTILES.values()))))
+                stats['rank_error'] = self.quantiles.rank_error
+            return stats
+
+        unique_values = self.distinct.estimate()
+        if self.approximate:
+            top = self.top_values.top(TOP_VALUES_SHOWN)
+        else:
+            # Counts of a trimmed table are no longer exact
+            top = [(value, count, 0) for value, count in self.top_values.top(TOP_VALUES_SHOWN)] if self.top_values.exact else []
+        if 0 < unique_values < self.count / 2:
+            most_common = self.top_values.most_common()
+        else:
+            most_common = 'Too many to display'
+        stats = {
+            'name': self.name,
+            'type': col_type,
+            'unique_values': unique_values,
+            'most_common': most_common,
+            'null_count': self.nulls,
+            'null_percentage': null_percentage,
+        }
+        if self.approximate:
+            # 95% bound, as a fraction of the estimate
+            stats['unique_values_error'] = 2 * self.distinct.relative_error
+        if top:
+            stats['top_values'] = [{'value': value, 'count': count, 'error': error} for value, count, error in top]
+        return stats
+
+
+class TableProfiler:
+    """Streams DataFrame chunks into per-column accumulators"""
+
+    def __init__(self, sample_rows=SAMPLE_ROWS, approximate=False):
+        self.sample_rows = sample_rows
+        self.approximate = approximate
+        self.columns = []
+        self.accumulators = {}
+        self.row_count = 0
+        self.memory_bytes = 0
+        self.sample = []
+
+    def update(self, df):
+        for column in df.columns:
+            if column not in self.accumulators:
+                self.columns.append(column)
+                self.accumulators[column] = ColumnAccumulator(column, self.approximate)
+            self.accumulators[column].update(df[column])
+        self.row_count += len(df)
+        self.memory_bytes += int(df.memory_usage(deep=True).sum())
+        if len(self.sample) < self.sample_rows:
+            self.sample.extend(df.head(self.sample_rows - len(self.sample)).to_dict('records'))
+
+    def merge(self, other):
+        for column in other.columns:
+            if column not in self.accumulators:
+                self.columns.append(column)
+                self.accumulators[column] = ColumnAccumulator(column, self.approximate)
+            self.accumulators[column].merge(other.accumulators[column])
+        self.row_count += other.row_count
+        self.memory_bytes += other.memory_bytes
+        if len(self.sample) < self.sample_rows:
+            self.sample.extend(other.sample[:self.sample_rows - len(self.sample)])
+
+    def to_state(self):
+        return {
+            'sample_rows': self.sample_rows,
+            'approximate': self.approximate,
+            'row_count': self.row_count,
+            'memory_bytes': self.memory_bytes,
+            'columns': [self.accumulators[column].to_state() for column in self.columns],
+            'sample': [[[encode_value(key), encode_value(value)] for key, value in row.items()] for row in self.sample],
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        profiler = cls(sample_rows=state['sample_rows'], approximate=state['approximate'])
+        for column_state in state['columns']:
+            accumulator = ColumnAccumulator.from_state(column_state)
+            profiler.columns.append(accumulator.name)
+            profiler.accumulators[accumulator.name] = accumulator
+        profiler.row_count, profiler.memory_bytes = state['row_count'], state['memory_bytes']
+        profiler.sample = [{decode_value(key): decode_value(value) for key, value in row} for row in state['sample']]
+        return profiler
+
+    def result(self):
+        return {
+            'stats': {
+                'row_count': self.row_count,
+                'column_count': len(self.columns),
+                'memory_usage': self.memory_bytes / (1024 * 1024),  # MB
+                'approximate': self.approximate,
+            },
+            'column_stats': [self.accumulators[col].to_stats() for col in self.columns],
+            'sample_data': self.sample,
+            'columns': list(self.columns),
+        }
+
+
+def build_profiler(chunks, sample_rows=SAMPLE_ROWS, approximate=False):
+    """Fold every chunk into a ``TableProfiler`` and return it"""
+    profiler = TableProfiler(sample_rows=sample_rows, approximate=approximate)
+    chunks = iter(chunks)
+    while True:
+        # Reading the next chunk and folding it into the profile are timed apart
+        with timed('pandas_read'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        with timed('stats'):
+            profiler.update(chunk)
+    return profiler
+
+
+def profile_chunks(chunks, sample_rows=SAMPLE_ROWS, approximate=False):
+    profiler = build_profiler(chunks, sample_rows=sample_rows, approximate=approximate)
+    with timed('stats'):
+        return profiler.result()
+
+
+def profile_upload(upload, sheet=None, approximate=False):
+    """Profile one sheet of an upload in a single streaming pass"""
+    return profile_chunks(iter_chunks(upload, sheet=sheet), approximate=approximate)
+
+
+def profile_sidecar(path, approximate=False):
+    """Profile a Parquet sidecar and keep its accumulators; needs no Django, so it can run in a pool process"""
+    from .columnar import iter_sidecar_chunks, sidecar_version
+
+    profiler = build_profiler(iter_sidecar_chunks(path), approximate=approximate)
+    save_profiler(path, profiler, sidecar_version(path))
+    return to_json_safe(profiler.result())
+
+
+def profiler_state_path(sidecar):
+    """Stored accumulators of a sidecar's profile"""
+    return sidecar + '.state'
+
+
+def _pack(state, arrays):
+    """``state`` as JSON, with its numpy arrays moved into ``arrays`` and referenced by key"""
+    if isinstance(state, np.ndarray):
+        key = f'a{len(arrays)}'
+        arrays[key] = state
+        return {'array': key}
+    if isinstance(state, dict):
+        return {key: _pack(value, arrays) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return [_pack(value, arrays) for value in state]
+    if isinstance(state, np.generic):
+        return state.item()
+    return state
+
+
+def _unpack(state, arrays):
+    if isinstance(state, dict):
+        if state.keys() == {'array'}:
+            return arrays[state['array']]
+        return {key: _unpack(value, arrays) for key, value in state.items()}
+    if isinstance(state, list):
+        return [_unpack(value, arrays) for value in state]
+    return state
+
+
+def save_profiler(sidecar, profiler, version):
+    """Store the accumulators of ``sidecar``'s profile, tagged with its content ``version``
+
+    An ``.npz`` archive: the sketches' arrays, plus one JSON document
+    holding everything else. Nothing in it is executed when it is read.
+    """
+    arrays = {}
+    state = {'format': PROFILER_STATE_FORMAT, 'version': version, 'profiler': _pack(profiler.to_state(), arrays)}
+    target = profiler_state_path(sidecar)
+    temp = f'{target}.{os.getpid()}.tmp'
+    with open(temp, 'wb') as f:
+        np.savez(f, state=np.array(json.dumps(state)), **arrays)
+    os.replace(temp, target)
+
+
+def load_profiler(sidecar, version):
+    """Stored accumulators of ``sidecar`` if they match its content ``version``, else None"""
+    try:
+        with np.load(profiler_state_path(sidecar), allow_pickle=False) as archive:
+            state = json.loads(str(archive['state']))
+            if state.get('format') != PROFILER_STATE_FORMAT or state.get('version') != version:
+                return None
+            return TableProfiler.from_state(_unpack(state['profiler'], archive))
+    except (OSError, ValueError, KeyError, TypeError, zipfile.BadZipFile):
+        return None
+
+
+def to_json_safe(value):
+    """Convert a profile to plain JSON types (numpy scalars, timestamps, NaN)"""
+    if isinstance(value, dict):
+        return {str(k): to_json_safe(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json_safe(v) for v in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float):
+        return None if np.isnan(value) or np.isinf(value) else value
+    if value is None or isinstance(value, (str, int, bool)):
+        return value
+    if value is pd.NaT or value is pd.NA:
+        return None
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
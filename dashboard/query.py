@@ -0,0 +1,331 @@
+"""
+Aggregate queries over the rows of an upload.
+
+A query is a small JSON spec, for example::
+
+    {
+        "sheet": "Sales",
+        "where": ["year:eq:2025"],
+        "group_by": ["region"],
+        "aggregates": [{"op": "sum", "column": "revenue", "as": "revenue"}],
+        "order_by": ["-revenue"],
+        "limit": 100
+    }
+
+``where`` uses the grid's ``column:op:value`` filters (or ``[column, op,
+value]`` lists). Queries stream the sheet's Parquet sidecar in record
+batches. Only the referenced columns are read, and filters are pushed into
+the scan so row groups whose statistics rule them out are skipped. Each
+batch is reduced to per-group partial aggregates that are merged into a
+running result, so memory is bounded by the number of groups rather than
+the size of the file. Uploads without a usable sidecar fall back to the
+chunked source readers.
+"""
+import logging
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from .columnar import BATCH_ROWS, _chunk_table, ensure_sidecar
+from .grid import FILTER_OPS, GridError, parse_filters
+from .profiling import to_json_safe
+from .readers import iter_source_chunks
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUERY_LIMIT = 1000
+MAX_QUERY_LIMIT = 10000
+# Grouped queries with more groups than this are refused
+MAX_GROUPS = 100000
+
+# How each aggregate is computed per batch and how the partials are merged
+PARTIALS = {
+    'count': [('count', 'sum')],
+    'sum': [('sum', 'sum')],
+    'min': [('min', 'min')],
+    'max': [('max', 'max')],
+    'mean': [('sum', 'sum'), ('count', 'sum')],
+}
+NUMERIC_AGGREGATES = {'sum', 'mean'}
+
+
+class QueryError(GridError):
+    """Invalid query spec"""
+
+
+def _as_list(value, name):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [value]
+    if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+        raise QueryError(f"'{name}' must be a column name or a list of column names")
+    return value
+
+
+def parse_query(spec):
+    """Validate a query spec and return it in normalized form"""
+    if not isinstance(spec, dict):
+        raise QueryError('A query must be a JSON object')
+    unknown = set(spec) - {'sheet', 'select', 'where', 'group_by', 'aggregates', 'order_by', 'limit'}
+    if unknown:
+        raise QueryError(f"Unknown query keys: {', '.join(sorted(unknown))}")
+
+    where = []
+    for condition in spec.get('where') or []:
+        if isinstance(condition, str):
+            where.extend(parse_filters([condition]))
+        elif isinstance(condition, list) and len(condition) == 3 and condition[1] in set(FILTER_OPS) | {'contains'}:
+            where.append(tuple(condition))
+        else:
+            raise QueryError(f"Invalid condition {condition!r}, expected 'column:op:value' or [column, op, value]")
+
+    aggregates = []
+    for aggregate in spec.get('aggregates') or []:
+        if not isinstance(aggregate, dict) or aggregate.get('op') not in PARTIALS:
+            raise QueryError(f"Aggregates need an 'op' out of {', '.join(PARTIALS)}")
+        column = aggregate.get('column')
+        if column in (None, '*'):
+            if aggregate['op'] != 'count':
+                raise QueryError(f"'{aggregate['op']}' needs a column")
+            column = None
+        alias = aggregate.get('as') or (f"{aggregate['op']}_{column}" if column else 'count')
+        aggregates.append((aggregate['op'], column, str(alias)))
+
+    group_by = _as_list(spec.get('group_by'), 'group_by')
+    select = _as_list(spec.get('select'), 'select')
+    if (group_by or aggregates) and select:
+        raise QueryError("Use 'group_by' and 'aggregates' or 'select', not both")
+
+    try:
+        limit = int(spec.get('limit', DEFAULT_QUERY_LIMIT))
+    except (TypeError, ValueError):
+        raise QueryError("'limit' must be an integer")
+
+    return {
+        'sheet': spec.get('sheet') or None,
+        'select': select,
+        'where': where,
+        'group_by': group_by,
+        'aggregates': aggregates,
+        'order_by': _as_list(spec.get('order_by'), 'order_by'),
+        'limit': max(1, min(limit, MAX_QUERY_LIMIT)),
+    }
+
+
+def _filter_expression(schema, where):
+    """One dataset expression for all conditions, typed against ``schema``"""
+    expression = None
+    for column, op, value in where:
+        field = ds.field(column)
+        if op == 'contains':
+            condition = pc.match_substring(field.cast(pa.string()), str(value), ignore_case=True)
+        elif value is None:
+            condition = field.is_null() if op == 'eq' else field.is_valid()
+        else:
+            try:
+                scalar = pa.scalar(value).cast(schema.field(column).type)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+                raise QueryError(f"'{value}' is not a valid value for column '{column}'")
+            condition = FILTER_OPS[op](field, scalar)
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def _check_columns(schema, names):
+    for name in names:
+        if schema.get_field_index(name) < 0:
+            raise QueryError(f"Unknown column '{name}'")
+
+
+def _check_aggregates(schema, aggregates):
+    for op, column, _ in aggregates:
+        if op in NUMERIC_AGGREGATES and column is not None:
+            kind = schema.field(column).type
+            if not (pa.types.is_integer(kind) or pa.types.is_floating(kind) or pa.types.is_decimal(kind)):
+                raise QueryError(f"'{op}' needs a numeric column, '{column}' is {kind}")
+
+
+def _check_sheet(upload, sheet):
+    if sheet is not None and upload.sheet_names and sheet not in upload.sheet_names:
+        raise QueryError(f"Unknown sheet '{sheet}'")
+
+
+def scan(upload, sheet, columns, where, batch_size=BATCH_ROWS):
+    """Yield ``(schema, table)`` batches of matching rows, projected to ``columns``
+
+    ``columns=None`` keeps every column.
+    """
+    _check_sheet(upload, sheet)
+    try:
+        path = ensure_sidecar(upload, sheet)
+    except Exception as e:
+        logger.warning(f"Columnar cache unavailable for upload {upload.pk}, reading source: {e}")
+        path = None
+
+    if path is not None:
+        dataset = ds.dataset(path, format='parquet')
+        _check_columns(dataset.schema, (columns or []) + [column for column, _, _ in where])
+        scanner = dataset.scanner(
+            columns=columns,
+            filter=_filter_expression(dataset.schema, where),
+            batch_size=batch_size,
+        )
+        for batch in scanner.to_batches():
+            yield dataset.schema, pa.Table.from_batches([batch])
+        return
+
+    for chunk in iter_source_chunks(upload, sheet=sheet, chunksize=batch_size):
+        table = _chunk_table(chunk)
+        _check_columns(table.schema, (columns or []) + [column for column, _, _ in where])
+        expression = _filter_expression(table.schema, where)
+        if expression is not None:
+            table = table.filter(expression)
+        yield table.schema, table.select(columns) if columns is not None else table
+
+
+def _partial_specs(aggregates):
+    """Distinct ``(column, function, name)`` partials and each aggregate's partial names"""
+    specs, names = {}, []
+    for op, column, _ in aggregates:
+        parts = []
+        for function, merge in PARTIALS[op]:
+            function = 'count_all' if column is None else function
+            key = (column, function)
+            if key not in specs:
+                specs[key] = (column, function, merge, f'_p{len(specs)}')
+            parts.append(specs[key][3])
+        names.append(parts)
+    return list(specs.values()), names
+
+
+def _reduce(table, keys, specs, merging):
+    """Group ``table`` by ``keys``, computing (or merging) every partial"""
+    aggregations, outputs = [], []
+    for column, function, merge, name in specs:
+        if merging:
+            aggregations.append((name, merge))
+            outputs.append(f'{name}_{merge}')
+        elif column is None:
+            aggregations.append(([], 'count_all'))
+            outputs.append('count_all')
+        else:
+            aggregations.append((column, function))
+            outputs.append(f'{column}_{function}')
+    grouped = table.group_by(keys, use_threads=False).aggregate(aggregations)
+    return pa.table(
+        [grouped.column(key) for key in keys] + [grouped.column(output) for output in outputs],
+        names=keys + [name for *_, name in specs],
+    )
+
+
+def _aggregate(batches, keys, aggregates):
+    specs, partial_names = _partial_specs(aggregates)
+    running = None
+    scanned = 0
+    for _, table in batches:
+        scanned += table.num_rows
+        if not table.num_rows:
+            continue
+        partial = _reduce(table, keys, specs, merging=False)
+        if running is not None:
+            combined = pa.concat_tables([running, partial], promote_options='permissive')
+            partial = _reduce(combined, keys, specs, merging=True)
+        running = partial
+        if running.num_rows > MAX_GROUPS:
+            raise QueryError(f'The query produces more than {MAX_GROUPS} groups')
+
+    if running is None:
+        if keys:
+            return pa.table({name: [] for name in keys + [alias for *_, alias in aggregates]}), scanned
+        # No matching rows: counts are 0, everything else is null
+        running = pa.table({name: pa.array([None], pa.int64()) for *_, name in specs})
+
+    columns = [running.column(key) for key in keys]
+    for (op, _, _), parts in zip(aggregates, partial_names):
+        if op == 'mean':
+            total, count = (running.column(name) for name in parts)
+            columns.append(pc.divide(pc.cast(total, pa.float64()), pc.cast(count, pa.float64())))
+        elif op == 'count':
+            columns.append(pc.fill_null(running.column(parts[0]), 0))
+        else:
+            columns.append(running.column(parts[0]))
+    return pa.table(columns, names=keys + [alias for *_, alias in aggregates]), scanned
+
+
+def _sort_keys(order_by, names):
+    keys = []
+    for item in order_by:
+        column, order = (item[1:], 'descending') if item.startswith('-') else (item, 'ascending')
+        if column not in names:
+            raise QueryError(f"Cannot order by '{column}', it is not in the result")
+        keys.append((column, order))
+    return keys
+
+
+def _select(batches, order_by, limit):
+    """Matching rows, keeping only the best ``limit`` rows while streaming"""
+    kept = None
+    scanned = 0
+    for _, table in batches:
+        scanned += table.num_rows
+        kept = table if kept is None else pa.concat_tables([kept, table], promote_options='permissive')
+        if order_by:
+            sort_keys = _sort_keys(order_by, kept.column_names)
+            if kept.num_rows > limit:
+                kept = kept.take(pc.select_k_unstable(kept, k=limit, sort_keys=sort_keys))
+        elif kept.num_rows >= limit:
+            # Unordered: the first rows found will do, stop reading
+            break
+    return kept, scanned
+
+
+def run_query(upload, spec):
+    """Run a query spec against one sheet of an upload"""
+    query = parse_query(spec)
+    _check_sheet(upload, query['sheet'])
+    keys, aggregates = query['group_by'], query['aggregates']
+
+    if keys or aggregates:
+        columns = list(dict.fromkeys(keys + [column for _, column, _ in aggregates if column is not None]))
+        batches = scan(upload, query['sheet'], columns, query['where'])
+        first = next(batches, None)
+        if first is not None:
+            _check_aggregates(first[0], aggregates)
+            batches = _chain(first, batches)
+        result, scanned = _aggregate(batches, keys, aggregates)
+    else:
+        columns = query['select'] or None
+        if columns is None:
+            columns = sheet_columns(upload, query['sheet'])
+        result, scanned = _select(scan(upload, query['sheet'], columns, query['where']), query['order_by'], query['limit'])
+        if result is None:
+            result = pa.table({name: [] for name in columns})
+
+    if query['order_by']:
+        result = result.sort_by(_sort_keys(query['order_by'], result.column_names))
+    truncated = result.num_rows > query['limit']
+    result = result.slice(0, query['limit'])
+
+    return {
+        'columns': result.column_names,
+        'rows': to_json_safe([list(row) for row in zip(*(column.to_pylist() for column in result.columns))]),
+        'row_count': result.num_rows,
+        'truncated': truncated,
+        'scanned_rows': scanned,
+    }
+
+
+def _chain(first, rest):
+    yield first
+    yield from rest
+
+
+def sheet_columns(upload, sheet):
+    """Column names of one sheet of an upload"""
+    try:
+        return ds.dataset(ensure_sidecar(upload, sheet), format='parquet').schema.names
+    except Exception:
+        chunk = next(iter_source_chunks(upload, sheet=sheet), None)
+        return [] if chunk is None else [str(column) for column in chunk.columns]
@@ -0,0 +1,168 @@
+"""
+Chunked readers for uploaded files.
+
+Every reader yields DataFrames of at most ``chunksize`` rows so callers can
+process files of any size with bounded memory. ``iter_chunks`` reads the
+upload's columnar sidecar (see columnar.py); ``open_source_sheets``
+dispatches on ``DataUpload.get_extension()`` and parses the original file,
+opening a workbook once for all of its sheets.
+"""
+import logging
+from contextlib import contextmanager
+from functools import partial
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Rows per chunk yielded by the readers
+CSV_CHUNK_ROWS = 50000
+XLSX_CHUNK_ROWS = 10000
+
+# CSV files have a single, implicit sheet
+CSV_SHEET_NAME = 'CSV Data'
+
+
+def iter_chunks(upload, sheet=None, columns=None, chunksize=None):
+    """Yield the rows of one sheet of an upload as DataFrame chunks"""
+    from .columnar import ensure_sidecar, iter_sidecar_chunks
+
+    try:
+        path = ensure_sidecar(upload, sheet)
+    except Exception as e:
+        logger.warning(f"Columnar cache unavailable for upload {upload.pk}, reading source: {e}")
+        return iter_source_chunks(upload, sheet=sheet, columns=columns, chunksize=chunksize)
+    return iter_sidecar_chunks(path, columns=columns, chunksize=chunksize)
+
+
+@contextmanager
+def open_source_sheets(upload, chunksize=None):
+    """Open the original file once and list its sheets
+
+    Yields ``[(sheet_name, chunks), ...]`` where ``chunks()`` returns a
+    fresh chunk iterator for that sheet. The file stays open until the
+    ``with`` block ends.
+    """
+    file_ext = upload.get_extension()
+    path = upload.file.path
+
+    if file_ext == '.csv':
+        from .schema import infer_csv_options
+
+        yield [(CSV_SHEET_NAME, partial(
+            iter_csv_chunks, path, chunksize=chunksize or CSV_CHUNK_ROWS, read_options=infer_csv_options(path),
+        ))]
+    elif file_ext == '.xlsx':
+        from openpyxl import load_workbook
+
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            yield [
+                (worksheet.title, partial(iter_worksheet_chunks, worksheet, chunksize=chunksize or XLSX_CHUNK_ROWS))
+                for worksheet in workbook.worksheets
+            ]
+        finally:
+            workbook.close()
+    elif file_ext == '.xls':
+        excel = pd.ExcelFile(path)
+        try:
+            yield [
+                (name, partial(iter_xls_chunks, excel, name, chunksize=chunksize or XLSX_CHUNK_ROWS))
+                for name in excel.sheet_names
+            ]
+        finally:
+            excel.close()
+    else:
+        raise ValueError(f"Unsupported file extension: {file_ext}")
+
+
+def iter_source_chunks(upload, sheet=None, columns=None, chunksize=None):
+    """Parse one sheet of the original upload file chunk by chunk"""
+    with open_source_sheets(upload, chunksize=chunksize) as sheets:
+        for name, chunks in sheets:
+            if sheet is None or name == sheet:
+                for chunk in chunks():
+                    yield chunk[list(columns)] if columns is not None else chunk
+                return
+    raise ValueError(f"Unknown sheet '{sheet}'")
+
+
+def iter_csv_chunks(path, columns=None, chunksize=CSV_CHUNK_ROWS, read_options=None):
+    """Stream a CSV file, typed by ``read_options`` (see schema.csv_read_options) when given
+
+    Raises ``schema.TypeMismatch`` when a value does not fit those types.
+    """
+    from .schema import TypeMismatch
+
+    options = read_options or {}
+    try:
+        with pd.read_csv(path, usecols=columns, chunksize=chunksize, low_memory=True, **options) as reader:
+            for chunk in reader:
+                yield chunk
+    except (ValueError, TypeError, OverflowError) as e:
+        if not options or isinstance(e, pd.errors.ParserError):
+            raise
+        raise TypeMismatch(f'CSV values do not match the sampled column types: {e}') from e
+
+
+def _header_names(cells):
+    """Column names for a header row, following pandas' read_excel conventions"""
+    names = []
+    seen = {}
+    for i, cell in enumerate(cells):
+        name = f'Unnamed: {i}' if cell is None else cell
+        if name in seen:
+            seen[name] += 1
+            name = f'{name}.{seen[name]}'
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+def iter_worksheet_chunks(worksheet, columns=None, chunksize=XLSX_CHUNK_ROWS):
+    """Stream the rows of a read-only openpyxl worksheet"""
+    rows = worksheet.iter_rows(values_only=True)
+
+    header = next(rows, None)
+    if header is None:
+        return
+    header = list(header)
+    while header and header[-1] is None:
+        header.pop()
+    names = _header_names(header)
+    width = len(names)
+
+    batch = []
+    emitted = False
+    pending_blank = 0  # blank rows are only kept if data follows them
+    for row in rows:
+        row = tuple(row[:width]) + (None,) * (width - len(row))
+        if all(value is None for value in row):
+            pending_blank += 1
+            continue
+        if pending_blank:
+            batch.extend([(None,) * width] * pending_blank)
+            pending_blank = 0
+        batch.append(row)
+        if len(batch) >= chunksize:
+            yield _frame(batch, names, columns)
+            emitted = True
+            batch = []
+    if batch or not emitted:
+        # A header-only sheet still yields its (empty) columns
+        yield _frame(batch, names, columns)
+
+
+def iter_xls_chunks(excel, sheet_name, columns=None, chunksize=XLSX_CHUNK_ROWS):
+    # xlrd cannot stream, so legacy .xls sheets are loaded once and sliced
+    df = excel.parse(sheet_name, usecols=columns)
+    for start in range(0, len(df), chunksize):
+        yield df.iloc[start:start + chunksize]
+
+
+def _frame(rows, names, columns=None):
+    df = pd.DataFrame.from_records(rows, columns=names)
+    if columns is not None:
+        df = df[list(columns)]
+    return df
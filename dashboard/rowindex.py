@@ -0,0 +1,175 @@
+"""
+Byte-offset row index for CSV uploads.
+
+At ingest every CSV upload gets an array with the byte offset where each
+data record starts, followed by the file size. It is stored as
+``rows.npy`` in the sidecar's index directory, so it goes away whenever
+the sidecar is rebuilt. Any row can then be sliced straight out of a
+memory map of the file and parsed on its own. A page of the grid, or the
+rows of a sorted or filtered view scattered across the file, cost a few
+hundred bytes of parsing each. Reading them from Parquet decompresses
+whole row groups.
+
+The scan is vectorized with numpy and quote-aware: a newline only ends a
+record when an even number of quotes precede it. Blank lines, which
+``read_csv`` skips, are left out so positions match the sidecar's rows.
+"""
+import io
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from .columnar import sidecar_index_dir
+from .schema import arrow_read_options
+
+logger = logging.getLogger(__name__)
+
+ROW_INDEX_NAME = 'rows.npy'
+# Bytes scanned per numpy pass
+SCAN_BLOCK_BYTES = 64 * 1024 * 1024
+# Rows compared with the sidecar before an index is trusted
+VERIFY_ROWS = 50
+
+QUOTE = ord('"')
+NEWLINE = ord('\n')
+CARRIAGE_RETURN = ord('\r')
+
+
+def row_index_path(sidecar):
+    return os.path.join(sidecar_index_dir(sidecar), ROW_INDEX_NAME)
+
+
+def _map(path):
+    if not os.path.getsize(path):
+        return np.empty(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='r')
+
+
+def _record_ends(data, start):
+    """Offsets just past every newline outside quotes, from ``start`` on"""
+    ends = []
+    quotes = 0
+    for block_start in range(start, len(data), SCAN_BLOCK_BYTES):
+        block = np.asarray(data[block_start:block_start + SCAN_BLOCK_BYTES])
+        quote_at = np.flatnonzero(block == QUOTE)
+        newline_at = np.flatnonzero(block == NEWLINE)
+        outside = (np.searchsorted(quote_at, newline_at) + quotes) % 2 == 0
+        ends.append(newline_at[outside].astype(np.uint64) + np.uint64(block_start + 1))
+        quotes += len(quote_at)
+    return np.concatenate(ends) if ends else np.empty(0, dtype=np.uint64)
+
+
+def row_offsets(data, start=0, header=True):
+    """Start of every record from ``start`` on, then the end of the data
+
+    With ``header`` the record at ``start`` is the header and is left out.
+    """
+    ends = _record_ends(data, start)
+    offsets = ends if header else np.concatenate([np.array([start], dtype=np.uint64), ends])
+    if not len(offsets) or offsets[-1] != len(data):
+        offsets = np.append(offsets, np.uint64(len(data)))
+    starts, lengths = offsets[:-1], np.diff(offsets)
+    blank = np.zeros(len(starts), dtype=bool)
+    short = np.flatnonzero(lengths <= 2)
+    first = data[starts[short].astype(np.int64)]
+    blank[short] = (first == NEWLINE) | ((first == CARRIAGE_RETURN) & (lengths[short] == 2))
+    if blank.any():
+        # Folding a blank line into the record before it keeps the slices contiguous
+        offsets = np.append(starts[~blank], offsets[-1])
+    return offsets
+
+
+def take_csv_rows(source, offsets, positions, schema):
+    """Rows of a CSV at ``positions`` (in that order), parsed into the Arrow ``schema``"""
+    positions = np.asarray(positions, dtype=np.int64)
+    if not len(positions):
+        return schema.empty_table()
+    data = _map(source)
+    header = data[:int(offsets[0])].tobytes()
+    if len(positions) > 1 and (np.diff(positions) == 1).all():
+        pieces = [data[int(offsets[positions[0]]):int(offsets[positions[-1] + 1])].tobytes()]
+    else:
+        pieces = [data[int(offsets[p]):int(offsets[p + 1])].tobytes() for p in positions]
+    # Only the last record of a file can lack its newline
+    body = b''.join(piece if piece.endswith(b'\n') else piece + b'\n' for piece in pieces)
+    df = pd.read_csv(io.BytesIO(header + body), **arrow_read_options(schema))
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if table.num_rows != len(positions):
+        raise ValueError('Row index does not match the file')
+    return table.cast(schema.remove_metadata())
+
+
+def _matches_sidecar(source, offsets, parquet):
+    from .grid import take_rows
+
+    total = parquet.metadata.num_rows
+    schema = parquet.schema_arrow
+    for start in sorted({0, max(0, total // 2 - VERIFY_ROWS // 2), max(0, total - VERIFY_ROWS)}):
+        positions = np.arange(start, min(start + VERIFY_ROWS, total))
+        try:
+            if not take_csv_rows(source, offsets, positions, schema).equals(
+                    take_rows(parquet, positions).cast(schema.remove_metadata())):
+                return False
+        except (ValueError, pa.ArrowException):
+            return False
+    return True
+
+
+def save_row_index(sidecar, offsets):
+    path = row_index_path(sidecar)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = f'{path}.{os.getpid()}.tmp'
+    with open(temp, 'wb') as f:
+        np.save(f, offsets)
+    os.replace(temp, path)
+
+
+def build_row_index(source, sidecar):
+    """Index the records of the CSV ``source`` and store the index with its sidecar
+
+    The index is only kept when it lines up with the sidecar's rows (a
+    file the scan cannot follow, such as one with stray quotes, is served
+    from the sidecar alone). Returns the offsets, or None.
+    """
+    from .columnar import open_sidecar
+
+    offsets = row_offsets(_map(source))
+    parquet = open_sidecar(sidecar)
+    if len(offsets) - 1 != parquet.metadata.num_rows or not _matches_sidecar(source, offsets, parquet):
+        logger.info(f"Row index of {os.path.basename(source)} does not match its sidecar; not using one")
+        return None
+    save_row_index(sidecar, offsets)
+    return offsets
+
+
+def extend_row_index(source, sidecar, offsets, start):
+    """Store ``offsets`` followed by the records appended to ``source`` from byte ``start``
+
+    Returns the new offsets, or None (storing nothing) when they do not
+    count the sidecar's rows.
+    """
+    from .columnar import open_sidecar
+
+    appended = row_offsets(_map(source), start=start, header=False)
+    offsets = np.concatenate([np.asarray(offsets[:-1], dtype=np.uint64), appended])
+    if len(offsets) - 1 != open_sidecar(sidecar).metadata.num_rows:
+        logger.info(f"Appended records of {os.path.basename(source)} do not match its sidecar; dropping the row index")
+        return None
+    save_row_index(sidecar, offsets)
+    return offsets
+
+
+def load_row_index(upload, sidecar, parquet):
+    """Memory-mapped row index of a CSV upload, or None if it has none or it is out of date"""
+    if upload.get_extension() != '.csv':
+        return None
+    path = row_index_path(sidecar)
+    if not os.path.exists(path):
+        return None
+    offsets = np.load(path, mmap_mode='r')
+    if len(offsets) - 1 != parquet.metadata.num_rows or int(offsets[-1]) != os.path.getsize(upload.file.path):
+        return None
+    return offsets
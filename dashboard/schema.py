@@ -0,0 +1,277 @@
+"""
+Typed schema inference for uploaded sheets.
+
+Columns are typed from a sample drawn across the whole sheet: the head,
+the tail and a few random blocks. Each column gets vectorized parse
+attempts as boolean, integer, float and datetime, and is then classified
+as categorical or string. CSV files are sampled before they are converted
+so the conversion can pass explicit ``dtype=``/``parse_dates=`` to pandas.
+Every sheet is typed again from its sidecar for ``DataPreview``; text
+columns that look typed there are checked against all of their values.
+"""
+import io
+import os
+import random
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pandas.tseries.api import guess_datetime_format
+
+TYPE_BOOLEAN = 'boolean'
+TYPE_INTEGER = 'integer'
+TYPE_FLOAT = 'float'
+TYPE_DATETIME = 'datetime'
+TYPE_CATEGORY = 'category'
+TYPE_STRING = 'string'
+
+# Sample shape: leading rows, plus random blocks and the tail of the file
+HEAD_ROWS = 1000
+SAMPLE_BLOCKS = 8
+BLOCK_BYTES = 64 * 1024
+BLOCK_ROWS = 500
+
+# Text columns with at most this many distinct values (and mostly repeats) are categorical
+CATEGORY_MAX_VALUES = 1000
+CATEGORY_MAX_RATIO = 0.5
+
+BOOLEAN_TOKENS = {'true', 'false'}
+
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+class TypeMismatch(ValueError):
+    """A value did not match the type inferred from the sample"""
+
+
+def infer_column(values):
+    """``(type, datetime_format)`` for one sampled column"""
+    non_null = values.dropna()
+    if pd.api.types.is_bool_dtype(values.dtype):
+        return TYPE_BOOLEAN, None
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        return TYPE_DATETIME, None
+    if pd.api.types.is_numeric_dtype(values.dtype):
+        numbers = non_null.to_numpy(dtype='float64')
+        whole = (numbers == numbers.round()).all() and (abs(numbers) < 2.0 ** 63).all()
+        return (TYPE_INTEGER if whole else TYPE_FLOAT), None
+
+    text = non_null.astype(str).str.strip()
+    text = text[text != '']
+    if not len(text):
+        return TYPE_STRING, None
+
+    if text.str.lower().isin(BOOLEAN_TOKENS).all():
+        return TYPE_BOOLEAN, None
+
+    numbers = pd.to_numeric(text, errors='coerce')
+    # Leading zeros (codes, zip codes) would be lost as numbers
+    if numbers.notna().all() and not text.str.match(r'^[+-]?0\d').any():
+        if not text.str.fullmatch(r'[+-]?\d+').all():
+            return TYPE_FLOAT, None
+        if _fits_int64(text):
+            return TYPE_INTEGER, None
+        # Identifiers too long for int64 would lose digits as floats
+        return _text_type(text), None
+
+    if numbers.isna().all():
+        date_format = guess_datetime_format(text.iloc[0])
+        if date_format is not None:
+            dates = pd.to_datetime(text, format=date_format, errors='coerce')
+            if dates.notna().all():
+                return TYPE_DATETIME, date_format
+
+    return _text_type(text), None
+
+
+def _fits_int64(text):
+    # Up to 18 digits always fits; only longer values need checking
+    long = text[text.str.lstrip('+-').str.len() > 18]
+    return all(INT64_MIN <= int(value) <= INT64_MAX for value in long)
+
+
+def _text_type(text):
+    distinct = text.nunique()
+    if distinct <= CATEGORY_MAX_VALUES and distinct <= len(text) * CATEGORY_MAX_RATIO:
+        return TYPE_CATEGORY
+    return TYPE_STRING
+
+
+def infer_schema(sample):
+    """``{column: (type, datetime_format, has_nulls)}`` for a sample DataFrame"""
+    return {
+        column: infer_column(sample[column]) + (bool(sample[column].isna().any()),)
+        for column in sample.columns
+    }
+
+
+def _csv_block(f, offset, names):
+    """Parse the complete lines of one block of a CSV file as text"""
+    f.seek(offset)
+    block = f.read(BLOCK_BYTES)
+    start = block.find(b'\n') + 1
+    end = block.rfind(b'\n') + 1
+    if not 0 < start < end:
+        return None
+    try:
+        return pd.read_csv(
+            io.BytesIO(block[start:end]), header=None, names=names, dtype=str,
+            nrows=BLOCK_ROWS, on_bad_lines='skip', engine='c',
+        )
+    except (pd.errors.ParserError, pd.errors.EmptyDataError, ValueError):
+        # The block started inside a quoted field
+        return None
+
+
+def sample_csv(path, seed=0):
+    """Head, tail and random blocks of a CSV file, all read as text"""
+    head = pd.read_csv(path, nrows=HEAD_ROWS, dtype=str)
+    size = os.path.getsize(path)
+    parts = [head]
+    if size > BLOCK_BYTES * 2:
+        rng = random.Random(seed)
+        offsets = sorted(rng.randrange(BLOCK_BYTES, size - BLOCK_BYTES) for _ in range(SAMPLE_BLOCKS))
+        with open(path, 'rb') as f:
+            for offset in offsets + [size - BLOCK_BYTES]:
+                block = _csv_block(f, offset, list(head.columns))
+                if block is not None:
+                    parts.append(block)
+    return pd.concat(parts, ignore_index=True)
+
+
+def csv_read_options(schema):
+    """``read_csv`` keyword arguments that apply an inferred schema
+
+    Nullable dtypes parse several times slower, so they are only used for
+    columns with nulls in the sample; a null the sample missed raises and
+    the caller reads the file untyped.
+    """
+    dtype = {}
+    parse_dates = []
+    date_format = {}
+    for column, (kind, fmt, has_nulls) in schema.items():
+        if kind == TYPE_INTEGER:
+            dtype[column] = 'Int64' if has_nulls else 'int64'
+        elif kind == TYPE_FLOAT:
+            dtype[column] = 'float64'
+        elif kind == TYPE_BOOLEAN:
+            dtype[column] = 'boolean' if has_nulls else 'bool'
+        elif kind == TYPE_DATETIME:
+            parse_dates.append(column)
+            date_format[column] = fmt
+        elif kind == TYPE_CATEGORY:
+            dtype[column] = 'category'
+        else:
+            dtype[column] = 'str'
+    options = {'dtype': dtype}
+    if parse_dates:
+        options['parse_dates'] = parse_dates
+        options['date_format'] = date_format
+    return options
+
+
+def arrow_read_options(schema):
+    """``read_csv`` keyword arguments that parse a CSV into the column types of an Arrow ``schema``
+
+    Used for rows appended to an upload, which must match its sidecar.
+    Integers and booleans are read as nullable so missing values still fit.
+    """
+    dtype = {}
+    parse_dates = []
+    for field in schema:
+        if pa.types.is_integer(field.type):
+            dtype[field.name] = 'Int64'
+        elif pa.types.is_floating(field.type):
+            dtype[field.name] = 'float64'
+        elif pa.types.is_boolean(field.type):
+            dtype[field.name] = 'boolean'
+        elif pa.types.is_timestamp(field.type) or pa.types.is_date(field.type):
+            parse_dates.append(field.name)
+        elif pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+            dtype[field.name] = 'str'
+    options = {'dtype': dtype}
+    if parse_dates:
+        options['parse_dates'] = parse_dates
+    return options
+
+
+def infer_csv_options(path):
+    """Sample a CSV file and return typed ``read_csv`` options (``{}`` if it cannot be sampled)"""
+    try:
+        return csv_read_options(infer_schema(sample_csv(path)))
+    except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError, ValueError):
+        return {}
+
+
+def sample_sidecar(parquet, seed=0):
+    """Head, tail and random row-group slices of a sidecar as a DataFrame"""
+    groups = parquet.metadata.num_row_groups
+    if not groups:
+        return parquet.schema_arrow.empty_table().to_pandas()
+    rng = random.Random(seed)
+    picks = sorted({0, groups - 1} | {rng.randrange(groups) for _ in range(min(SAMPLE_BLOCKS, groups))})
+    parts = []
+    for group in picks:
+        table = parquet.read_row_group(group)
+        if group == 0:
+            parts.append(table.slice(0, HEAD_ROWS))
+        if group == groups - 1:
+            parts.append(table.slice(max(0, table.num_rows - BLOCK_ROWS)))
+        if 0 < group < groups - 1 or groups == 1:
+            start = rng.randrange(max(1, table.num_rows - BLOCK_ROWS))
+            parts.append(table.slice(start, BLOCK_ROWS))
+    return pd.concat([part.to_pandas() for part in parts], ignore_index=True)
+
+
+def _column_fits(parquet, column, kind, date_format):
+    """True if every value of a text column of a sidecar parses as ``kind``"""
+    for batch in parquet.iter_batches(columns=[column]):
+        values = pc.utf8_trim_whitespace(pc.drop_null(batch.column(0)))
+        values = values.filter(pc.not_equal(values, ''))
+        try:
+            if kind == TYPE_INTEGER:
+                pc.cast(values, pa.int64())
+            elif kind == TYPE_FLOAT:
+                pc.cast(values, pa.float64())
+            elif kind == TYPE_DATETIME:
+                pc.strptime(values, format=date_format, unit='us')
+            elif kind == TYPE_BOOLEAN and not pc.all(pc.is_in(pc.utf8_lower(values), pa.array(sorted(BOOLEAN_TOKENS)))).as_py():
+                return False
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            return False
+    return True
+
+
+def infer_sidecar_schema(parquet, seed=0):
+    """``{column: type}`` for a sidecar
+
+    Types come from a sample; a text column that looks typed in the sample
+    is only reported as such when all of its values parse.
+    """
+    sample = sample_sidecar(parquet, seed)
+    types = {}
+    for field in parquet.schema_arrow:
+        if field.name not in sample.columns:
+            continue
+        kind, date_format = infer_column(sample[field.name])
+        is_text = pa.types.is_string(field.type) or pa.types.is_large_string(field.type)
+        if is_text and kind not in (TYPE_CATEGORY, TYPE_STRING) and not _column_fits(parquet, field.name, kind, date_format):
+            kind = _text_type(sample[field.name].dropna().astype(str))
+        types[field.name] = kind
+    return types
+
+
+def null_counts(parquet):
+    """Exact null count per column from row-group statistics (None if unknown)"""
+    metadata = parquet.metadata
+    counts = {}
+    for index, name in enumerate(parquet.schema_arrow.names):
+        total = 0
+        for group in range(metadata.num_row_groups):
+            statistics = metadata.row_group(group).column(index).statistics
+            if statistics is None or not statistics.has_null_count:
+                total = None
+                break
+            total += statistics.null_count
+        counts[name] = total
+    return counts
@@ -0,0 +1,384 @@
+"""
+Fixed-size, mergeable column summaries for the profiler.
+
+Each sketch takes a column chunk at a time, merges with a sketch of
+another part of the same column, and uses the same memory whatever the
+number of rows or distinct values:
+
+* ``HyperLogLog`` counts distinct values: 2**precision one-byte
+  registers (4 KB by default), relative standard error 1.04/sqrt(m).
+* ``SpaceSaving`` tracks the most common values: ``capacity`` counters.
+  Each count overestimates by at most its recorded error, and no error
+  exceeds rows/capacity.
+* ``QuantileSketch`` is a KLL sketch of a numeric column: about 3k
+  floats. Quantiles and CDF points are within ``rank_error`` of the true
+  rank, as a fraction of the rows.
+* ``Histogram`` counts a numeric column exactly in at most ``max_bins``
+  bins whose width is a power of two, widened as the range grows.
+
+Every operation is vectorized over the chunk. ``to_state`` gives each
+sketch as plain JSON values and numpy arrays, which ``from_state`` reads
+back (see ``profiling.save_profiler``).
+"""
+import datetime
+import decimal
+
+import numpy as np
+import pandas as pd
+
+HLL_PRECISION = 12
+SPACE_SAVING_CAPACITY = 64
+KLL_K = 200
+HISTOGRAM_MAX_BINS = 1024
+
+# Ratio between the capacities of successive KLL levels
+KLL_LEVEL_RATIO = 2 / 3
+
+
+def hash_values(series):
+    """64-bit hash of each value; every sketch and the exact profiler hash through this"""
+    return pd.util.hash_pandas_object(series, index=False).to_numpy()
+
+
+def encode_value(value):
+    """A column value as JSON, tagged with its type where JSON has none"""
+    if isinstance(value, np.datetime64):
+        value = pd.Timestamp(value)
+    elif isinstance(value, np.timedelta64):
+        value = pd.Timedelta(value)
+    elif isinstance(value, np.generic):
+        value = value.item()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if value is pd.NaT:
+        return {'nat': True}
+    if value is pd.NA:
+        return {'na': True}
+    if isinstance(value, datetime.datetime):
+        return {'timestamp': value.isoformat()}
+    if isinstance(value, datetime.timedelta):
+        return {'timedelta': int(pd.Timedelta(value).value)}
+    if isinstance(value, datetime.date):
+        return {'date': value.isoformat()}
+    if isinstance(value, datetime.time):
+        return {'time': value.isoformat()}
+    if isinstance(value, decimal.Decimal):
+        return {'decimal': str(value)}
+    if isinstance(value, bytes):
+        return {'bytes': value.hex()}
+    return {'text': str(value)}
+
+
+VALUE_DECODERS = {
+    'nat': lambda _: pd.NaT,
+    'na': lambda _: pd.NA,
+    'timestamp': pd.Timestamp,
+    'timedelta': pd.Timedelta,
+    'date': datetime.date.fromisoformat,
+    'time': datetime.time.fromisoformat,
+    'decimal': decimal.Decimal,
+    'bytes': bytes.fromhex,
+    'text': str,
+}
+
+
+def decode_value(value):
+    """Inverse of ``encode_value``"""
+    if isinstance(value, dict):
+        (tag, payload), = value.items()
+        return VALUE_DECODERS[tag](payload)
+    return value
+
+
+def series_state(counts):
+    """Value counts as encoded values and an int64 array"""
+    return {'values': [encode_value(value) for value in counts.index], 'counts': counts.to_numpy(dtype=np.int64)}
+
+
+def series_from_state(values, counts):
+    """Inverse of ``series_state``"""
+    return pd.Series(np.asarray(counts, dtype=np.int64), index=pd.Index([decode_value(value) for value in values]))
+
+
+def _bit_length(values):
+    """Number of significant bits of each uint64"""
+    values = values.copy()
+    length = np.zeros(len(values), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        wide = values >= np.uint64(1 << shift)
+        values[wide] >>= np.uint64(shift)
+        length[wide] += shift
+    return length + (values > 0)
+
+
+class HyperLogLog:
+    """Distinct-value count from the longest run of leading zero bits per register"""
+
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    @property
+    def relative_error(self):
+        """Standard error as a fraction of the estimate"""
+        return 1.04 / np.sqrt(len(self.registers))
+
+    def update(self, series):
+        self.update_hashes(hash_values(series))
+
+    def update_hashes(self, hashes):
+        tail_bits = 64 - self.precision
+        register = (hashes >> np.uint64(tail_bits)).astype(np.intp)
+        tail = hashes & np.uint64((1 << tail_bits) - 1)
+        rank = (tail_bits - _bit_length(tail) + 1).astype(np.uint8)
+        np.maximum.at(self.registers, register, rank)
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def to_state(self):
+        return {'precision': self.precision, 'registers': self.registers}
+
+    @classmethod
+    def from_state(cls, state):
+        sketch = cls(state['precision'])
+        sketch.registers = np.asarray(state['registers'], dtype=np.uint8)
+        return sketch
+
+    def estimate(self):
+        m = len(self.registers)
+        raw = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(np.exp2(-self.registers.astype(np.float64)))
+        empty = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and empty:
+            # Linear counting is more accurate for small cardinalities
+            raw = m * np.log(m / empty)
+        return int(round(raw))
+
+
+class SpaceSaving:
+    """Heavy hitters with per-value error bounds (mergeable Space-Saving)
+
+    Values outside the summary are assumed to have the smallest tracked
+    count; that assumption is what each value's ``error`` records.
+    """
+
+    def __init__(self, capacity=SPACE_SAVING_CAPACITY):
+        self.capacity = capacity
+        self.counts = pd.Series(dtype='int64')
+        self.errors = pd.Series(dtype='int64')
+
+    def floor(self):
+        """Upper bound on the count of any value not in the summary"""
+        return int(self.counts.min()) if len(self.counts) >= self.capacity else 0
+
+    def update(self, series):
+        counts = series.value_counts(sort=False)
+        if len(counts) > self.capacity:
+            # A new value outside the chunk's own top values could never make the cut
+            heavy = counts.nlargest(self.capacity, keep='first')
+            tracked = counts.reindex(self.counts.index).dropna().astype('int64')
+            counts = pd.concat([heavy, tracked[~tracked.index.isin(heavy.index)]])
+        self._absorb(counts, pd.Series(0, index=counts.index, dtype='int64'), 0)
+
+    def merge(self, other):
+        self._absorb(other.counts, other.errors, other.floor())
+
+    def to_state(self):
+        return {'capacity': self.capacity, **series_state(self.counts), 'errors': self.errors.to_numpy(dtype=np.int64)}
+
+    @classmethod
+    def from_state(cls, state):
+        sketch = cls(state['capacity'])
+        sketch.counts = series_from_state(state['values'], state['counts'])
+        sketch.errors = pd.Series(np.asarray(state['errors'], dtype=np.int64), index=sketch.counts.index)
+        return sketch
+
+    def _absorb(self, counts, errors, floor):
+        own_floor = self.floor()
+        index = self.counts.index.union(counts.index) if len(self.counts) else counts.index
+        total = self.counts.reindex(index, fill_value=own_floor) + counts.reindex(index, fill_value=floor)
+        error = self.errors.reindex(index, fill_value=own_floor) + errors.reindex(index, fill_value=floor)
+        kept = total.nlargest(self.capacity, keep='first').index
+        self.counts = total[kept].astype('int64')
+        self.errors = error[kept].astype('int64')
+
+    def most_common(self):
+        return self.counts.idxmax() if len(self.counts) else None
+
+    def top(self, n):
+        """``[(value, count, error), ...]`` for the ``n`` heaviest values; the true count is in ``[count - error, count]``"""
+        heaviest = self.counts.nlargest(n, keep='first')
+        return [(value, int(count), int(self.errors[value])) for value, count in heaviest.items()]
+
+
+class QuantileSketch:
+    """KLL sketch: levels of sorted samples, each item at level h standing for 2**h values"""
+
+    def __init__(self, k=KLL_K, seed=0):
+        self.k = k
+        self.n = 0
+        self.levels = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+
+    @property
+    def rank_error(self):
+        """Normalized rank error (99% confidence) of a KLL sketch of this size"""
+        return 2.296 / self.k ** 0.9723
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        self.n += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+
+    def merge(self, other):
+        self.n += other.n
+        for height, items in enumerate(other.levels):
+            if height == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[height] = np.concatenate([self.levels[height], items])
+        self._compress()
+
+    def to_state(self):
+        return {'k': self.k, 'n': self.n, 'levels': list(self.levels), 'rng': self._rng.bit_generator.state}
+
+    @classmethod
+    def from_state(cls, state):
+        sketch = cls(state['k'])
+        sketch.n = state['n']
+        sketch.levels = [np.asarray(items, dtype=np.float64) for items in state['levels']]
+        sketch._rng.bit_generator.state = state['rng']
+        return sketch
+
+    def _capacity(self, height):
+        depth = len(self.levels) - 1 - height
+        return max(2, int(np.ceil(self.k * KLL_LEVEL_RATIO ** depth)))
+
+    def _compress(self):
+        # Only the lowest full level is compacted, and only while the sketch is over its total size
+        while sum(map(len, self.levels)) > sum(map(self._capacity, range(len(self.levels)))):
+            height = next(h for h in range(len(self.levels)) if len(self.levels[h]) >= self._capacity(h))
+            if height + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+            items = np.sort(self.levels[height])
+            # An odd item out stays behind; every other remaining item moves up at double weight
+            kept, paired = items[:len(items) % 2], items[len(items) % 2:]
+            self.levels[height] = kept
+            self.levels[height + 1] = np.concatenate([self.levels[height + 1], paired[self._rng.integers(2)::2]])
+
+    def _sorted(self):
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 2.0 ** height) for height, items in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        return values[order], np.cumsum(weights[order])
+
+    def quantiles(self, fractions):
+        """Approximate values at each of ``fractions`` (0..1) of the rows"""
+        if not self.n:
+            return [None] * len(fractions)
+        values, cumulative = self._sorted()
+        positions = np.searchsorted(cumulative, np.asarray(fractions) * cumulative[-1], side='left')
+        return values[np.minimum(positions, len(values) - 1)].tolist()
+
+    def cdf(self, points):
+        """Approximate fraction of the rows at or below each of ``points``"""
+        if not self.n:
+            return [0.0] * len(points)
+        values, cumulative = self._sorted()
+        below = np.concatenate([[0.0], cumulative])[np.searchsorted(values, points, side='right')]
+        return (below / cumulative[-1]).tolist()
+
+
+class Histogram:
+    """Exact counts in aligned bins ``[i * 2**exponent, (i + 1) * 2**exponent)``
+
+    Bins are aligned to multiples of their width, so widening them (to
+    fit a larger range, or to merge with a coarser histogram) only adds
+    neighbouring counts together and never splits one.
+    """
+
+    def __init__(self, max_bins=HISTOGRAM_MAX_BINS):
+        self.max_bins = max_bins
+        self.exponent = None
+        self.first = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def _span(self):
+        """Lowest and highest bin start, or None while empty"""
+        if self.exponent is None:
+            return None
+        return np.ldexp(float(self.first), self.exponent), np.ldexp(float(self.first + len(self.counts) - 1), self.exponent)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[np.isfinite(values)]
+        if not len(values):
+            return
+        self._fit(values.min(), values.max(), self.exponent)
+        bins = np.floor(np.ldexp(values, -self.exponent)).astype(np.int64)
+        self._add(int(bins.min()), np.bincount(bins - bins.min()))
+
+    def merge(self, other):
+        span = other._span()
+        if span is None:
+            return
+        self._fit(*span, other.exponent)
+        self._add(*_coarsen(other.first, other.counts, self.exponent - other.exponent))
+
+    def to_state(self):
+        return {'max_bins': self.max_bins, 'exponent': self.exponent, 'first': self.first, 'counts': self.counts}
+
+    @classmethod
+    def from_state(cls, state):
+        histogram = cls(state['max_bins'])
+        histogram.exponent = state['exponent']
+        histogram.first = state['first']
+        histogram.counts = np.asarray(state['counts'], dtype=np.int64)
+        return histogram
+
+    def _fit(self, low, high, exponent):
+        """Widen the bins (from at least ``exponent``) until ``[low, high]`` and the current bins fit"""
+        span = self._span()
+        if span is not None:
+            low, high = min(low, span[0]), max(high, span[1])
+        if exponent is None:
+            exponent = int(np.floor(np.log2(max(high - low, np.finfo(np.float64).tiny) / self.max_bins)))
+        # Bin numbers must fit in an int64
+        exponent = max(exponent, self.exponent or exponent, int(np.ceil(np.log2(max(abs(low), abs(high), 1.0)))) - 62)
+        while np.floor(np.ldexp(high, -exponent)) - np.floor(np.ldexp(low, -exponent)) >= self.max_bins:
+            exponent += 1
+        if self.exponent is None:
+            self.exponent = exponent
+        elif exponent > self.exponent:
+            self.first, self.counts = _coarsen(self.first, self.counts, exponent - self.exponent)
+            self.exponent = exponent
+
+    def _add(self, first, counts):
+        if not len(self.counts):
+            self.first, self.counts = first, counts.astype(np.int64)
+            return
+        start = min(self.first, first)
+        total = np.zeros(max(self.first + len(self.counts), first + len(counts)) - start, dtype=np.int64)
+        total[self.first - start:self.first - start + len(self.counts)] += self.counts
+        total[first - start:first - start + len(counts)] += counts
+        self.first, self.counts = start, total
+
+    def bins(self, max_bins):
+        """``(edges, counts)`` with bins widened until there are at most ``max_bins``"""
+        if self.exponent is None:
+            return [], []
+        first, counts, exponent = self.first, self.counts, self.exponent
+        while len(counts) > max_bins:
+            first, counts = _coarsen(first, counts, 1)
+            exponent += 1
+        edges = np.ldexp(np.arange(first, first + len(counts) + 1, dtype=np.float64), exponent)
+        return edges.tolist(), counts.tolist()
+
+
+def _coarsen(first, counts, steps):
+    """Bins of a histogram after doubling their width ``steps`` times"""
+    if steps <= 0 or not len(counts):
+        return first, counts
+    bins = np.arange(first, first + len(counts), dtype=np.int64) >> steps
+    return int(bins[0]), np.bincount(bins - bins[0], weights=counts, minlength=1).astype(np.int64)
@@ -0,0 +1,89 @@
+"""
+Upload totals for the dashboard home page.
+
+``UploadRollup`` keeps one row per file extension that is adjusted when an
+upload is created or deleted, so the home page reads a handful of rows
+instead of counting uploads and stat-ing their files. A chunked upload is
+only counted once its last chunk arrives (see chunked.py).
+"""
+import json
+
+from django.db import transaction
+from django.db.models import F, Max, Q
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.template.defaultfilters import date as format_date, filesizeformat
+
+from .models import DataUpload, UploadRollup, UploadSession
+
+FILE_TYPE_LABELS = ['Excel', 'CSV', 'JSON', 'Other']
+FILE_TYPE_GROUPS = {'xlsx': 'Excel', 'xls': 'Excel', 'csv': 'CSV', 'json': 'JSON'}
+
+
+def add_to_rollup(upload):
+    with transaction.atomic():
+        UploadRollup.objects.get_or_create(extension=upload.file_extension)
+        rollup = UploadRollup.objects.filter(extension=upload.file_extension)
+        rollup.update(
+            upload_count=F('upload_count') + 1,
+            total_size=F('total_size') + upload.file_size,
+        )
+        rollup.filter(
+            Q(latest_upload_at__isnull=True) | Q(latest_upload_at__lt=upload.uploaded_at)
+        ).update(latest_upload_at=upload.uploaded_at)
+
+
+@receiver(post_save, sender=DataUpload)
+def record_upload(sender, instance, created, **kwargs):
+    # A chunked upload is added by chunked._complete once all its bytes arrived
+    if created and not getattr(instance, 'receiving_chunks', False):
+        add_to_rollup(instance)
+
+
+@receiver(pre_delete, sender=DataUpload)
+def note_unfinished_upload(sender, instance, **kwargs):
+    # Checked before the delete cascades to the session
+    instance.receiving_chunks = UploadSession.objects.filter(
+        upload_id=instance.pk, completed_at__isnull=True
+    ).exists()
+
+
+@receiver(post_delete, sender=DataUpload)
+def forget_upload(sender, instance, **kwargs):
+    if getattr(instance, 'receiving_chunks', False):
+        return
+    with transaction.atomic():
+        rollup = UploadRollup.objects.filter(extension=instance.file_extension, upload_count__gt=0)
+        rollup.update(
+            upload_count=F('upload_count') - 1,
+            total_size=F('total_size') - instance.file_size,
+        )
+        # Only deleting the newest upload of a type moves its latest date
+        if rollup.filter(latest_upload_at=instance.uploaded_at).exists():
+            latest = DataUpload.objects.filter(
+                file_extension=instance.file_extension
+            ).aggregate(latest=Max('uploaded_at'))['latest']
+            rollup.update(latest_upload_at=latest)
+
+
+def dashboard_summary():
+    """Context for the home page cards and file type chart"""
+    rollups = [rollup for rollup in UploadRollup.objects.all() if rollup.upload_count]
+    upload_count = sum(rollup.upload_count for rollup in rollups)
+    
+    by_type = dict.fromkeys(FILE_TYPE_LABELS, 0)
+    for rollup in rollups:
+        by_type[FILE_TYPE_GROUPS.get(rollup.extension, 'Other')] += rollup.upload_count
+    distribution = [
+        round(100 * by_type[label] / upload_count, 1) if upload_count else 0
+        for label in FILE_TYPE_LABELS
+    ]
+    
+    latest = max((rollup.latest_upload_at for rollup in rollups if rollup.latest_upload_at), default=None)
+    return {
+        'upload_count': upload_count,
+        'total_size': filesizeformat(sum(rollup.total_size for rollup in rollups)),
+        'latest_upload_date': format_date(latest, 'M d, Y') if latest else 'No uploads yet',
+        'file_formats_count': len(rollups),
+        'file_type_distribution': json.dumps(distribution),
+    }
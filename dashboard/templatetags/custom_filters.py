@@ -20,4 +20,15 @@ def subtract_from(value, arg):
     try:
         return arg - value
     except (ValueError, TypeError):
-        return 0
\ No newline at end of file
+        return 0
+@register.filter
+def percentage(value, digits=1):
+    """
+    Format a fraction as a percentage.
+    Usage: {{ 0.0133|percentage }}
+    Returns: '1.3%'
+    """
+    try:
+        return f'{float(value) * 100:.{int(digits)}f}%'
+    except (ValueError, TypeError):
+        return ''
@@ -1,3 +1,918 @@
-from django.test import TestCase
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from openpyxl import Workbook, load_workbook
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import OperationalError, connection, transaction
+from django.contrib.auth.models import User
+from django.conf import settings
+from django.template import engines
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import chunked, diff, export, grid, jobs, metrics, readers, schema, views
+from .materialize import materialize_upload, query_positions
+from .appending import append_rows
+from .blobs import attach_blob
+from .caching import ComputeLock, local_cache
+from .columnar import iter_sidecar_chunks, open_sidecar, sidecar_index_dir, sidecar_path, upload_lock
+from .database import retry_write
+from .listing import CursorError, keyset_page
+from .models import DataUpload, SheetProfile, StoredBlob, UploadRollup, UploadSession
+from .processing import process_excel_file
+from .profiling import build_profiler, load_profiler, profile_chunks, save_profiler, to_json_safe
+from .query import run_query
+from .readers import iter_csv_chunks
+from .rowindex import load_row_index, row_offsets, take_csv_rows
+from .schema import TYPE_CATEGORY, TYPE_INTEGER, TypeMismatch, csv_read_options, infer_column
+from .sketches import Histogram, HyperLogLog, QuantileSketch, SpaceSaving
+
+
+def csv_text(header, rows):
+    lines = [','.join(header)] + [','.join('' if value is None else str(value) for value in row) for row in rows]
+    return '\n'.join(lines) + '\n'
+
+
+def write_csv(test, text, name='rows.csv'):
+    """Path of a throwaway CSV file holding ``text``"""
+    directory = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+    path = os.path.join(directory, name)
+    with open(path, 'w') as f:
+        f.write(text)
+    return path
+
+
+class UploadTestMixin:
+    """Uploads ingested from CSV text into a throwaway media root and cache"""
+
+    def setUp(self):
+        self.media_root = media_root = tempfile.mkdtemp(prefix='dashboard-tests-')
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings = override_settings(
+            MEDIA_ROOT=media_root,
+            INGEST_ASYNC=False,
+            CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        local_cache.clear()
+        self.addCleanup(local_cache.clear)
+
+    def make_upload(self, text, name='data.csv', title=None):
+        upload = DataUpload(title=title or name)
+        upload.file.save(name, ContentFile(text if isinstance(text, bytes) else text.encode()), save=False)
+        upload.save()
+        rows = process_excel_file(upload)
+        DataUpload.objects.filter(pk=upload.pk).update(row_count=rows)
+        upload.set_status(DataUpload.STATUS_READY, progress=100)
+        upload.refresh_from_db()
+        return upload
+
+    def store_upload(self, text, name):
+        """An upload saved the way the upload form saves it, sharing a blob with identical files"""
+        upload = DataUpload(title=name)
+        upload.file = ContentFile(text.encode(), name=name)
+        attach_blob(upload, hashlib.sha256(text.encode()).hexdigest())
+        upload.save()
+        return upload
+
+
+class UploadTestCase(UploadTestMixin, TestCase):
+    pass
+
+
+class UploadTransactionTestCase(UploadTestMixin, TransactionTestCase):
+    """For code that writes through a connection of its own (materialized tables)"""
+
+
+class DiffTests(UploadTestCase):
+    def test_partitioned_diff_matches_keys_across_batches_with_nulls(self):
+        rows = [(i, f'v{i}') for i in range(400)]
+        # A null key makes its batch float64 once converted to pandas; it
+        # sits in a different batch on each side
+        old = rows[:10] + [(None, 'no key')] + rows[10:]
+        new = rows[:310] + [(None, 'no key')] + rows[310:]
+        new[200] = (200, 'changed')
+        upload_a = self.make_upload(csv_text(['id', 'value'], old), 'old.csv')
+        upload_b = self.make_upload(csv_text(['id', 'value'], new), 'new.csv')
+
+        with mock.patch.object(diff, 'DIFF_PARTITION_ROWS', 100), mock.patch.object(diff, 'BATCH_ROWS', 50):
+            result = diff.diff_uploads(upload_a, upload_b, ['id'])
+
+        self.assertGreater(result['partitions'], 1)
+        self.assertEqual(result['added_count'], 0)
+        self.assertEqual(result['removed_count'], 0)
+        self.assertEqual(result['changed_count'], 1)
+        self.assertEqual(result['changed'][0]['key'], {'id': 200})
+
+    def test_partitioned_diff_counts_match_a_single_partition(self):
+        old = [(i % 50, i // 50, f'v{i}') for i in range(600)]
+        new = [row for row in old if row[0] != 7] + [(99, i, 'new') for i in range(15)]
+        new = [(a, b, 'edited' if (a + b) % 40 == 0 else value) for a, b, value in new]
+        upload_a = self.make_upload(csv_text(['region', 'day', 'value'], old), 'old.csv')
+        upload_b = self.make_upload(csv_text(['region', 'day', 'value'], new), 'new.csv')
+
+        single = diff.diff_uploads(upload_a, upload_b, ['region', 'day'])
+        with mock.patch.object(diff, 'DIFF_PARTITION_ROWS', 64), mock.patch.object(diff, 'BATCH_ROWS', 50):
+            partitioned = diff.diff_uploads(upload_a, upload_b, ['region', 'day'])
+
+        self.assertEqual(single['partitions'], 1)
+        self.assertGreater(partitioned['partitions'], 1)
+        changed = sum(1 for a, b, _ in old if a != 7 and (a + b) % 40 == 0)
+        for result in (single, partitioned):
+            self.assertEqual((result['added_count'], result['removed_count'], result['changed_count']), (15, 12, changed))
+
+
+class SchemaInferenceTests(UploadTestCase):
+    def test_integers_beyond_int64_are_not_inferred_as_integers(self):
+        self.assertEqual(infer_column(pd.Series(['1', '42', '9223372036854775807']))[0], TYPE_INTEGER)
+        self.assertNotEqual(infer_column(pd.Series(['1', '12345678901234567890123']))[0], TYPE_INTEGER)
+
+    def test_overflowing_value_missed_by_the_sample_raises_type_mismatch(self):
+        path = write_csv(self, csv_text(['id'], [(1,), (12345678901234567890123,)]))
+        options = csv_read_options({'id': (TYPE_INTEGER, None, False)})
+        with self.assertRaises(TypeMismatch):
+            list(iter_csv_chunks(path, read_options=options))
+
+    def test_values_the_sample_missed_fall_back_to_pandas_types(self):
+        rows = [(i, i * 3) for i in range(50)]
+        rows[40] = ('unknown', 120)
+        rows[45] = (45, 12345678901234567890123)
+        # Only the first rows are sampled, so both integer guesses hold until row 40
+        with mock.patch.object(schema, 'HEAD_ROWS', 10):
+            upload = self.make_upload(csv_text(['id', 'ref'], rows))
+        self.assertEqual(upload.row_count, 50)
+        frame = pd.concat(iter_sidecar_chunks(sidecar_path(upload)))
+        self.assertEqual(frame['id'].astype(str).tolist(), [str(row[0]) for row in rows])
+        self.assertEqual(frame['ref'].astype(str).tolist(), [str(row[1]) for row in rows])
+
+    def test_long_identifiers_ingest_without_losing_digits(self):
+        upload = self.make_upload(csv_text(['id', 'n'], [(12345678901234567890123, 1), (98765432109876543210987, 2)]))
+        self.assertEqual(upload.row_count, 2)
+        values = pd.concat(iter_sidecar_chunks(sidecar_path(upload)))['id'].astype(str).tolist()
+        self.assertEqual(values, ['12345678901234567890123', '98765432109876543210987'])
+
+    def test_categorical_columns_are_parsed_as_categories_and_stored_as_text(self):
+        self.assertEqual(csv_read_options({'city': (TYPE_CATEGORY, None, True)})['dtype'], {'city': 'category'})
+        # One chunk holds no city at all, so its categories are empty
+        rows = [(i, None if 40 <= i < 60 else ['Oslo', 'Lima', 'Pune'][i % 3]) for i in range(100)]
+        with mock.patch.object(readers, 'CSV_CHUNK_ROWS', 20):
+            upload = self.make_upload(csv_text(['id', 'city'], rows))
+        self.assertEqual(upload.row_count, 100)
+        self.assertTrue(pa.types.is_large_string(open_sidecar(sidecar_path(upload)).schema_arrow.field('city').type))
+        window = grid.read_window(upload, limit=3, sort=('city', True))
+        self.assertEqual([row[1] for row in window['rows']], ['Pune'] * 3)
+
+
+class ComputeLockTests(UploadTestCase):
+    def test_file_cache_lock_is_exclusive_until_released(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+        backend = {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location}
+        with override_settings(CACHES={'default': backend}):
+            first, second = ComputeLock('preview_x'), ComputeLock('preview_x')
+            self.assertTrue(first.acquire())
+            self.assertFalse(second.acquire())
+            first.release()
+            self.assertTrue(second.acquire())
+            second.release()
+
+    def test_file_cache_locks_are_per_key_and_removed_on_release(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+        backend = {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location}
+        with override_settings(CACHES={'default': backend}):
+            locks = [ComputeLock(f'preview_{i}') for i in range(200)]
+            self.assertTrue(all(lock.acquire() for lock in locks))
+            for lock in locks:
+                lock.release()
+            self.assertEqual(os.listdir(os.path.join(location, 'locks')), [])
+
+    def test_release_leaves_a_lock_taken_over_by_another_worker(self):
+        lock = ComputeLock('preview_x')
+        self.assertTrue(lock.acquire())
+        # Our lock expired mid-compute and another worker took it
+        cache.set(lock.key, 'other-token')
+        lock.release()
+        self.assertEqual(cache.get(lock.key), 'other-token')
+
+
+class GridOrderCacheTests(UploadTestCase):
+    def test_row_orders_are_evicted_least_recently_used_first(self):
+        upload = self.make_upload(csv_text(['a', 'b', 'c'], [(i, -i, i % 7) for i in range(200)]))
+        directory = sidecar_index_dir(sidecar_path(upload))
+        # Room for two orders of 200 positions
+        with override_settings(GRID_ORDER_CACHE_BYTES=4000):
+            grid.read_window(upload, sort=('a', False))
+            grid.read_window(upload, sort=('b', False))
+            grid.read_window(upload, sort=('a', False))
+            window = grid.read_window(upload, sort=('c', True))
+        self.assertEqual(window['rows'][0][2], 6)
+        self.assertEqual(len([name for name in os.listdir(directory) if name.startswith('order-')]), 2)
+
+        with mock.patch.object(grid, '_compute_order', wraps=grid._compute_order) as compute:
+            grid.read_window(upload, sort=('a', False))
+            self.assertEqual(compute.call_count, 0)
+            grid.read_window(upload, sort=('b', False))
+            self.assertEqual(compute.call_count, 1)
+
+
+class ChunkedUploadTests(UploadTestCase):
+    def rollup(self):
+        return UploadRollup.objects.filter(extension='csv').values_list('upload_count', 'total_size').first()
+
+    def test_upload_is_counted_once_its_last_chunk_arrives(self):
+        data = csv_text(['a', 'b'], [(i, i * 2) for i in range(50)]).encode()
+        session = chunked.start_session('chunked', '', 'chunked.csv', len(data))
+        self.assertIsNone(self.rollup())
+
+        chunked.append_chunk(session, 0, io.BytesIO(data[:100]), 100)
+        self.assertIsNone(self.rollup())
+        chunked.append_chunk(session, 100, io.BytesIO(data[100:]), len(data) - 100)
+        self.assertEqual(self.rollup(), (1, len(data)))
+
+    def test_abandoned_sessions_are_deleted_with_their_files(self):
+        self.make_upload(csv_text(['a'], [(1,)]))
+        totals = self.rollup()
+        session = chunked.start_session('abandoned', '', 'abandoned.csv', 1000)
+        chunked.append_chunk(session, 0, io.BytesIO(b'a,b\n1,2\n'), 8)
+        path = session.upload.file.path
+        old = timezone.now() - timedelta(days=2)
+        UploadSession.objects.filter(pk=session.pk).update(created_at=old)
+
+        # Still being written to: kept
+        self.assertEqual(chunked.expire_sessions(), 0)
+        os.utime(path, (old.timestamp(), old.timestamp()))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(chunked.expire_sessions(), 1)
+
+        self.assertFalse(DataUpload.objects.filter(pk=session.upload_id).exists())
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.rollup(), totals)
+
+
+class UploadLockTests(UploadTestCase):
+    def test_lock_is_exclusive_across_threads(self):
+        upload = self.make_upload(csv_text(['a'], [(1,), (2,)]))
+        entered = threading.Event()
+
+        def rebuild():
+            with upload_lock(upload):
+                entered.set()
+
+        with upload_lock(upload):
+            worker = threading.Thread(target=rebuild)
+            worker.start()
+            self.assertFalse(entered.wait(0.3))
+        worker.join(5)
+        self.assertTrue(entered.is_set())
+
+    def test_append_may_rebuild_the_sidecar_while_holding_the_lock(self):
+        upload = self.make_upload(csv_text(['a', 'b'], [(1, 'x'), (2, 'y')]))
+        os.remove(sidecar_path(upload))
+        path = write_csv(self, csv_text(['a', 'b'], [(3, 'z')]))
+        self.assertEqual(append_rows(upload, path), 1)
+
+
+class KeysetPageTests(UploadTestCase):
+    def setUp(self):
+        super().setUp()
+        now = timezone.now()
+        # Three uploads share a timestamp, so pages have to break ties on id
+        times = [now - timedelta(minutes=minutes) for minutes in (0, 1, 1, 1, 2, 3, 4)]
+        for index, uploaded_at in enumerate(times):
+            DataUpload.objects.create(title=f'u{index}', file='u.csv', file_extension='csv', uploaded_at=uploaded_at)
+        self.expected = list(DataUpload.objects.order_by('-uploaded_at', '-id').values_list('pk', flat=True))
+
+    def test_next_cursors_walk_every_upload_once_in_order(self):
+        seen, cursor = [], None
+        while True:
+            page = keyset_page(DataUpload.objects.all(), 2, after=cursor)
+            seen.extend(upload.pk for upload in page)
+            if not page.has_next():
+                break
+            cursor = page.next_cursor
+        self.assertEqual(seen, self.expected)
+
+    def test_previous_cursor_returns_the_page_before(self):
+        first = keyset_page(DataUpload.objects.all(), 3)
+        second = keyset_page(DataUpload.objects.all(), 3, after=first.next_cursor)
+        self.assertTrue(second.has_previous())
+        back = keyset_page(DataUpload.objects.all(), 3, before=second.previous_cursor)
+        self.assertEqual([upload.pk for upload in back], [upload.pk for upload in first])
+        self.assertFalse(back.has_previous())
+
+    def test_malformed_cursor_is_rejected(self):
+        with self.assertRaises(CursorError):
+            keyset_page(DataUpload.objects.all(), 2, after='not-a-cursor')
+
+
+class AppendRowsTests(UploadTestCase):
+    header = ['id', 'city', 'amount']
+
+    def rows(self, start, stop):
+        return [(i, ['Oslo', 'Lima', 'Pune'][i % 3], round(i * 1.5, 1) if i % 7 else None) for i in range(start, stop)]
+
+    def test_merged_profile_and_row_index_match_a_full_ingestion(self):
+        upload = self.make_upload(csv_text(self.header, self.rows(0, 120)))
+        added = append_rows(upload, write_csv(self, csv_text(self.header, self.rows(120, 200))))
+        upload.refresh_from_db()
+        self.assertEqual(added, 80)
+        self.assertEqual(upload.row_count, 200)
+
+        whole = self.make_upload(csv_text(self.header, self.rows(0, 200)), 'whole.csv')
+        merged = SheetProfile.objects.get(upload=upload).profile
+        expected = SheetProfile.objects.get(upload=whole).profile
+        self.assertEqual(merged['stats']['row_count'], expected['stats']['row_count'])
+        self.assertEqual(len(merged['column_stats']), len(expected['column_stats']))
+        for merged_column, expected_column in zip(merged['column_stats'], expected['column_stats']):
+            self.assertEqual(merged_column.keys(), expected_column.keys())
+            for name, value in expected_column.items():
+                # Variances summed in another order differ in the last bits
+                if isinstance(value, float):
+                    self.assertAlmostEqual(merged_column[name], value, msg=name)
+                else:
+                    self.assertEqual(merged_column[name], value, msg=name)
+
+        sidecar = sidecar_path(upload)
+        # Start of every row, then the end of the file
+        self.assertEqual(len(load_row_index(upload, sidecar, open_sidecar(sidecar))), 201)
+        window = grid.read_window(upload, offset=118, limit=4)
+        self.assertEqual([row[0] for row in window['rows']], [118, 119, 120, 121])
+        self.assertEqual(window['total'], 200)
+
+    def test_rows_that_change_a_column_type_reingest_the_upload(self):
+        upload = self.make_upload(csv_text(self.header, self.rows(0, 20)))
+        added = append_rows(upload, write_csv(self, csv_text(self.header, [('x1', 'Oslo', 1.0)])))
+        upload.refresh_from_db()
+        self.assertEqual(added, 1)
+        self.assertEqual(upload.row_count, 21)
+
+
+class ProfilerStateTests(UploadTestCase):
+    def chunks(self, start, stop):
+        index = np.arange(start, stop)
+        return [pd.DataFrame({
+            'id': index,
+            'amount': np.where(index % 7 == 0, np.nan, index * 1.5),
+            'city': pd.Series(np.array(['Oslo', 'Lima', 'Pune'])[index % 3]).where(index % 5 != 0),
+            'seen': pd.Timestamp('2024-01-01') + pd.to_timedelta(index, unit='h'),
+            'paid': index % 2 == 0,
+        })]
+
+    def test_stored_profiler_merges_like_the_one_in_memory(self):
+        for approximate in (False, True):
+            with self.subTest(approximate=approximate):
+                first = build_profiler(self.chunks(0, 3000), approximate=approximate)
+                sidecar = os.path.join(self.media_root, f'first-{approximate}.parquet')
+                save_profiler(sidecar, first, 'v1')
+                self.assertIsNone(load_profiler(sidecar, 'v2'))
+                stored = load_profiler(sidecar, 'v1')
+                self.assertEqual(to_json_safe(stored.result()), to_json_safe(first.result()))
+
+                first.merge(build_profiler(self.chunks(3000, 5000), approximate=approximate))
+                stored.merge(build_profiler(self.chunks(3000, 5000), approximate=approximate))
+                self.assertEqual(to_json_safe(stored.result()), to_json_safe(first.result()))
+
+    def test_unreadable_state_is_ignored(self):
+        sidecar = os.path.join(self.media_root, 'rows.parquet')
+        with open(sidecar + '.state', 'wb') as f:
+            f.write(b'not an archive')
+        self.assertIsNone(load_profiler(sidecar, 'v1'))
+
+
+class RunParallelTests(UploadTestCase):
+    def test_every_call_reuses_the_shared_pool(self):
+        created = []
+
+        def pool(**kwargs):
+            created.append(kwargs)
+            return ThreadPoolExecutor(max_workers=kwargs['max_workers'])
+
+        with mock.patch.object(jobs, '_executor', None), mock.patch.object(jobs, 'ProcessPoolExecutor', pool), \
+                override_settings(INGEST_ASYNC=True):
+            self.assertEqual(jobs.run_parallel(abs, [-1, -2, -3]), [1, 2, 3])
+            self.assertEqual(jobs.run_parallel(abs, [-4, -5]), [4, 5])
+            jobs._executor.shutdown()
+        self.assertEqual(len(created), 1)
+
+
+class BlobTests(UploadTestCase):
+    def test_identical_files_share_one_blob_until_the_last_release(self):
+        text = csv_text(['a'], [(1,), (2,)])
+        first, second = self.store_upload(text, 'first.csv'), self.store_upload(text, 'second.csv')
+        blob = StoredBlob.objects.get()
+        self.assertEqual(blob.ref_count, 2)
+        self.assertEqual(first.file.name, second.file.name)
+        path = first.file.path
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 1)
+        self.assertTrue(os.path.exists(path))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(StoredBlob.objects.exists())
+        self.assertFalse(os.path.exists(path))
+
+    def test_different_content_gets_its_own_blob(self):
+        self.store_upload(csv_text(['a'], [(1,)]), 'one.csv')
+        self.store_upload(csv_text(['a'], [(2,)]), 'two.csv')
+        self.assertEqual(list(StoredBlob.objects.values_list('ref_count', flat=True)), [1, 1])
+
+
+class QueryTests(UploadTestCase):
+    def setUp(self):
+        super().setUp()
+        rows = [(['north', 'south', 'east'][i % 3], 2024 + i % 2, i * 10 if i % 5 else None) for i in range(90)]
+        self.frame = pd.DataFrame(rows, columns=['region', 'year', 'revenue'])
+        self.upload = self.make_upload(csv_text(self.frame.columns, rows))
+
+    def test_grouped_aggregates_match_pandas(self):
+        result = run_query(self.upload, {
+            'where': ['year:eq:2025'],
+            'group_by': ['region'],
+            'aggregates': [
+                {'op': 'sum', 'column': 'revenue', 'as': 'total'},
+                {'op': 'mean', 'column': 'revenue', 'as': 'average'},
+                {'op': 'count', 'column': 'revenue', 'as': 'filled'},
+                {'op': 'count', 'as': 'rows'},
+            ],
+            'order_by': ['region'],
+        })
+        selected = self.frame[self.frame['year'] == 2025].groupby('region')['revenue']
+        expected = pd.DataFrame({
+            'total': selected.sum(), 'average': selected.mean(), 'filled': selected.count(), 'rows': selected.size(),
+        }).sort_index()
+        self.assertEqual(result['columns'], ['region', 'total', 'average', 'filled', 'rows'])
+        self.assertEqual([row[0] for row in result['rows']], list(expected.index))
+        for row, (_, values) in zip(result['rows'], expected.iterrows()):
+            self.assertEqual(row[1], values['total'])
+            self.assertAlmostEqual(row[2], values['average'])
+            self.assertEqual(row[3:], [values['filled'], values['rows']])
+
+    def test_filtered_selection_matches_pandas(self):
+        result = run_query(self.upload, {
+            'select': ['region', 'revenue'], 'where': [['revenue', 'gt', '500']], 'order_by': ['-revenue'], 'limit': 5,
+        })
+        expected = self.frame[self.frame['revenue'] > 500].sort_values('revenue', ascending=False).head(5)
+        self.assertEqual(result['rows'], [[region, revenue] for region, revenue in zip(expected['region'], expected['revenue'])])
+
+
+class MaterializedFilterTests(UploadTransactionTestCase):
+    def test_sqlite_and_parquet_filters_agree_for_every_op(self):
+        days = ['2025-01-14', '2025-01-15', '2025-01-16']
+        rows = [(i, days[i % 3], i * 0.5, ['a', 'b'][i % 2], ['true', 'false'][i % 2]) for i in range(33)]
+        upload = self.make_upload(csv_text(['n', 'when', 'x', 'label', 'flag'], rows))
+        columns = {'n': '16', 'when': '2025-01-15', 'x': '8.0', 'label': 'b', 'flag': 'true'}
+        materialize_upload(upload, index_columns=list(columns))
+        upload.refresh_from_db()
+        sidecar = sidecar_path(upload)
+
+        for column, value in columns.items():
+            for op in list(grid.FILTER_OPS) + ['contains']:
+                with self.subTest(column=column, op=op):
+                    filters = [(column, op, value)]
+                    expected = grid._compute_order(open_sidecar(sidecar), None, filters)
+                    positions = query_positions(upload, None, None, filters)
+                    if positions is not None:
+                        self.assertEqual(list(positions), list(expected))
+                    if op == 'eq':
+                        self.assertGreater(len(expected), 0)
+
+
+class AdminDeleteTests(UploadTransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.force_login(user)
+
+    def table_exists(self, name):
+        with connection.cursor() as cursor:
+            return name in connection.introspection.table_names(cursor)
+
+    def test_admin_delete_drops_the_table_and_the_file(self):
+        upload = self.make_upload(csv_text(['a'], [(1,), (2,)]))
+        table_name = materialize_upload(upload)
+        path = upload.file.path
+        self.assertTrue(self.table_exists(table_name))
+
+        response = self.client.post(reverse('admin:dashboard_dataupload_delete', args=[upload.pk]), {'post': 'yes'})
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(DataUpload.objects.exists())
+        self.assertFalse(self.table_exists(table_name))
+        self.assertFalse(os.path.exists(path))
+
+    def test_admin_bulk_delete_releases_shared_blobs(self):
+        text = csv_text(['a'], [(1,), (2,)])
+        uploads = [self.store_upload(text, 'first.csv'), self.store_upload(text, 'second.csv')]
+        path = uploads[0].file.path
+        self.assertEqual(StoredBlob.objects.get().ref_count, 2)
+
+        response = self.client.post(reverse('admin:dashboard_dataupload_changelist'), {
+            'action': 'delete_selected', '_selected_action': [upload.pk for upload in uploads], 'post': 'yes',
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(DataUpload.objects.exists())
+        self.assertFalse(StoredBlob.objects.exists())
+        self.assertFalse(os.path.exists(path))
+
+
+class StreamingProfileTests(UploadTestCase):
+    def frame(self):
+        index = np.arange(500)
+        return pd.DataFrame({
+            'amount': np.where(index % 9 == 0, np.nan, (index * 37 % 101) / 4),
+            'city': pd.Series(np.array(['Oslo', 'Lima', 'Pune', 'Oslo'])[index % 4]).where(index % 11 != 0),
+        })
+
+    def test_chunked_profile_matches_pandas_over_the_whole_frame(self):
+        frame = self.frame()
+        profile = profile_chunks(frame.iloc[start:start + 37] for start in range(0, len(frame), 37))
+        self.assertEqual(profile['stats']['row_count'], 500)
+        self.assertEqual(len(profile['sample_data']), 50)
+        amount, city = profile['column_stats']
+
+        self.assertEqual(amount['null_count'], frame['amount'].isna().sum())
+        self.assertEqual(amount['min'], frame['amount'].min())
+        self.assertEqual(amount['max'], frame['amount'].max())
+        self.assertAlmostEqual(amount['mean'], frame['amount'].mean())
+        self.assertAlmostEqual(amount['std'], frame['amount'].std())
+
+        self.assertEqual(city['null_count'], frame['city'].isna().sum())
+        self.assertEqual(city['unique_values'], 3)
+        self.assertEqual(city['most_common'], 'Oslo')
+        self.assertEqual(city['top_values'][0]['count'], (frame['city'] == 'Oslo').sum())
+
+
+class WorkbookTests(UploadTestCase):
+    def workbook(self):
+        workbook = Workbook()
+        orders = workbook.active
+        orders.title = 'Orders'
+        orders.append(['id', 'amount'])
+        for i in range(30):
+            orders.append([i, i * 2.5])
+        people = workbook.create_sheet('People')
+        people.append(['name', 'age', 'city'])
+        for i in range(12):
+            people.append([f'person {i}', 20 + i, ['Oslo', 'Lima'][i % 2]])
+        buffer = io.BytesIO()
+        workbook.save(buffer)
+        return buffer.getvalue()
+
+    def test_every_sheet_is_profiled_on_the_pool_and_kept_apart(self):
+        def pool(**kwargs):
+            return ThreadPoolExecutor(max_workers=kwargs['max_workers'])
+
+        with mock.patch.object(jobs, '_executor', None), mock.patch.object(jobs, 'ProcessPoolExecutor', pool), \
+                override_settings(INGEST_ASYNC=True):
+            upload = self.make_upload(self.workbook(), 'book.xlsx')
+            jobs._executor.shutdown()
+
+        self.assertEqual(upload.sheet_names, ['Orders', 'People'])
+        self.assertEqual(upload.row_count, 42)
+        sheets = list(SheetProfile.objects.filter(upload=upload))
+        self.assertEqual([(sheet.sheet_name, sheet.row_count, sheet.column_count) for sheet in sheets],
+                         [('Orders', 30, 2), ('People', 12, 3)])
+        self.assertEqual(sheets[1].profile['columns'], ['name', 'age', 'city'])
+
+        window = grid.read_window(upload, sheet='People', offset=10, limit=5)
+        self.assertEqual(window['total'], 12)
+        self.assertEqual(window['rows'], [['person 10', 30, 'Oslo'], ['person 11', 31, 'Lima']])
+
+
+class ExportTests(UploadTestCase):
+    header = ['id', 'city', 'amount']
+    rows = [(i, ['Oslo', 'Lima', 'Pune'][i % 3], i * 1.5) for i in range(50)]
+
+    def setUp(self):
+        super().setUp()
+        self.upload = self.make_upload(csv_text(self.header, self.rows))
+        batches = mock.patch.object(export, 'EXPORT_BATCH_ROWS', 7)
+        batches.start()
+        self.addCleanup(batches.stop)
+
+    def get(self, **params):
+        return self.client.get(reverse('dashboard:export_upload', args=[self.upload.pk]), params)
+
+    def test_csv_is_streamed_one_batch_at_a_time(self):
+        response = self.get(format='csv')
+        self.assertTrue(response.streaming)
+        chunks = list(response.streaming_content)
+        self.assertEqual(len(chunks), 8)
+        frame = pd.read_csv(io.BytesIO(b''.join(chunks)))
+        self.assertEqual(list(frame.columns), self.header)
+        self.assertEqual(list(frame.itertuples(index=False, name=None)), self.rows)
+
+    def test_filtered_ndjson_is_gzipped(self):
+        response = self.get(format='ndjson', gzip='1', filter='id:ge:45')
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        lines = gzip.decompress(b''.join(response.streaming_content)).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines],
+                         [dict(zip(self.header, row)) for row in self.rows[45:]])
+
+    def test_xlsx_holds_the_header_and_every_row(self):
+        response = self.get(format='xlsx')
+        worksheet = load_workbook(io.BytesIO(b''.join(response.streaming_content)), read_only=True).active
+        values = list(worksheet.iter_rows(values_only=True))
+        self.assertEqual(values[0], tuple(self.header))
+        self.assertEqual(values[1:], self.rows)
+
+    def test_unknown_format_is_rejected(self):
+        self.assertEqual(self.get(format='parquet').status_code, 400)
+
+
+class AsyncViewTests(UploadTransactionTestCase):
+    header = ['id', 'city']
+    rows = [(i, ['Oslo', 'Lima', 'Pune'][i % 3]) for i in range(30)]
+
+    def setUp(self):
+        super().setUp()
+        self.upload = self.make_upload(csv_text(self.header, self.rows))
+
+    def url(self, name):
+        return reverse(f'dashboard:{name}', args=[self.upload.pk])
+
+    async def test_rows_are_served_sorted_and_filtered(self):
+        response = await self.async_client.get(self.url('data_rows'), {'sort': '-id', 'filter': 'city:eq:Lima', 'limit': 3})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['rows'], [[28, 'Lima'], [25, 'Lima'], [22, 'Lima']])
+
+    async def test_rows_wait_for_ingestion(self):
+        await DataUpload.objects.filter(pk=self.upload.pk).aupdate(status=DataUpload.STATUS_PROCESSING)
+        response = await self.async_client.get(self.url('data_rows'))
+        self.assertEqual(response.status_code, 409)
+        status = json.loads((await self.async_client.get(self.url('upload_status'))).content)
+        self.assertEqual(status['status'], DataUpload.STATUS_PROCESSING)
+
+    async def test_events_of_a_ready_upload_end_after_one_progress_event(self):
+        response = await self.async_client.get(self.url('upload_events'))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        body = ''.join([chunk.decode() async for chunk in response.streaming_content])
+        self.assertEqual(body.count('event: progress'), 1)
+        self.assertIn(f'"status": "{DataUpload.STATUS_READY}"', body)
+
+    async def test_preview_page_lists_the_columns(self):
+        response = await self.async_client.get(self.url('data_preview'))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Lima')
+        self.assertContains(response, 'city')
+
+
+class MetricsTests(UploadTestCase):
+    sample_re = re.compile(r'^(?P<name>[a-zA-Z_:][a-zA-Z0-9_:]*)(?P<labels>\{(?:[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\\n]|\\.)*",?)*\})? (?P<value>\S+)$')
+
+    def setUp(self):
+        super().setUp()
+        registry = mock.patch.object(metrics, 'registry', metrics.Registry())
+        registry.start()
+        self.addCleanup(registry.stop)
+
+    @override_settings(METRICS_TOKEN='scraper-token')
+    def test_metrics_are_valid_prometheus_text(self):
+        upload = self.make_upload(csv_text(['a'], [(1,), (2,)]))
+        for _ in range(2):
+            self.client.get(reverse('dashboard:data_rows', args=[upload.pk]))
+        self.assertEqual(self.client.get(reverse('dashboard:metrics')).status_code, 403)
+
+        response = self.client.get(reverse('dashboard:metrics'), HTTP_AUTHORIZATION='Bearer scraper-token')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        types, samples = {}, {}
+        for line in response.content.decode().splitlines():
+            if line.startswith('# TYPE '):
+                _, _, name, kind = line.split(' ')
+                types[name] = kind
+                continue
+            match = self.sample_re.match(line)
+            self.assertIsNotNone(match, line)
+            samples[match.group('name') + (match.group('labels') or '')] = float(match.group('value'))
+            # Every sample belongs to a declared family
+            name = match.group('name')
+            self.assertTrue(name in types or re.sub(r'_(bucket|sum|count)$', '', name) in types, line)
+
+        labels = '{view="dashboard:data_rows"}'
+        self.assertEqual(types['dashboard_request_seconds'], 'histogram')
+        self.assertEqual(samples[f'dashboard_request_seconds_count{labels}'], 2)
+        buckets = [value for key, value in samples.items()
+                   if key.startswith('dashboard_request_seconds_bucket{view="dashboard:data_rows"')]
+        self.assertEqual(buckets, sorted(buckets))
+        self.assertEqual(buckets[-1], 2)
+
+
+class RowIndexTests(UploadTestCase):
+    def note(self, i):
+        return f'line {i}\nsecond, with "quotes"' if i % 4 == 0 else f'plain {i}'
+
+    def text(self):
+        lines = ['id,note,amount']
+        for i in range(60):
+            note = self.note(i).replace('"', '""')
+            lines.append(f'{i},"{note}",{i * 1.5}' if i % 4 == 0 else f'{i},{note},{i * 1.5}')
+            if i % 10 == 9:
+                lines.append('')
+        # The last record has no newline
+        return '\n'.join(lines)
+
+    def test_blank_lines_fold_into_the_record_before_them(self):
+        data = np.frombuffer(b'a,b\n1,"x\ny"\n\n2,z', dtype=np.uint8)
+        self.assertEqual(row_offsets(data).tolist(), [4, 13, 16])
+
+    def test_offsets_match_the_sidecar_rows_across_quoted_newlines(self):
+        upload = self.make_upload(self.text())
+        sidecar = sidecar_path(upload)
+        parquet = open_sidecar(sidecar)
+        offsets = load_row_index(upload, sidecar, parquet)
+        self.assertIsNotNone(offsets)
+        self.assertEqual(len(offsets), 61)
+
+        positions = [59, 0, 12, 13, 40, 41]
+        table = take_csv_rows(upload.file.path, offsets, positions, parquet.schema_arrow)
+        self.assertTrue(table.equals(grid.take_rows(parquet, positions).cast(parquet.schema_arrow.remove_metadata())))
+        self.assertEqual(table.column('note').to_pylist(), [self.note(i) for i in positions])
+
+
+class SketchTests(UploadTestCase):
+    def parts(self, values, count=8):
+        step = -(-len(values) // count)
+        return [values[start:start + step] for start in range(0, len(values), step)]
+
+    def test_merged_hyperloglog_equals_a_single_pass(self):
+        values = pd.Series(np.random.default_rng(1).integers(0, 40000, 100000))
+        whole, merged = HyperLogLog(), HyperLogLog()
+        whole.update(values)
+        for part in self.parts(values):
+            sketch = HyperLogLog()
+            sketch.update(part)
+            merged.merge(sketch)
+        self.assertTrue(np.array_equal(merged.registers, whole.registers))
+        distinct = values.nunique()
+        self.assertLess(abs(merged.estimate() - distinct), 3 * merged.relative_error * distinct)
+
+    def test_merged_kll_quantiles_stay_within_the_rank_error(self):
+        values = np.random.default_rng(2).lognormal(size=100000)
+        whole, merged = QuantileSketch(), QuantileSketch()
+        whole.update(values)
+        for part in self.parts(values):
+            sketch = QuantileSketch()
+            sketch.update(part)
+            merged.merge(sketch)
+        self.assertEqual(merged.n, whole.n)
+        fractions = [0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99]
+        ordered = np.sort(values)
+        for sketch in (whole, merged):
+            ranks = np.searchsorted(ordered, sketch.quantiles(fractions), side='right') / len(values)
+            self.assertLess(np.abs(ranks - fractions).max(), sketch.rank_error)
+
+    def test_merged_space_saving_bounds_the_true_counts(self):
+        rng = np.random.default_rng(3)
+        values = pd.Series(rng.zipf(1.3, 50000) % 5000)
+        merged = SpaceSaving()
+        for part in self.parts(values):
+            sketch = SpaceSaving()
+            sketch.update(part)
+            merged.merge(sketch)
+        counts = values.value_counts()
+        top = merged.top(10)
+        self.assertEqual([value for value, _, _ in top[:3]], counts.index[:3].tolist())
+        for value, count, error in top:
+            self.assertLessEqual(count - error, counts[value])
+            self.assertLessEqual(counts[value], count)
+
+    @override_settings(PROFILE_MODE='approximate')
+    def test_approximate_profiles_report_their_error_bounds(self):
+        upload = self.make_upload(csv_text(['id', 'city'], [(i, ['Oslo', 'Lima', 'Pune'][i % 3]) for i in range(300)]))
+        profile = SheetProfile.objects.get(upload=upload).profile
+        self.assertTrue(profile['stats']['approximate'])
+        city = profile['column_stats'][1]
+        self.assertEqual(city['unique_values'], 3)
+        self.assertIn('unique_values_error', city)
+        self.assertEqual(city['top_values'][0], {'value': 'Oslo', 'count': 100, 'error': 0})
+
+
+class HistogramTests(UploadTestCase):
+    def test_merged_histogram_counts_every_value_in_its_bin(self):
+        values = np.random.default_rng(4).normal(50, 20, 20000)
+        whole, merged = Histogram(), Histogram()
+        whole.update(values)
+        for start in range(0, len(values), 3000):
+            part = Histogram()
+            # Parts with narrower ranges get finer bins, which the merge widens
+            part.update(values[start:start + 3000] / (1 + start // 3000))
+            merged.merge(part)
+        edges, counts = whole.bins(20)
+        self.assertLessEqual(len(counts), 20)
+        self.assertEqual(counts, np.histogram(values, bins=edges)[0].tolist())
+        self.assertEqual(sum(merged.bins(20)[1]), len(values))
+
+    def test_profile_lists_histogram_quantiles_and_top_values(self):
+        rows = [(i, ['Oslo', 'Lima', 'Pune', 'Oslo'][i % 4]) for i in range(1000)]
+        upload = self.make_upload(csv_text(['amount', 'city'], rows))
+        amount, city = SheetProfile.objects.get(upload=upload).profile['column_stats']
+
+        self.assertEqual(sum(amount['histogram']['counts']), 1000)
+        self.assertEqual(len(amount['histogram']['edges']), len(amount['histogram']['counts']) + 1)
+        for name, value in amount['quantiles'].items():
+            fraction = {'p1': 0.01, 'p25': 0.25, 'p50': 0.5, 'p75': 0.75, 'p99': 0.99}[name]
+            self.assertLessEqual(abs((value + 1) / 1000 - fraction), amount['rank_error'] + 0.001, name)
+
+        self.assertEqual(city['top_values'], [
+            {'value': 'Oslo', 'count': 500, 'error': 0},
+            {'value': 'Lima', 'count': 250, 'error': 0},
+            {'value': 'Pune', 'count': 250, 'error': 0},
+        ])
+
+
+class RetryWriteTests(UploadTransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        sleep = mock.patch('dashboard.database.time.sleep')
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def flaky(self, failures, error='database is locked'):
+        calls = []
+
+        @retry_write
+        def write():
+            calls.append(1)
+            if len(calls) <= failures:
+                raise OperationalError(error)
+            return DataUpload.objects.create(title='written').pk
+
+        return write, calls
+
+    @override_settings(DATABASE_WRITE_ATTEMPTS=4)
+    def test_locked_writes_are_retried_with_growing_pauses(self):
+        write, calls = self.flaky(2)
+        with self.assertLogs('dashboard.database', 'WARNING') as logs:
+            self.assertTrue(DataUpload.objects.filter(pk=write()).exists())
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(len(logs.records), 2)
+        first, second = [call.args[0] for call in self.sleep.call_args_list]
+        self.assertLess(first, second)
+
+    @override_settings(DATABASE_WRITE_ATTEMPTS=3)
+    def test_retries_stop_after_the_configured_attempts(self):
+        write, calls = self.flaky(5)
+        with self.assertRaises(OperationalError), self.assertLogs('dashboard.database', 'WARNING'):
+            write()
+        self.assertEqual(len(calls), 3)
+
+    def test_other_errors_and_enclosing_transactions_are_not_retried(self):
+        write, calls = self.flaky(1, error='no such table: nowhere')
+        with self.assertRaises(OperationalError):
+            write()
+        self.assertEqual(len(calls), 1)
+
+        write, calls = self.flaky(1)
+        with self.assertRaises(OperationalError), transaction.atomic():
+            write()
+        self.assertEqual(len(calls), 1)
+
+    def test_new_connections_get_the_configured_pragmas(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], settings.SQLITE_PRAGMAS['busy_timeout'])
+
+
+class PreviewFragmentTests(UploadTransactionTestCase):
+    def test_fragments_are_rendered_once_and_index_options_marked_per_request(self):
+        upload = self.make_upload(csv_text(['id', 'city'], [(i, ['Oslo', 'Lima'][i % 2]) for i in range(20)]))
+        url = reverse('dashboard:data_preview', args=[upload.pk])
+        with mock.patch.object(views, 'render_to_string', wraps=views.render_to_string) as render:
+            first = self.client.get(url)
+            rendered = render.call_count
+            materialize_upload(upload, index_columns=['city'])
+            second = self.client.get(url)
+        self.assertEqual(rendered, 3)
+        self.assertEqual(render.call_count, rendered)
+
+        rows = json.loads(re.search(r'<script id="preview-rows" type="application/json">(.*?)</script>',
+                                    first.content.decode(), re.S).group(1))
+        self.assertEqual(rows[:2], [[0, 'Oslo'], [1, 'Lima']])
+        self.assertNotContains(first, '<option value="city" selected>')
+        self.assertContains(second, '<option value="city" selected>')
+
+    def test_templates_are_compiled_once_per_process(self):
+        loader = engines['django'].engine.template_loaders[0]
+        self.assertEqual(type(loader).__module__, 'django.template.loaders.cached')
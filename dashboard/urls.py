@@ -7,6 +7,20 @@ urlpatterns = [
     path('', views.index, name='index'),  # Changed from 'dashboard' to 'index' to match templates
     path('upload/', views.upload_file, name='upload_file'),
     path('preview/<int:pk>/', views.data_preview, name='data_preview'),
+    path('preview/<int:pk>/status/', views.upload_status, name='upload_status'),
+    path('preview/<int:pk>/events/', views.upload_events, name='upload_events'),
+    path('preview/<int:pk>/rows/', views.data_rows, name='data_rows'),
+    path('preview/<int:pk>/query/', views.query_upload, name='query_upload'),
+    path('preview/<int:pk>/export/', views.export_upload, name='export_upload'),
+    path('preview/<int:pk>/diff/', views.upload_diff, name='upload_diff'),
+    path('preview/<int:pk>/append/', views.append_upload, name='append_upload'),
+    path('preview/<int:pk>/materialize/', views.materialize_upload, name='materialize_upload'),
+    path('delete/<int:pk>/', views.delete_upload, name='delete_upload'),
+    path('uploads/chunked/', views.chunked_upload_start, name='chunked_upload_start'),
+    path('uploads/chunked/<uuid:session_id>/', views.chunked_upload, name='chunked_upload'),
+    path('uploads/chunked/<uuid:session_id>/profile/', views.chunked_upload_profile, name='chunked_upload_profile'),
     path('uploads/', views.DataUploadListView.as_view(), name='upload_list'),
+    path('performance/', views.performance, name='performance'),
+    path('metrics/', views.metrics_export, name='metrics'),
     path('debug/', views.debug_upload, name='debug_upload'),  # New debug URL
 ]
\ No newline at end of file
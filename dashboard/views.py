@@ -1,29 +1,63 @@
-from django.shortcuts import render, redirect, get_object_or_404
+from django.shortcuts import render, redirect, get_object_or_404, aget_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
 from django.views.generic import ListView, DetailView
-from django.http import JsonResponse
+from django.http import JsonResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.views.decorators.http import require_POST
 from django_tables2 import SingleTableView
 from django.urls import reverse
-from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.html import format_html, format_html_join
+from django.utils.safestring import mark_safe
 from django.conf import settings
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Substr
+from asgiref.sync import sync_to_async
 
-from .models import DataUpload, DataPreview
-from .forms import DataUploadForm
+from .models import DataUpload, DataPreview, UploadSession
+from .forms import AppendForm, DataUploadForm, MaterializeForm, ChunkedUploadForm, DiffForm
+from .jobs import enqueue_append, enqueue_ingestion, enqueue_materialization
+from .caching import PREVIEW_CACHE_TIMEOUT, get_or_compute, versioned_key
+from .columnar import ensure_sidecars
+from .appending import AppendError, check_appendable
+from .processing import get_sheet_profile
+from .grid import GridError, parse_filters, parse_sort, read_window, DEFAULT_LIMIT
+from .query import run_query, sheet_columns
+from .diff import cached_diff
+from .export import EXPORT_FORMATS, export_filename, export_rows
+from .summary import dashboard_summary
+from .listing import CursorError, keyset_page, search_uploads
+from .blobs import attach_blob, received_sha256
+from .chunked import ChunkError, append_chunk, profile_received, start_session
+from .offload import call_bounded, run_blocking
+from . import metrics
 
+import asyncio
 import pandas as pd
 import numpy as np
 import json
 import sys  # Added for debug_upload view
 import os
+from urllib.parse import urlencode
 
-# Cache timeout in seconds (10 minutes)
-CACHE_TIMEOUT = 60 * 10
+# Server-Sent Events for job progress: how often the job is checked, the
+# idle gap before a keep-alive comment, how long one stream stays open
+# and how soon the browser reconnects
+SSE_POLL_SECONDS = 0.5
+SSE_HEARTBEAT_SECONDS = 15
+SSE_MAX_SECONDS = 300
+SSE_RETRY_MS = 2000
 
 def index(request):
     """Dashboard home page"""
-    recent_uploads = DataUpload.objects.all().order_by('-uploaded_at')[:5]
-    return render(request, 'dashboard/index.html', {'recent_uploads': recent_uploads})
+    recent_uploads = (
+        DataUpload.objects.only('id', 'file', 'file_extension', 'file_size', 'uploaded_at')
+        .order_by('-uploaded_at', '-id')[:5]
+    )
+    context = dashboard_summary()
+    context['recent_uploads'] = recent_uploads
+    return render(request, 'dashboard/index.html', context)
 
 def upload_file(request):
     """Handle file uploads"""
@@ -34,21 +68,23 @@ def upload_file(request):
                 # Check if a file was actually provided
                 if 'file' not in request.FILES:
                     messages.error(request, 'No file was selected. Please choose a file to upload.')
-                    return render(request, 'dashboard/upload_form.html', {'form': form})
+                    return render(request, 'dashboard/upload_form.html', {'form': form, 'chunk_size': settings.CHUNKED_UPLOAD_MAX_CHUNK})
                 
-                # Save the uploaded file
-                data_upload = form.save()
+                # Save the upload, storing the file only if its content is new
+                data_upload = form.save(commit=False)
+                attach_blob(data_upload, received_sha256(request, 'file'))
+                data_upload.save()
                 
-                # Process the uploaded file
-                process_excel_file(data_upload)
+                # Process the uploaded file in the background
+                enqueue_ingestion(data_upload)
                 
-                messages.success(request, 'File uploaded successfully!')
+                messages.success(request, 'File uploaded successfully! Processing has started.')
                 return redirect('dashboard:data_preview', pk=data_upload.pk)
             except Exception as e:
                 messages.error(request, f'Error uploading file: {str(e)}')
                 # Log the error for debugging
                 print(f"Upload error: {str(e)}")
-                return render(request, 'dashboard/upload_form.html', {'form': form})
+                return render(request, 'dashboard/upload_form.html', {'form': form, 'chunk_size': settings.CHUNKED_UPLOAD_MAX_CHUNK})
         else:
             # Display form errors
             for field, errors in form.errors.items():
@@ -57,169 +93,420 @@ def upload_file(request):
     else:
         form = DataUploadForm()
     
-    return render(request, 'dashboard/upload_form.html', {'form': form})
+    return render(request, 'dashboard/upload_form.html', {'form': form, 'chunk_size': settings.CHUNKED_UPLOAD_MAX_CHUNK})
 
-def data_preview(request, pk):
-    upload = get_object_or_404(DataUpload, pk=pk)
+def _session_payload(session):
+    upload = session.upload
+    return {
+        'id': str(session.pk),
+        'upload_id': upload.pk,
+        'offset': session.received,
+        'size': session.total_size,
+        'sha256': session.sha256,
+        'complete': session.is_complete(),
+        'chunk_url': reverse('dashboard:chunked_upload', args=[session.pk]),
+        'status_url': reverse('dashboard:upload_status', args=[upload.pk]),
+        'preview_url': reverse('dashboard:data_preview', args=[upload.pk]),
+    }
+
+@require_POST
+def chunked_upload_start(request):
+    """Start a resumable upload and return where to send its chunks"""
+    form = ChunkedUploadForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    session = start_session(
+        form.cleaned_data['title'],
+        form.cleaned_data['description'],
+        form.cleaned_data['filename'],
+        form.cleaned_data['size'],
+    )
+    return JsonResponse(_session_payload(session), status=201)
+
+def chunked_upload(request, session_id):
+    """GET the offset to resume from, or PUT the chunk that starts at it
+
+    PUT bodies are raw bytes; the ``Upload-Offset`` header (or ``offset``
+    query parameter) says where the chunk starts.
+    """
+    session = get_object_or_404(UploadSession.objects.select_related('upload'), pk=session_id)
+    if request.method == 'GET':
+        return JsonResponse(_session_payload(session))
+    if request.method != 'PUT':
+        return JsonResponse({'error': 'Use GET or PUT'}, status=405)
     
-    # Try to get cached data first
-    cache_key = f'data_preview_{pk}'
-    preview_data = cache.get(cache_key)
+    try:
+        offset = int(request.headers.get('Upload-Offset', request.GET.get('offset', -1)))
+        length = int(request.headers.get('Content-Length') or 0)
+        session = append_chunk(session, offset, request, length)
+    except ChunkError as e:
+        return JsonResponse({'error': str(e), 'offset': e.offset}, status=409)
+    except ValueError:
+        return JsonResponse({'error': 'Upload-Offset and Content-Length must be integers'}, status=400)
+    return JsonResponse(_session_payload(session))
+
+def chunked_upload_profile(request, session_id):
+    """Profile of the part of a CSV upload received so far"""
+    session = get_object_or_404(UploadSession.objects.select_related('upload'), pk=session_id)
+    try:
+        # Repeated polls at the same offset reuse one computation
+        profiled_bytes, profile = get_or_compute(
+            f'upload_session_profile_{session.pk}_{session.received}',
+            lambda: profile_received(session),
+            PREVIEW_CACHE_TIMEOUT,
+        )
+    except ChunkError as e:
+        return JsonResponse({'error': str(e), 'offset': e.offset}, status=409)
+    return JsonResponse({'offset': session.received, 'profiled_bytes': profiled_bytes, 'profile': profile})
+
+def _preview_fragments(upload, sheet_name, preview_data):
+    """HTML of the parts of the preview page that only depend on the sheet's content
+
+    The sample rows are sent row-major as JSON for the page script to
+    fill the grid with, rather than looked up cell by cell in a template.
+    """
+    columns = preview_data['columns']
+    inferred_types = dict(upload.previews.filter(sheet_name=sheet_name).values_list('column_name', 'inferred_type'))
+    # Histograms and most common values for the distribution chart
+    distributions = {
+        col['name']: {key: col[key] for key in ('histogram', 'quantiles', 'rank_error', 'top_values') if key in col}
+        for col in preview_data['column_stats'] if 'histogram' in col or 'top_values' in col
+    }
+    return {
+        'grid': render_to_string('dashboard/_preview_grid.html', {
+            'columns': columns,
+            'rows': [[row.get(column) for column in columns] for row in preview_data['sample_data']],
+        }),
+        'column_stats': render_to_string('dashboard/_column_stats.html', {
+            'column_stats': [
+                dict(col, inferred_type=inferred_types.get(col['name'], '')) for col in preview_data['column_stats']
+            ],
+        }),
+        'distributions': render_to_string('dashboard/_distributions.html', {'distributions': distributions}),
+        # Options of the index column picker, marked as selected per request
+        'index_options': format_html_join('', '<option value="{}">{}</option>', ((column, column) for column in columns)),
+    }
+
+def _preview_page(request, upload, sheet_name):
+    """Render the preview of one sheet; parses go through the bounded pool"""
+    if not upload.sheet_names:
+        # Uploads ingested before multi-sheet support: discover their sheets once
+        call_bounded(ensure_sidecars, upload)
     
-    if not preview_data:
-        # Cache miss, process the data
-        file_path = os.path.join(settings.MEDIA_ROOT, upload.file.name)
-        
-        if upload.get_extension() in ['.xlsx', '.xls']:
-            df = pd.read_excel(file_path)
-        else:  # CSV
-            df = pd.read_csv(file_path)
-            
-        # Basic data statistics
-        stats = {
-            'row_count': len(df),
-            'column_count': len(df.columns),
-            'memory_usage': df.memory_usage(deep=True).sum() / (1024 * 1024),  # MB
-        }
-        
-        # Generate column statistics
-        column_stats = []
-        for col in df.columns:
-            col_type = str(df[col].dtype)
-            
-            # Calculate statistics based on data type
-            if pd.api.types.is_numeric_dtype(df[col]):
-                col_stats = {
-                    'name': col,
-                    'type': col_type,
-                    'min': df[col].min() if not df[col].isna().all() else 'N/A',
-                    'max': df[col].max() if not df[col].isna().all() else 'N/A',
-                    'mean': df[col].mean() if not df[col].isna().all() else 'N/A',
-                    'null_count': df[col].isna().sum(),
-                    'null_percentage': round((df[col].isna().sum() / len(df)) * 100, 2)
-                }
-            else:
-                unique_values = df[col].nunique()
-                col_stats = {
-                    'name': col,
-                    'type': col_type,
-                    'unique_values': unique_values,
-                    'most_common': df[col].value_counts().index[0] if unique_values > 0 and unique_values < len(df) / 2 else 'Too many to display',
-                    'null_count': df[col].isna().sum(),
-                    'null_percentage': round((df[col].isna().sum() / len(df)) * 100, 2)
-                }
-            column_stats.append(col_stats)
-            
-        # Get sample data (first 50 rows)
-        sample_data = df.head(50).to_dict('records')
-        columns = list(df.columns)
-        
-        preview_data = {
-            'stats': stats,
-            'column_stats': column_stats,
-            'sample_data': sample_data,
-            'columns': columns
-        }
-        
-        # Save to cache
-        cache.set(cache_key, preview_data, CACHE_TIMEOUT)
-        
-        # Save preview data to database
-        try:
-            data_preview_obj, created = DataPreview.objects.update_or_create(
-                data_upload=upload,
-                defaults={
-                    'column_info': json.dumps(column_stats),
-                    'row_count': stats['row_count'],
-                    'preview_data': json.dumps(sample_data[:10])  # Store only first 10 rows
-                }
-            )
-        except Exception as e:
-            # Handle any database errors
-            print(f"Error saving preview data: {e}")
+    # Only the selected sheet is loaded; the other tabs load when opened
+    sheet_name = sheet_name or upload.sheet_names[0]
+    if sheet_name not in upload.sheet_names:
+        raise Http404(f"No sheet named '{sheet_name}'")
+    
+    # Two-tier cache keyed by content hash; on a miss use the profile
+    # stored at ingestion (or build it), computed by one worker at a time
+    cache_key = versioned_key('data_preview', upload, upload.sheet_names.index(sheet_name))
+    preview_data = get_or_compute(
+        cache_key, lambda: call_bounded(get_sheet_profile, upload, sheet_name), PREVIEW_CACHE_TIMEOUT,
+    )
+    
+    # The grid and column analysis of wide sheets cost more to render than to look up
+    fragments = get_or_compute(
+        versioned_key('preview_fragments', upload, upload.sheet_names.index(sheet_name)),
+        lambda: _preview_fragments(upload, sheet_name, preview_data), PREVIEW_CACHE_TIMEOUT,
+    )
+    
+    materialized = upload.tables.filter(sheet_name=sheet_name).first()
+    index_options = fragments['index_options']
+    for column in (materialized.indexed_columns if materialized else []):
+        option = format_html('<option value="{}">', column)
+        index_options = index_options.replace(option, option[:-1] + ' selected>', 1)
     
     context = {
         'upload': upload,
+        'sheets': upload.sheet_names,
+        'active_sheet': sheet_name,
         'stats': preview_data['stats'],
-        'column_stats': preview_data['column_stats'],
-        'sample_data': preview_data['sample_data'],
-        'columns': preview_data['columns']
+        'fragments': {name: mark_safe(html) for name, html in fragments.items()},
+        'materialized': materialized,
+        'index_options': mark_safe(index_options),
     }
     
     return render(request, 'dashboard/data_preview.html', context)
 
+async def data_preview(request, pk):
+    upload = await aget_object_or_404(DataUpload, pk=pk)
+    
+    # Show a progress page until the ingestion job has finished
+    if not upload.is_ready():
+        return await sync_to_async(render)(request, 'dashboard/data_preview.html', {'upload': upload, 'processing': True})
+    
+    return await sync_to_async(_preview_page, thread_sensitive=False)(request, upload, request.GET.get('sheet'))
+
+def _job_payload(upload):
+    return {
+        'id': upload.pk,
+        'status': upload.status,
+        'progress': upload.progress,
+        'message': upload.status_message,
+        'row_count': upload.row_count,
+        'preview_url': reverse('dashboard:data_preview', args=[upload.pk]),
+    }
+
+async def upload_status(request, pk):
+    """JSON progress of the ingestion job for an upload"""
+    upload = await aget_object_or_404(DataUpload, pk=pk)
+    return JsonResponse(_job_payload(upload))
+
+async def upload_events(request, pk):
+    """Server-Sent Events stream of an upload's ingestion progress
+
+    Sends a ``progress`` event whenever the job's state changes and ends
+    once the upload is ready or failed. Long streams are closed after
+    ``SSE_MAX_SECONDS``; the browser's EventSource reconnects by itself.
+    """
+    upload = await aget_object_or_404(DataUpload, pk=pk)
+    
+    async def events():
+        loop = asyncio.get_running_loop()
+        started = last_sent = loop.time()
+        last = None
+        yield f'retry: {SSE_RETRY_MS}\n\n'
+        while True:
+            payload = _job_payload(upload)
+            if payload != last:
+                yield f'event: progress\ndata: {json.dumps(payload)}\n\n'
+                last, last_sent = payload, loop.time()
+            elif loop.time() - last_sent >= SSE_HEARTBEAT_SECONDS:
+                # Comment line: keeps proxies from closing an idle stream
+                yield ': keep-alive\n\n'
+                last_sent = loop.time()
+            if upload.status in (DataUpload.STATUS_READY, DataUpload.STATUS_FAILED):
+                return
+            if loop.time() - started >= SSE_MAX_SECONDS:
+                return
+            await asyncio.sleep(SSE_POLL_SECONDS)
+            await upload.arefresh_from_db(fields=['status', 'progress', 'status_message', 'row_count'])
+    
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+async def data_rows(request, pk):
+    """JSON window of rows for the preview grid"""
+    upload = await aget_object_or_404(DataUpload, pk=pk)
+    if not upload.is_ready():
+        return JsonResponse({'error': 'Upload is still being processed', 'status': upload.status}, status=409)
+    
+    try:
+        offset = int(request.GET.get('offset', 0))
+        limit = int(request.GET.get('limit', DEFAULT_LIMIT))
+        window = await run_blocking(
+            read_window,
+            upload,
+            sheet=request.GET.get('sheet') or None,
+            offset=offset,
+            limit=limit,
+            sort=parse_sort(request.GET.get('sort')),
+            filters=parse_filters(request.GET.getlist('filter')),
+        )
+    except (ValueError, GridError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    
+    return JsonResponse(window)
+
+def _diff_page(request, upload):
+    """Render the diff form and, once it is filled in, the diff itself"""
+    sheet = request.GET.get('sheet') or None
+    if sheet is not None and sheet not in upload.sheet_names:
+        raise Http404(f"No sheet named '{sheet}'")
+    columns = sheet_columns(upload, sheet)
+    
+    form = DiffForm(request.GET if 'against' in request.GET else None, upload=upload, columns=columns)
+    diff = against = None
+    if form.is_valid():
+        against = form.cleaned_data['against']
+        try:
+            # The diff itself is cached per upload pair and runs on the bounded pool
+            diff = cached_diff(
+                upload, against, form.cleaned_data['key'],
+                sheet_a=sheet, sheet_b=form.cleaned_data['against_sheet'] or None, compute=call_bounded,
+            )
+        except (ValueError, GridError) as e:
+            form.add_error(None, str(e))
+    
+    context = {
+        'upload': upload,
+        'against': against,
+        'form': form,
+        'diff': diff,
+        'sheets': upload.sheet_names,
+        'active_sheet': sheet or (upload.sheet_names[0] if upload.sheet_names else ''),
+        'changed_columns': [col for col in diff['column_changes'] if col['changed']] if diff else [],
+        'matched_rows': diff['changed_count'] + diff['unchanged_count'] if diff else 0,
+    }
+    return render(request, 'dashboard/diff.html', context)
+
+async def upload_diff(request, pk):
+    """Compare an upload with another (usually newer) version of the same data"""
+    upload = await aget_object_or_404(DataUpload, pk=pk)
+    if not upload.is_ready():
+        return redirect('dashboard:data_preview', pk=upload.pk)
+    return await sync_to_async(_diff_page, thread_sensitive=False)(request, upload)
+
+def query_upload(request, pk):
+    """Run a JSON query spec (see query.py) against an upload's rows
+
+    The spec is the POST body, or the ``q`` parameter of a GET.
+    """
+    upload = get_object_or_404(DataUpload, pk=pk)
+    if not upload.is_ready():
+        return JsonResponse({'error': 'Upload is still being processed', 'status': upload.status}, status=409)
+    
+    try:
+        spec = json.loads(request.body if request.method == 'POST' else request.GET.get('q', '{}'))
+        result = run_query(upload, spec)
+    except json.JSONDecodeError as e:
+        return JsonResponse({'error': f'Invalid JSON: {e}'}, status=400)
+    except (ValueError, GridError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    
+    return JsonResponse(result)
+
+def export_upload(request, pk):
+    """Stream one sheet as CSV, NDJSON or XLSX, optionally gzipped"""
+    upload = get_object_or_404(DataUpload, pk=pk)
+    if not upload.is_ready():
+        return JsonResponse({'error': 'Upload is still being processed', 'status': upload.status}, status=409)
+    
+    fmt = request.GET.get('format', 'csv')
+    sheet = request.GET.get('sheet') or None
+    compress = request.GET.get('gzip') in ('1', 'true', 'yes')
+    try:
+        chunks = export_rows(upload, sheet, fmt, parse_filters(request.GET.getlist('filter')), compress)
+    except (ValueError, GridError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    
+    response = StreamingHttpResponse(chunks, content_type='application/gzip' if compress else EXPORT_FORMATS[fmt][0])
+    response['Content-Disposition'] = f'attachment; filename="{export_filename(upload, sheet, fmt, compress)}"'
+    # Let proxies pass bytes through as they are produced
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+@require_POST
+def materialize_upload(request, pk):
+    """Queue loading an upload into a SQLite table with optional indexes"""
+    upload = get_object_or_404(DataUpload, pk=pk)
+    if not upload.is_ready():
+        messages.error(request, 'The file is still being processed.')
+        return redirect('dashboard:data_preview', pk=pk)
+    
+    sheet_name = request.POST.get('sheet') or (upload.sheet_names[0] if upload.sheet_names else '')
+    if sheet_name not in upload.sheet_names:
+        raise Http404(f"No sheet named '{sheet_name}'")
+    
+    columns = upload.previews.filter(sheet_name=sheet_name).values_list('column_name', flat=True)
+    form = MaterializeForm(request.POST, columns=columns)
+    if form.is_valid():
+        enqueue_materialization(upload, sheet_name, form.cleaned_data['index_columns'])
+        messages.success(request, 'Loading data into the database. Indexed filters will be used once it is ready.')
+    else:
+        for field, errors in form.errors.items():
+            for error in errors:
+                messages.error(request, f"{field}: {error}")
+    return redirect(f"{reverse('dashboard:data_preview', args=[pk])}?{urlencode({'sheet': sheet_name})}")
+
+@require_POST
+def append_upload(request, pk):
+    """Queue adding the rows of another CSV file to an upload"""
+    upload = get_object_or_404(DataUpload, pk=pk)
+    if not upload.is_ready():
+        messages.error(request, 'The file is still being processed.')
+        return redirect('dashboard:data_preview', pk=pk)
+    
+    form = AppendForm(request.POST, request.FILES)
+    if not form.is_valid():
+        for field, errors in form.errors.items():
+            for error in errors:
+                messages.error(request, f"{field}: {error}")
+        return redirect('dashboard:data_preview', pk=pk)
+    
+    # The job reads the rows from a file of its own and deletes it when done
+    storage = upload.file.storage
+    name = storage.save(os.path.join('appends', os.path.basename(form.cleaned_data['file'].name)), form.cleaned_data['file'])
+    try:
+        check_appendable(upload, storage.path(name))
+    except AppendError as e:
+        storage.delete(name)
+        messages.error(request, str(e))
+        return redirect('dashboard:data_preview', pk=pk)
+    
+    enqueue_append(upload, storage.path(name))
+    messages.success(request, 'Appending rows. Only the new rows are processed.')
+    return redirect('dashboard:data_preview', pk=pk)
+
+@require_POST
+def delete_upload(request, pk):
+    """Delete an upload along with its tables, and its file once unused"""
+    upload = get_object_or_404(DataUpload, pk=pk)
+    title = upload.title
+    # Receivers drop its tables and release its file (see blobs.py, materialize.py)
+    upload.delete()
+    messages.success(request, f"'{title}' was deleted.")
+    return redirect('dashboard:index')
+
 class DataUploadListView(ListView):
-    """List all uploaded files"""
+    """List all uploaded files
+
+    Pages follow a cursor instead of a page number (see listing.py), and
+    only the columns the list shows are loaded.
+    """
     model = DataUpload
     template_name = 'dashboard/upload_list.html'
     context_object_name = 'uploads'
-    ordering = ['-uploaded_at']
     paginate_by = 10
 
-def process_excel_file(data_upload):
-    """Process uploaded Excel file and extract preview data"""
-    try:
-        file_ext = data_upload.get_extension()
-        
-        # Use chunking for larger files to improve memory usage
-        chunksize = 1000  # Adjust based on expected file sizes
-        
-        if file_ext in ['.xlsx', '.xls']:
-            excel = pd.ExcelFile(data_upload.file.path)
-            sheet_name = excel.sheet_names[0]  # Use first sheet
-            
-            # Use optimized reading with specific dtypes if possible
-            df = pd.read_excel(
-                data_upload.file.path, 
-                sheet_name=sheet_name,
-                nrows=100  # Limit initial read for preview/analysis
+    def get_queryset(self):
+        column_count = (
+            DataPreview.objects.filter(upload=OuterRef('pk'))
+            .values('upload').annotate(count=Count('*')).values('count')
+        )
+        queryset = (
+            DataUpload.objects.only('id', 'title', 'file', 'uploaded_at', 'status')
+            .annotate(
+                # Enough of the description for the truncated column
+                description_excerpt=Substr('description', 1, 51),
+                column_count=Coalesce(Subquery(column_count), 0),
             )
-        elif file_ext == '.csv':
-            # Use optimized CSV reading
-            df = pd.read_csv(
-                data_upload.file.path,
-                nrows=100,  # Limit initial read for preview/analysis
-                low_memory=True
-            )
-            sheet_name = 'CSV Data'
-        else:
-            print(f"Unsupported file extension: {file_ext}")
-            return
-        
-        # Clear any existing previews for this upload
-        DataPreview.objects.filter(upload=data_upload).delete()
-        
-        # Store column information in DataPreview model
-        for column in df.columns:
-            data_type = str(df[column].dtype)
-            
-            # Optimize sample data storage by using JSON serialization
-            # and limiting to first 3 non-null values when possible
-            sample_values = df[column].dropna().head(3).tolist()
-            sample = json.dumps(sample_values)
-            
-            # Create preview entry
-            DataPreview.objects.create(
-                upload=data_upload,
-                sheet_name=sheet_name,
-                column_name=column,
-                column_data_type=data_type,
-                sample_data=sample
+        )
+        return search_uploads(queryset, self.request.GET.get('q', ''))
+
+    def paginate_queryset(self, queryset, page_size):
+        try:
+            page = keyset_page(
+                queryset, page_size, after=self.request.GET.get('after'), before=self.request.GET.get('before'),
             )
-            
-        # Return total rows count for user feedback
-        if file_ext in ['.xlsx', '.xls']:
-            total_rows = len(pd.read_excel(data_upload.file.path, sheet_name=sheet_name, header=None))
-        else:
-            total_rows = sum(1 for _ in open(data_upload.file.path))
-        
-        return total_rows
-    except Exception as e:
-        print(f"Error processing file: {str(e)}")
-        # Log the error properly
-        import logging
-        logging.error(f"File processing error: {str(e)}")
-        return None
+        except CursorError as e:
+            raise Http404(str(e))
+        return None, page, page.object_list, page.has_other_pages()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['query'] = self.request.GET.get('q', '')
+        return context
+
+@staff_member_required
+def performance(request):
+    """Request timings, query counts and cache hit rates over the recent window"""
+    context = metrics.window_summary()
+    context['enabled'] = metrics.ENABLED
+    return render(request, 'dashboard/performance.html', context)
+
+def metrics_export(request):
+    """Metrics in the Prometheus text format, for staff or a scraper holding METRICS_TOKEN"""
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    authorized = request.user.is_authenticated and request.user.is_staff
+    if token and request.headers.get('Authorization') == f'Bearer {token}':
+        authorized = True
+    if not authorized:
+        return HttpResponse('Forbidden', status=403, content_type='text/plain')
+    return HttpResponse(metrics.prometheus_text(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 def debug_upload(request):
     """Debug view for file uploads"""
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -47,7 +48,29 @@ INSTALLED_APPS = [
 
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
 
+# Background ingestion (see dashboard/jobs.py)
+INGEST_ASYNC = True  # False runs ingestion inline in the request
+INGEST_WORKERS = 2
+INGEST_NICE = 10  # lower CPU priority of ingestion processes, so page requests go first
+PROFILE_MODE = 'exact'  # 'approximate' profiles columns with fixed-size sketches (see dashboard/sketches.py)
+CHUNKED_UPLOAD_MAX_CHUNK = 8 * 1024 * 1024  # largest chunk accepted by the resumable upload API
+CHUNKED_UPLOAD_EXPIRY = 24 * 60 * 60  # seconds before an abandoned resumable upload and its partial file are deleted
+PREVIEW_WORKERS = 4  # threads parsing files for async preview views (see dashboard/offload.py)
+GRID_ORDER_CACHE_BYTES = 256 * 1024 * 1024  # sorted/filtered row orders kept per sheet; least recently used go first
+
+# Per-request timings, query counts and cache hit rates (see dashboard/metrics.py)
+METRICS_ENABLED = True  # False removes the middleware and makes every hook a no-op
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # lets a Prometheus scraper read /metrics/ without a staff login
+
+# Hash uploads as they arrive so duplicates can share one stored file
+FILE_UPLOAD_HANDLERS = [
+    'dashboard.blobs.SHA256UploadHandler',
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+
 MIDDLEWARE = [
+    'dashboard.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -84,9 +107,49 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Keep connections (and their pragmas) between requests
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            # Writers queue for the lock when their transaction begins, where the busy timeout applies
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 5,
+        },
     }
 }
 
+# Applied to every new SQLite connection (see dashboard/database.py)
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',  # readers are never blocked by an ingestion writing
+    'synchronous': 'NORMAL',  # durable at checkpoints; safe from corruption in WAL mode
+    'busy_timeout': 5000,  # ms a writer waits for the lock
+    'cache_size': -64000,  # 64 MB page cache per connection
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+DATABASE_WRITE_ATTEMPTS = 4  # tries of an ingestion write that finds the database locked
+
+
+# Cache
+# File-based so all workers on the host share computed previews (see
+# dashboard/caching.py, which adds an in-process LRU in front of it).
+# A local Redis works as a drop-in replacement:
+#   'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+#   'LOCATION': 'redis://127.0.0.1:6379',
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache',
+        'TIMEOUT': 60 * 10,
+        'OPTIONS': {
+            'MAX_ENTRIES': 2000,
+        },
+    }
+}
+
+PREVIEW_CACHE_LOCAL_ENTRIES = 128  # size of the in-process LRU in front of CACHES
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators